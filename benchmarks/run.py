@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+iimport benchmarks.
+
+Measures notebook reading, markup processing (on import and in executed
+cells), conversion to .py, output stripping, notebook lookup and full import on synthetic
+notebooks (see synthetic.py), reports time and peak allocated memory of every stage and optionally
+compares them to results saved by a previous run:
+
+    $ python benchmarks/run.py --save baseline.json
+    ... (switch to another commit)
+    $ python benchmarks/run.py --compare baseline.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(1, os.path.dirname(here))
+
+import nbformat
+
+import iimport
+from iimport.strip import NotebookStripper
+from synthetic import write_notebook
+
+scenarios = {
+    'small': dict(n_cells=20, lines_per_cell=10),
+    'large': dict(n_cells=250, lines_per_cell=20),
+    'deep': dict(n_cells=50, lines_per_cell=40, depth=8),
+    'many_params': dict(n_cells=50, lines_per_cell=40, n_params=25),
+    'skip_blocks': dict(n_cells=50, lines_per_cell=20, skip_blocks=10),
+    'outputs': dict(n_cells=50, lines_per_cell=20, output_size=2**20),
+}
+
+
+def measure(fn, repeat):
+    """
+    Run `fn` `repeat` times and return timings and peak memory
+    (measured on a separate run, as tracing slows the code down).
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'time_min': min(times),
+        'time_median': statistics.median(times),
+        'peak_kb': peak / 1024,
+    }
+
+
+def run_scenario(name, params, tmpdir, repeat):
+    nb_dir = os.path.join(tmpdir, name)
+    os.makedirs(nb_dir)
+    modname = 'bench_%s' % name
+    path = write_notebook(os.path.join(nb_dir, modname + '.ipynb'), **params)
+    nb = iimport.read_ipynb(path)
+
+    def read_nbformat():
+        with open(path, 'r', encoding='utf-8') as f:
+            nbformat.read(f, 4)
+
+    cells = [cell.source.splitlines(True) for cell in nb.cells
+             if cell.cell_type == 'code']
+
+    def run_cells():
+        transformer = iimport.CellTransformer(enabled=True)
+        for lines in cells:
+            transformer(lines)
+
+    def strip_notebook():
+        with open(path, 'r', encoding='utf-8', newline='') as f, \
+                open(os.devnull, 'w', encoding='utf-8') as out:
+            NotebookStripper(f, out).strip()
+
+    def import_notebook():
+        sys.modules.pop(modname, None)
+        importlib.import_module(modname)
+
+    def import_cold():
+        iimport.cache_opts['enabled'] = False
+        try:
+            import_notebook()
+        finally:
+            iimport.cache_opts['enabled'] = True
+
+    # Path with many directories without notebooks, as on long sys.path
+    lookup_path = [os.path.join(tmpdir, 'empty%i' % i) for i in range(50)]
+    for d in lookup_path:
+        os.makedirs(d, exist_ok=True)
+    lookup_path.append(nb_dir)
+
+    benchmarks = {
+        'read_ipynb': lambda: iimport.read_ipynb(path),
+        'read_nbformat': read_nbformat,
+        'process_ipynb': lambda: iimport.NotebookLoader.process_ipynb(nb),
+        'process_ipynb_chain': lambda: iimport.NotebookLoader.process_ipynb(
+            nb, parser='chain'),
+        'cell_transformer': run_cells,
+        'strip_notebook': strip_notebook,
+        'convert_ipynb': lambda: iimport.NotebookLoader.convert_ipynb(path),
+        'find_notebook_hit': lambda: iimport.find_notebook(modname,
+                                                           lookup_path),
+        'find_notebook_miss': lambda: iimport.find_notebook('missing',
+                                                            lookup_path),
+        'import_cold': import_cold,
+        'import_cached': import_notebook,
+    }
+
+    cwd = os.getcwd()
+    os.chdir(nb_dir)
+    write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = False
+    try:
+        return {bench: measure(fn, repeat) for bench, fn in benchmarks.items()}
+    finally:
+        sys.dont_write_bytecode = write_bytecode
+        os.chdir(cwd)
+        sys.modules.pop(modname, None)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Print time and memory ratios to the baseline, return number of
+    regressions (ratio above `threshold`).
+    """
+    regressions = 0
+    for scenario, benches in sorted(results.items()):
+        for bench, res in sorted(benches.items()):
+            base = baseline.get(scenario, {}).get(bench)
+            if base is None:
+                continue
+            time_ratio = res['time_min'] / max(base['time_min'], 1e-9)
+            mem_ratio = res['peak_kb'] / max(base['peak_kb'], 1e-3)
+            flag = ''
+            if time_ratio > threshold or mem_ratio > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print('%-12s %-20s time x%.2f  memory x%.2f%s'
+                  % (scenario, bench, time_ratio, mem_ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=sorted(scenarios),
+                        help='scenarios to run (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--save', help='save results to the JSON file')
+    parser.add_argument('--compare', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='ratio to the baseline reported as regression')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name in args.scenario or sorted(scenarios):
+            results[name] = run_scenario(name, scenarios[name], tmpdir,
+                                         args.repeat)
+            for bench, res in results[name].items():
+                print('%-12s %-20s %9.2f ms  %10.0f KiB'
+                      % (name, bench, res['time_min'] * 1000, res['peak_kb']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'meta': {
+                    'iimport': iimport.__version__,
+                    'revision': git_revision(),
+                    'python': platform.python_version(),
+                },
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+Generator of synthetic marked up notebooks for benchmarks.
+
+Every code cell holds a chain of nested procedures:
+
+    %def cell3_level0(args.p0, args.p1):
+    v0_0 = args.p0 + 0
+    %def cell3_level1(args.p0, args.p1):
+    v1_0 = args.p1 + 0
+    %return v1_0
+    %/*
+    skipped = 0
+    %*/
+    %- print(v0_0)
+    %return v0_0
+    top3 = 3
+
+so importing the notebook exercises procedure collection, nesting,
+parameter substitution, skip blocks and top-level code execution.
+"""
+import base64
+
+import nbformat
+
+
+def make_cell_source(cell, lines_per_cell=20, depth=1, n_params=3,
+                     skip_blocks=1):
+    params = ', '.join('args.p%i' % j for j in range(n_params))
+    levels = max(depth, 1)
+    body_lines = max(lines_per_cell // levels, 1)
+
+    lines = []
+    for level in range(levels):
+        lines.append('%%def cell%i_level%i(%s):' % (cell, level, params))
+        for i in range(body_lines):
+            lines.append('v%i_%i = args.p%i + %i'
+                         % (level, i, i % max(n_params, 1), i))
+    for level in reversed(range(levels)):
+        for block in range(skip_blocks):
+            lines += ['%/*', 'skipped_%i = %i' % (block, block), '%*/']
+        lines.append('%%- print(v%i_0)' % level)
+        lines.append('%%return v%i_%i' % (level, body_lines - 1))
+    lines.append('top%i = %i' % (cell, cell))
+    return '\n'.join(lines)
+
+
+def make_output(size):
+    data = base64.b64encode(b'\0' * (size * 3 // 4)).decode('ascii')
+    return nbformat.v4.new_output(
+        'display_data', {'image/png': data, 'text/plain': '<Figure>'})
+
+
+def make_notebook(n_cells=50, lines_per_cell=20, depth=1, n_params=3,
+                  skip_blocks=1, output_size=0):
+    """
+    Make a notebook with `n_cells` marked up code cells.
+
+    output_size -- size (bytes) of base64 image output attached to every cell
+    """
+    setup = ('import types\n'
+             'args = types.SimpleNamespace(%s)'
+             % ', '.join('p%i=%i' % (j, j) for j in range(n_params)))
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(setup)]
+    for cell in range(n_cells):
+        nb.cells.append(nbformat.v4.new_markdown_cell('## Cell %i' % cell))
+        code = nbformat.v4.new_code_cell(make_cell_source(
+            cell, lines_per_cell, depth, n_params, skip_blocks))
+        if output_size:
+            code.outputs = [make_output(output_size)]
+        nb.cells.append(code)
+    return nb
+
+
+def write_notebook(path, **params):
+    nb = make_notebook(**params)
+    with open(path, 'w', encoding='utf-8') as f:
+        nbformat.write(nb, f)
+    return path
@@ -2,3 +2,7 @@ from iimport import save_ipynb_to_py
 
 c = get_config()
 c.FileContentsManager.post_save_hook = save_ipynb_to_py
+
+# To export notebooks in background threads without blocking the save:
+# from iimport import save_ipynb_to_py_async
+# c.FileContentsManager.post_save_hook = save_ipynb_to_py_async
@@ -1,6 +1,7 @@
 import os
 #from .iimport import load_ipython_extension, unload_ipython_extension
 from .iimport import *
+from .iimport import __version__
 
 # def _jupyter_server_extension_paths():
 #     return [{
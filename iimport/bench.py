@@ -0,0 +1,265 @@
+"""
+iimport-bench: run named examples of notebooks as benchmarks.
+
+    $ iimport-bench features models --save baseline.json
+    ... (change the notebooks)
+    $ iimport-bench features models --compare baseline.json
+
+Named examples (`%example name` ... `%end_example`) become `_example_name`
+functions of the imported notebook. Every example is run `warmup` times,
+timed `repeat` times and run once more to measure peak allocated memory
+(tracing slows the code down). Examples are run in parallel worker
+processes; as they compete for CPU and memory bandwidth, use `-j 1` for
+precise timings (the examples are run in the current process then).
+
+Results are compared with the baseline saved by a previous run, and the
+examples slower or using more memory than `threshold` times the baseline
+are reported as regressions (the exit code is 1 then).
+
+Without arguments, examples of the notebooks imported in the session
+(`%iimport_bench` magic) or of the notebooks in the current directory
+are run.
+"""
+import argparse
+import ast
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .iimport import (NotebookLoader, find_notebook, module_lock,
+                      notebook_modules, __version__)
+
+example_prefix = '_example_'
+
+
+def example_names(source):
+    """
+    Names of examples defined in the module source.
+    """
+    return [node.name[len(example_prefix):]
+            for node in ast.parse(source).body
+            if isinstance(node, ast.FunctionDef)
+            and node.name.startswith(example_prefix)
+            and not node.args.args]
+
+
+def find_examples(notebooks=None, path=None):
+    """
+    Find examples of the notebooks given as module names or .ipynb paths
+    (by default, of the imported notebooks or of the notebooks in the
+    current directory). Returns [(module name, notebook path, example)].
+    """
+    if not notebooks:
+        modules = notebook_modules()
+        if modules:
+            notebooks = [mod.__name__ for mod in modules]
+        else:
+            notebooks = sorted(fn for fn in os.listdir('.')
+                               if fn.endswith('.ipynb'))
+    path = list(path or []) + ['']
+    tasks = []
+    for nb in notebooks:
+        if nb.endswith('.ipynb'):
+            if not os.path.isfile(nb):
+                raise FileNotFoundError(nb)
+            name = os.path.basename(nb)[:-len('.ipynb')]
+            nb_path = nb
+        else:
+            name = nb
+            nb_path = find_notebook(nb, path)
+            if nb_path is None:
+                raise ImportError("Notebook %s is not found" % nb)
+        mod = sys.modules.get(name)
+        if mod is not None and '_source' in mod.__dict__:
+            source = mod._source
+        else:
+            source, _, _ = NotebookLoader().compile_ipynb(nb_path)
+        nb_path = os.path.abspath(nb_path)
+        tasks += [(name, nb_path, example)
+                  for example in example_names(source)]
+    return tasks
+
+
+def measure(fn, warmup=1, repeat=5):
+    """
+    Run `fn` `warmup` times, then `repeat` times measuring time, then once
+    more measuring peak allocated memory.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'time_min': min(times),
+        'time_median': statistics.median(times),
+        'time_mean': statistics.mean(times),
+        'time_stdev': statistics.stdev(times) if len(times) > 1 else 0.,
+        'peak_kb': peak / 1024,
+    }
+
+
+def import_notebook(name, nb_path):
+    """
+    Import the notebook from the file unless it is imported already.
+    """
+    with module_lock(name):
+        mod = sys.modules.get(name)
+        if mod is None:
+            loader = NotebookLoader()
+            spec = importlib.util.spec_from_file_location(name, nb_path,
+                                                          loader=loader)
+            mod = importlib.util.module_from_spec(spec)
+            sys.modules[name] = mod
+            try:
+                loader.exec_module(mod)
+            except BaseException:
+                sys.modules.pop(name, None)
+                raise
+        return mod
+
+
+def run_example(name, nb_path, example, warmup=1, repeat=5):
+    """
+    Import the notebook and measure the example.
+    """
+    mod = import_notebook(name, nb_path)
+    return measure(getattr(mod, example_prefix + example), warmup, repeat)
+
+
+def bench_examples(tasks, jobs=None, warmup=1, repeat=5, report=print):
+    """
+    Measure the examples. Returns ({module: {example: stats}},
+    {'module:example': error}) of measured and failed examples.
+    """
+    results = {}
+    failures = {}
+
+    def done(name, example, stats):
+        results.setdefault(name, {})[example] = stats
+        report('%-20s %-20s %9.2f ms  +-%7.2f ms  %10.0f KiB'
+               % (name, example, stats['time_median'] * 1000,
+                  stats['time_stdev'] * 1000, stats['peak_kb']))
+
+    def failed(name, example, exc):
+        failures['%s:%s' % (name, example)] = exc
+        report('%-20s %-20s FAILED: %s' % (name, example, exc))
+
+    if jobs == 1:
+        for task in tasks:
+            try:
+                done(task[0], task[2], run_example(*task, warmup, repeat))
+            except Exception as exc:
+                failed(task[0], task[2], exc)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(run_example, *task, warmup, repeat):
+                       task for task in tasks}
+            for future in as_completed(futures):
+                name, _, example = futures[future]
+                try:
+                    done(name, example, future.result())
+                except Exception as exc:
+                    failed(name, example, exc)
+    return results, failures
+
+
+def compare(results, baseline, threshold, report=print):
+    """
+    Report time and memory ratios to the baseline, return number of
+    regressions (ratio above `threshold`).
+    """
+    regressions = 0
+    for name, examples in sorted(results.items()):
+        for example, stats in sorted(examples.items()):
+            base = baseline.get(name, {}).get(example)
+            if base is None:
+                continue
+            time_ratio = stats['time_min'] / max(base['time_min'], 1e-9)
+            mem_ratio = stats['peak_kb'] / max(base['peak_kb'], 1e-3)
+            flag = ''
+            if time_ratio > threshold or mem_ratio > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            report('%-20s %-20s time x%.2f  memory x%.2f%s'
+                   % (name, example, time_ratio, mem_ratio, flag))
+    return regressions
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump({
+            'meta': {
+                'iimport': __version__,
+                'python': platform.python_version(),
+            },
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='iimport-bench',
+        description='Run named examples of notebooks as benchmarks.')
+    parser.add_argument('notebooks', nargs='*',
+                        help='notebook files or module names (default: '
+                             'imported notebooks or notebooks in the '
+                             'current directory)')
+    parser.add_argument('-e', '--example', action='append',
+                        help='examples to run (default: all)')
+    parser.add_argument('-p', '--path', action='append', default=[],
+                        help='directory to look for notebooks in '
+                             '(default: current)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes '
+                             '(default: number of CPUs)')
+    parser.add_argument('-w', '--warmup', type=int, default=1)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--save', help='save results to the JSON file')
+    parser.add_argument('--compare', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='ratio to the baseline reported as regression')
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error('--repeat must be positive')
+
+    try:
+        tasks = find_examples(args.notebooks, args.path)
+    except (ImportError, OSError, SyntaxError) as exc:
+        print('iimport-bench: %s' % exc, file=sys.stderr)
+        return 1
+    if args.example:
+        tasks = [task for task in tasks if task[2] in args.example]
+    if not tasks:
+        print('iimport-bench: no examples found', file=sys.stderr)
+        return 1
+
+    results, failures = bench_examples(tasks, args.jobs, args.warmup,
+                                       args.repeat)
+    if args.save:
+        save_results(args.save, results)
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+    return 1 if failures or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+iimport-bundle: pack compiled notebooks into a zip archive importable
+without iimport, IPython and nbformat.
+
+    $ iimport-bundle -o features.zip features.ipynb models
+
+Notebooks imported by the given ones (with `%iimport` or `import`)
+are added too. Their names are kept, so they are imported the same way
+as from the notebooks. On the workers put the archive on `sys.path`:
+
+    sys.path.insert(0, 'features.zip')
+    import features
+
+Modules are stored as bytecode of the running Python version, so the
+workers must run the same version. Magics other than `%iimport` and
+`%time` are ignored, `%{cache}def` results are cached in memory only.
+"""
+import argparse
+import ast
+import importlib.util
+import json
+import marshal
+import os
+import re
+import sys
+import zipfile
+
+from .iimport import (NotebookLoader, NotebookCache, find_notebook,
+                      read_ipynb, __version__)
+
+runtime_name = '_iimport_runtime'
+manifest_name = 'iimport_bundle.json'
+
+
+def module_name(path):
+    """
+    Module name of the notebook file (`My notebook.ipynb` -> `My_notebook`).
+    """
+    base = os.path.basename(path).rsplit('.', 1)[0]
+    return base.replace('-', '_').replace(' ', '_')
+
+
+_iimport_magic_re = re.compile(r'^[ \t]*%iimport[ \t]+(.*)$', re.M)
+
+
+def notebook_imports(nb, tree):
+    """
+    Names of modules imported by the notebook: with `import` statements
+    of the generated code and with `%iimport` magic (top-level magics are
+    cut from the generated code, so they are looked up in the cells).
+    """
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            if node.module and not node.level:
+                names.append(node.module)
+    for cell in nb.cells:
+        if cell.cell_type != 'code':
+            continue
+        for line in _iimport_magic_re.findall(cell.source):
+            args = [a for a in line.split() if not a.startswith('--')]
+            if args:
+                names.append(args[0])
+    return names
+
+
+class RuntimeImports(ast.NodeTransformer):
+    """
+    Make the generated code use `_iimport_runtime` instead of IPython
+    and iimport.
+    """
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if (isinstance(node.func, ast.Name) and node.func.id == '__import__'
+                and len(node.args) == 1
+                and isinstance(node.args[0], ast.Constant)
+                and node.args[0].value == 'iimport'):
+            node.args[0] = ast.copy_location(ast.Constant(runtime_name),
+                                             node.args[0])
+        return node
+
+    def visit_Module(self, node):
+        self.generic_visit(node)
+        pos = 0
+        for stmt in node.body:
+            if (isinstance(stmt, ast.ImportFrom)
+                    and stmt.module == '__future__'):
+                pos += 1
+            else:
+                break
+        stmt = ast.ImportFrom(module=runtime_name,
+                              names=[ast.alias(name='get_ipython')], level=0)
+        node.body.insert(pos, ast.copy_location(
+            stmt, node.body[pos] if pos < len(node.body) else node))
+        return node
+
+
+def compile_notebook(path, filename):
+    """
+    Returns (source, code, imported module names) of the notebook,
+    the code is compiled with `filename`.
+    """
+    source, _, _ = NotebookLoader(os.path.dirname(path)).compile_ipynb(
+        path, mode='module')
+    tree = ast.parse(source)
+    imports = notebook_imports(read_ipynb(path), tree)
+    tree = ast.fix_missing_locations(RuntimeImports().visit(tree))
+    return source, compile(tree, filename, 'exec'), imports
+
+
+def pyc_data(source, code):
+    """
+    Contents of unchecked hash-based .pyc file: it is loaded without
+    looking for the source file.
+    """
+    return (importlib.util.MAGIC_NUMBER
+            + (0b01).to_bytes(4, 'little')
+            + importlib.util.source_hash(source.encode('utf-8'))
+            + marshal.dumps(code))
+
+
+def find_notebooks(notebooks, path):
+    """
+    Find the notebooks given as names or .ipynb paths.
+    Returns [(module name, notebook path)].
+    """
+    found = []
+    for nb in notebooks:
+        if nb.endswith('.ipynb'):
+            if not os.path.isfile(nb):
+                raise FileNotFoundError(nb)
+            found.append((module_name(nb), os.path.abspath(nb)))
+        else:
+            nb_path = find_notebook(nb, path)
+            if nb_path is None:
+                raise ImportError("Notebook %s is not found" % nb)
+            found.append((nb, os.path.abspath(nb_path)))
+    return found
+
+
+def bundle_notebooks(notebooks, output, path=None, report=print):
+    """
+    Compile the notebooks and the notebooks they import into a zip
+    archive `output`. Returns the manifest written to the archive:
+    {'modules': {name: notebook path}, ...}.
+    """
+    path = list(path or []) + ['']
+    queue = find_notebooks(notebooks, path)
+    archive = os.path.abspath(output)
+    modules = {}
+    entries = []
+    while queue:
+        name, nb_path = queue.pop(0)
+        if name in modules:
+            if modules[name] != nb_path:
+                raise ImportError("Notebooks %s and %s have the same module "
+                                  "name %s" % (modules[name], nb_path, name))
+            continue
+        if '.' in name:
+            raise ImportError("Notebooks in packages are not supported: %s"
+                              % name)
+        modules[name] = nb_path
+        filename = os.path.join(archive, name + '.py')
+        source, code, imports = compile_notebook(nb_path, filename)
+        entries.append((name + '.py', source.encode('utf-8')))
+        entries.append((name + '.pyc', pyc_data(source, code)))
+        report('%-24s %s' % (name, nb_path))
+
+        nb_dir = os.path.dirname(nb_path)
+        for imported in imports:
+            if '.' in imported:
+                continue
+            imported_path = find_notebook(imported, [nb_dir] + path)
+            if imported_path is not None:
+                queue.append((imported, os.path.abspath(imported_path)))
+
+    runtime_path = os.path.join(os.path.dirname(__file__), 'bundle_runtime.py')
+    with open(runtime_path, 'rb') as f:
+        entries.append((runtime_name + '.py', f.read()))
+    manifest = {
+        'iimport': __version__,
+        'python': '%i.%i' % sys.version_info[:2],
+        'modules': modules,
+        'digests': {name: NotebookCache.file_digest(nb_path)
+                    for name, nb_path in modules.items()},
+    }
+    entries.append((manifest_name,
+                    json.dumps(manifest, indent=1, sort_keys=True)
+                    .encode('utf-8')))
+
+    tmp_path = '%s.%i.tmp' % (archive, os.getpid())
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for arcname, data in entries:
+                # Fixed date, so the same notebooks give the same archive
+                info = zipfile.ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zf.writestr(info, data)
+        os.replace(tmp_path, archive)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='iimport-bundle',
+        description='Pack compiled notebooks and the notebooks they import '
+                    'into a zip archive importable without iimport.')
+    parser.add_argument('notebooks', nargs='+',
+                        help='notebook files or module names')
+    parser.add_argument('-o', '--output', required=True,
+                        help='archive to write')
+    parser.add_argument('-p', '--path', action='append', default=[],
+                        help='directory to look for notebooks in '
+                             '(default: current)')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    report = (lambda line: None) if args.quiet else print
+    try:
+        manifest = bundle_notebooks(args.notebooks, args.output, args.path,
+                                    report=report)
+    except (ImportError, OSError, SyntaxError) as exc:
+        print('iimport-bundle: %s' % exc, file=sys.stderr)
+        return 1
+    print('%i notebooks written to %s' % (len(manifest['modules']),
+                                          args.output),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Runtime support of notebooks bundled with iimport-bundle.
+
+This file is copied into every bundle as `_iimport_runtime` module.
+The code generated from notebooks calls `get_ipython()` for magics and
+shell commands and `__import__('iimport').memoize` for cached procedures;
+here are their stand-ins which need neither IPython nor iimport, so it
+must depend on the standard library only.
+"""
+import functools
+import importlib
+import inspect
+import logging
+import pickle
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+from hashlib import md5
+
+logger = logging.getLogger('iimport.bundle')
+
+# Magics which make no sense outside of the notebook
+ignored_magics = {'load_ext', 'reload_ext', 'matplotlib', 'config',
+                  'autoreload', 'aimport', 'iimport_enabled'}
+
+
+class Shell(object):
+    """
+    Part of the IPython shell interface used by the generated code.
+    """
+
+    def run_line_magic(self, magic_name, line, _stack_depth=1):
+        ns = sys._getframe(_stack_depth).f_globals
+        if magic_name == 'iimport':
+            return self.iimport(line, ns)
+        if magic_name in ('time', 'timeit'):
+            exec(line, ns)
+            return
+        if magic_name not in ignored_magics:
+            logger.warning("Magic %%%s is not supported in bundled notebooks"
+                           % magic_name)
+
+    def run_cell_magic(self, magic_name, line, cell):
+        logger.warning("Cell magic %%%%%s is not supported in bundled "
+                       "notebooks" % magic_name)
+
+    # The same as `%iimport` magic, but the notebooks are taken from
+    # the bundle
+    def iimport(self, line, ns):
+        args = [arg for arg in line.split() if not arg.startswith('--')]
+        path, *args = args
+        if len(args) == 0:
+            name = path
+            for c in ',. -':
+                name = name.replace(c, '_')
+            name = name.lower()
+        elif args[0] == 'as':
+            name = args[1]
+        else:
+            raise ImportError()
+        ns[name] = importlib.import_module(path)
+
+    def system(self, cmd):
+        return subprocess.call(cmd, shell=True)
+
+    def getoutput(self, cmd, split=True):
+        out = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             universal_newlines=True).stdout
+        return out.splitlines() if split else out
+
+_shell = Shell()
+
+def get_ipython():
+    return _shell
+
+
+# Results cache of %{cache}def procedures (in memory only)
+max_entries = 128
+_results = OrderedDict()
+_lock = threading.Lock()
+_missing = object()
+
+def memoize(source_digest, storage=None):
+    def decorator(fn):
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            try:
+                raw = pickle.dumps(
+                    (source_digest, bound.args, sorted(bound.kwargs.items())),
+                    pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                return fn(*args, **kwargs)
+            key = md5(raw).hexdigest()
+            with _lock:
+                result = _results.get(key, _missing)
+                if result is not _missing:
+                    _results.move_to_end(key)
+                    wrapper.hits += 1
+                    return result
+            wrapper.misses += 1
+            result = fn(*args, **kwargs)
+            with _lock:
+                _results[key] = result
+                while len(_results) > max_entries:
+                    _results.popitem(last=False)
+            return result
+
+        wrapper.hits = 0
+        wrapper.misses = 0
+        wrapper.source_digest = source_digest
+        return wrapper
+    return decorator
@@ -0,0 +1,153 @@
+"""
+iimport-convert: batch conversion of notebook trees to .py files.
+
+    $ iimport-convert notebooks/ -j 8
+
+Notebooks are converted in parallel worker processes. The content hash
+of every converted notebook is saved to a state file in the root of the
+tree, and on the next run notebooks with the same hash are skipped.
+Failures are reported and do not stop the batch.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .iimport import (NotebookCache, NotebookLoader, write_if_changed,
+                      __version__)
+
+state_filename = '.iimport-convert.json'
+
+
+def find_notebooks(root):
+    """
+    Walk the tree and yield paths of notebooks, skipping hidden directories
+    (including `.ipynb_checkpoints`).
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for fn in sorted(filenames):
+            if fn.endswith('.ipynb'):
+                yield os.path.join(dirpath, fn)
+
+
+def load_state(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if state.get('version') != __version__:
+        # Conversion may give different results, convert everything again
+        return {}
+    return state.get('notebooks', {})
+
+
+def save_state(path, notebooks):
+    text = json.dumps({'version': __version__, 'notebooks': notebooks},
+                      indent=1, sort_keys=True)
+    write_if_changed(path, text)
+
+
+def convert_notebook(path, entry=None, force=False):
+    """
+    Convert the notebook unless its contents match the `entry` of the
+    previous run. Returns (status, entry, seconds), status is one of
+    'skipped', 'unchanged' (.py is up to date) and 'converted'.
+    """
+    start = time.perf_counter()
+    st = os.stat(path)
+    stamp = [st.st_mtime_ns, st.st_size]
+    py_exists = os.path.isfile(path.rsplit('.', 1)[0] + '.py')
+    entry = entry or {}
+
+    if not force and py_exists and entry.get('stamp') == stamp:
+        return 'skipped', entry, time.perf_counter() - start
+    digest = NotebookCache.file_digest(path)
+    new_entry = {'stamp': stamp, 'md5': digest}
+    if not force and py_exists and entry.get('md5') == digest:
+        return 'skipped', new_entry, time.perf_counter() - start
+
+    written = NotebookLoader.convert_ipynb(path)
+    status = 'converted' if written else 'unchanged'
+    return status, new_entry, time.perf_counter() - start
+
+
+def convert_tree(root, jobs=None, force=False, state_path=None,
+                 report=print):
+    """
+    Convert all notebooks in the tree. Returns {path: error} of failures.
+    """
+    if state_path is None:
+        state_path = os.path.join(root, state_filename)
+    state = load_state(state_path)
+    new_state = {}
+    failures = {}
+
+    def done(path, status, entry, seconds):
+        new_state[os.path.relpath(path, root)] = entry
+        report('%-9s %8.3fs  %s' % (status, seconds, path))
+
+    def failed(path, exc):
+        failures[path] = exc
+        report('%-9s %8s   %s: %s' % ('FAILED', '', path, exc))
+
+    paths = list(find_notebooks(root))
+    tasks = [(path, state.get(os.path.relpath(path, root)), force)
+             for path in paths]
+
+    if jobs == 1:
+        for task in tasks:
+            try:
+                done(task[0], *convert_notebook(*task))
+            except Exception as exc:
+                failed(task[0], exc)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(convert_notebook, *task): task[0]
+                       for task in tasks}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    done(path, *future.result())
+                except Exception as exc:
+                    failed(path, exc)
+
+    save_state(state_path, new_state)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='iimport-convert',
+        description='Convert notebooks in directory trees to .py files.')
+    parser.add_argument('roots', nargs='*', default=['.'],
+                        help='directories to convert (default: current)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes '
+                             '(default: number of CPUs)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='convert notebooks even if they did not change')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='report failures only')
+    args = parser.parse_args(argv)
+
+    def report(line):
+        if not args.quiet or line.startswith('FAILED'):
+            print(line)
+
+    start = time.perf_counter()
+    failures = {}
+    for root in args.roots:
+        failures.update(convert_tree(root, args.jobs, args.force,
+                                     report=report))
+    print('Done in %.1fs, %i failed' % (time.perf_counter() - start,
+                                        len(failures)),
+          file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,32 @@
 import os
 import sys
 import types
+import ast
+import builtins
+import functools
+import inspect
+import itertools
+import numbers
+import copy
+import contextlib
+import threading
+import time
+import tracemalloc
+import weakref
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed, wait, FIRST_COMPLETED)
 from functools import reduce
 
 import importlib
+import importlib.util
+import json
+import linecache
+import marshal
+import pickle
 import re
+import shlex
 import logging
 logger = logging.getLogger(__name__)
 
@@ -12,11 +34,13 @@ import numpy as np
 from hashlib import md5
 
 import nbformat
+from nbformat import NotebookNode
 from IPython import get_ipython
-from IPython.core.inputtransformer import InputTransformer, CoroutineInputTransformer
 from IPython.core.interactiveshell import InteractiveShell
 from IPython.core.magic import register_line_magic
 
+__version__ = '0.1.dev1'
+
 #
 # Procedure collector
 #
@@ -87,6 +111,25 @@ class Procedure(object):
                             .format(param=param))
         return name, default
 
+    @staticmethod
+    def substitution_re(values):
+        """
+        Compile one regex matching any of parameter default values.
+
+        Values are matched as whole expressions: `args.path` does not match
+        inside `args.path_extra` or `self.args.path`. Longer values take
+        precedence over shorter ones starting at the same position.
+        """
+        patterns = []
+        for value in sorted(values, key=len, reverse=True):
+            pattern = re.escape(value)
+            if re.match(r'\w', value):
+                pattern = r'(?<![\w.])' + pattern
+            if re.search(r'\w$', value):
+                pattern = pattern + r'(?!\w)'
+            patterns.append(pattern)
+        return re.compile('|'.join(patterns))
+
     def __repr__(self):
         return self.__dict__.__repr__()
 
@@ -97,20 +140,43 @@ class Procedure(object):
         self.param_names = [k for k, v in self.params]
         self.param_defaults = [v for k, v in self.params]
         self.param_substs = [(v, k) for k, v in self.params if v is not None]
+        self.subst_names = {}
+        for v, k in self.param_substs:
+            if v != k:
+                self.subst_names.setdefault(v, k)
+        self.subst_re = None
+        if self.subst_names:
+            self.subst_re = self.substitution_re(self.subst_names)
 
         self.body = []
         self.ns = ns
+        # Names of inner procedures called in the body
+        self.calls = []
+        # Digests of their code (see `end`)
+        self.call_digests = []
+        # Positions of the header and body lines in the notebook
+        # (see `SourceMap`)
+        self.origin = None
+        self.origins = []
 
         self.indent = meta.get('indent', 0)
+        # Tag options: %{cache,disk}def -> ['cache', 'disk']
+        self.options = [s.strip() for s in
+                        (meta.get('options') or '').split(',') if s.strip()]
         logger.debug("Procedure metadata from header:\n%s" % self)
 
-    def add_line(self, line, meta):
+    def add_line(self, line, meta, origin=None):
         assert line.startswith(self.indent)
         # Trim indentation
         line = line[len(self.indent):]
         # Substitute parameter values by its names
-        line = reduce(lambda s, r: s.replace(*r), self.param_substs, line)
+        if self.subst_re is not None:
+            line = self.subst_re.sub(self.substitute, line)
         self.body.append(line)
+        self.origins.append(origin)
+
+    def substitute(self, match):
+        return self.subst_names[match.group()]
 
     def end(self, results, meta):
         self.results = [s.strip() for s in results.split(',')]
@@ -128,8 +194,58 @@ class Procedure(object):
                            for k, v in self.params)
         text = "\ndef %s(%s):\n" % (self.name, params)
         text += '\n'.join('    %s' % s for s in comment_lines + self.body)
+        # Inner procedures are defined as separate functions,
+        # so their code is not in the text
+        self.digest = md5('\n'.join([text] + self.call_digests)
+                          .encode('utf-8')).hexdigest()
+        if 'cache' in self.options:
+            text = self.memoize_decorator() + text
         return text
 
+    def memoize_decorator(self):
+        """
+        Decorator line caching the function results (see `memoize`),
+        keyed by the hash of the function source (including the inner
+        procedures) and arguments.
+        """
+        storage = None
+        for option in self.options:
+            if option in result_storages:
+                storage = option
+        return ("\n@__import__('iimport').memoize(%r, %r)"
+                % (self.digest, storage))
+
+    def node(self):
+        """
+        Description of the procedure in the procedure graph
+        (see `MarkupParser.graph`).
+        """
+        return {
+            'params': self.param_names,
+            'defaults': {k: v for k, v in self.params if v is not None},
+            'results': self.results,
+            'calls': list(self.calls),
+        }
+
+    def add_call(self, inner, meta, origin=None):
+        """
+        Add the call of the inner procedure which has just ended.
+        """
+        self.calls.append(inner.name)
+        self.call_digests.append(inner.digest)
+        self.add_line(inner.call(meta), meta, origin)
+
+    def text_origins(self, text, origin):
+        """
+        Positions in the notebook of the lines of function `text` returned
+        by `end`: header and docstring lines come from the procedure header,
+        `return` line from the `origin` of the ending tag.
+        """
+        if not text:
+            return [origin]
+        n_header = text.count('\n') + 1 - len(self.body)
+        return [self.origin] * n_header + self.origins + [origin]
+
     def call(self, meta):
         params = ', '.join(v if v is not None else k for k, v in self.params)
         results = ', '.join(self.results)
@@ -210,6 +326,7 @@ def fetch_tag(destination, opts={}):
             indent = m.group('indent')
             assert len(indent) % 4 == 0
             meta['indent'] = indent
+            meta['options'] = m.group('tagoptions')
 
         # If processing is disabled, ignore all tags
         if opts.get('enabled', True):
@@ -293,13 +410,13 @@ def collect_proc(destination, ipython=None):
             text = proc.end(line, meta)
             logger.debug('Defining a function:{text}'.format(text=text))
             # Restore previous procedure
-            call = proc.call(meta)
+            inner = proc
             proc = stack.pop()
             # Declare procedure
             line_out = destination.send((tag, text, meta))
             # Add procedure call to the wrapping procedure
             if proc is not None:
-                proc.add_line(call, meta)
+                proc.add_call(inner, meta)
 
         elif tag == 'BEGIN_EXAMPLE':
             # Example is a special case of the procedure. It encapsulates
@@ -353,191 +470,3525 @@ def output_filter(is_module=False):
         else:
             line_out = None
 
-#
-# .ipynb import mechanism
-#
+class MarkupParser(object):
+    """
+    Single-pass markup processor.
 
-def find_notebook(fullname, path=None):
-    name = fullname.rsplit('.', 1)[-1]
-    if not path:
-        path = ['']
-    for d in path:
-        nb_path = os.path.join(d, name + '.ipynb')
-        if os.path.isfile(nb_path):
-            return nb_path
-        # try with hyphens
-        nb_path_hyp = nb_path.replace('_', '-')
-        if os.path.isfile(nb_path_hyp):
-            return nb_path_hyp
-        # try with spaces
-        nb_path_spc = nb_path.replace('_', ' ')
-        if os.path.isfile(nb_path_spc):
-            return nb_path_spc
+    Produces the same output as `fetch_tag` -> `collect_proc` ->
+    `output_filter(is_module=not interactive)` chain, but instead of pushing
+    every line through the coroutines it finds all tag lines of a cell with
+    one regex search and handles the runs of plain lines between them
+    in bulk.
 
-class NotebookFinder(object):
-    def __init__(self):
-        self.loaders = {}
+    Feed it with cells one by one (procedures may span several cells),
+    each call returns output lines of the cell.
+    """
+    tag_re = re.compile(_tag_re, re.M)
+    procname_re = re.compile(_procname_re)
+    examplename_re = re.compile(_examplename_re)
 
-    def find_module(self, fullname, path=None):
-        nb_path = find_notebook(fullname, path)
-        if not nb_path:
+    def __init__(self, interactive=False, source_map=False,
+                 checkpoint=False):
+        # Output all the code (as in the notebook), not only
+        # the code outside procedures (as in the module)
+        self.interactive = interactive
+        # In interactive mode, wrap the code of top-level procedures
+        # in checkpoint restoring (see `checkpoint_lines`)
+        self.checkpoint = checkpoint
+        # (feed number, position in its output) of the procedure body
+        self.checkpoint_start = None
+        self.feeds = 0
+        # Record positions of output lines in the notebook: after every
+        # `feed` `origins_out` holds a list of (cell, line) for every
+        # line of every item of its output (see `SourceMap`)
+        self.source_map = source_map
+        self.origins_out = None
+        self.cell = 0
+        self.lineno = 1
+        self.ended = None
+        # Stack of procedures in declaration
+        self.stack = []
+        # Procedure being collected
+        self.proc = None
+        # Inside %/* ... %*/ block
+        self.skipping = False
+        # The previous line closed %/* ... %*/ block
+        # (the chain does not recognize %/* right after %*/)
+        self.after_skip = False
+        # Names of functions defined so far
+        self.procedures = []
+        # Procedures defined so far, {name: `Procedure.node()`}
+        self.graph = OrderedDict()
+
+    def is_clean(self):
+        return (self.proc is None and not self.stack
+                and not self.skipping and not self.after_skip)
+
+    def state_digest(self):
+        """
+        Digest of the parser state: the output of the next cell is fully
+        determined by its text and this digest.
+        """
+        if self.is_clean():
+            return ''
+        # Digests of inner procedures are in the memoize decorator
+        # of the outer one (see `Procedure.end`)
+        procs = [(type(p).__name__, p.name, p.params, p.indent, p.options,
+                  p.body, p.calls, p.call_digests)
+                 for p in self.stack + [self.proc] if p is not None]
+        state = (procs, [p is None for p in self.stack],
+                 self.skipping, self.after_skip)
+        return md5(repr(state).encode('utf-8')).hexdigest()
+
+    def get_state(self):
+        if self.is_clean():
+            return None
+        return copy.deepcopy(
+            (self.stack, self.proc, self.skipping, self.after_skip))
+
+    def set_state(self, state):
+        if state is None:
+            self.stack, self.proc = [], None
+            self.skipping = self.after_skip = False
+        else:
+            (self.stack, self.proc, self.skipping, self.after_skip) = \
+                copy.deepcopy(state)
+
+    def feed(self, text):
+        if self.source_map:
+            return self.feed_with_origins(text)
+        self.feeds += 1
+        lines_out = []
+        pos = 0
+        for m in self.tag_re.finditer(text):
+            if m.start() > pos:
+                self.add_lines(text[pos:m.start() - 1].split('\n'),
+                               lines_out)
+            end = text.find('\n', m.start())
+            if end < 0:
+                end = len(text)
+            self.add_tag(m, text[m.start():end], lines_out)
+            pos = end + 1
+        if pos <= len(text):
+            self.add_lines(text[pos:].split('\n'), lines_out)
+        return lines_out
+
+    def feed_with_origins(self, text):
+        """
+        The same as `feed`, but also fills `origins_out`.
+        """
+        self.cell += 1
+        lines_out = []
+        self.origins_out = origins = []
+        pos = 0
+
+        def add_lines(lines):
+            n = len(lines_out)
+            self.lineno = text.count('\n', 0, pos) + 1
+            self.add_lines(lines, lines_out)
+            origins.extend([(self.cell, self.lineno + i)]
+                           for i in range(len(lines_out) - n))
+
+        for m in self.tag_re.finditer(text):
+            if m.start() > pos:
+                add_lines(text[pos:m.start() - 1].split('\n'))
+            end = text.find('\n', m.start())
+            if end < 0:
+                end = len(text)
+            n = len(lines_out)
+            self.lineno = text.count('\n', 0, m.start()) + 1
+            self.ended = None
+            self.add_tag(m, text[m.start():end], lines_out)
+            origin = (self.cell, self.lineno)
+            for item in lines_out[n:]:
+                if self.ended is not None:
+                    origins.append(self.ended.text_origins(item, origin))
+                else:
+                    origins.append([origin])
+            pos = end + 1
+        if pos <= len(text):
+            add_lines(text[pos:].split('\n'))
+        return lines_out
+
+    def add_lines(self, lines, lines_out):
+        self.after_skip = False
+        if self.interactive:
+            lines_out.extend(lines)
+        if self.skipping:
+            return
+        if self.proc is None:
+            if not self.interactive:
+                lines_out.extend(lines)
+        elif self.source_map:
+            for i, line in enumerate(lines):
+                self.proc.add_line(line, None, (self.cell, self.lineno + i))
+        else:
+            for line in lines:
+                self.proc.add_line(line, None)
+
+    def add_tag(self, m, line, lines_out):
+        indent = m.group('indent')
+        assert len(indent) % 4 == 0
+        tag = tags.get(m.group('tagcode'))
+        if tag is None:
+            # Not a markup tag (some other magic command)
+            self.add_lines([line], lines_out)
+            return
+        logger.debug("Found tag: %s" % tag)
+        line = line[len(m.group(0)):]
+        meta = {'indent': indent, 'options': m.group('tagoptions')}
+
+        after_skip = self.after_skip
+        self.after_skip = False
+        if self.skipping:
+            if tag == 'END_SKIP':
+                self.skipping = False
+                self.after_skip = True
+                lines_out.append(line)
+            elif self.interactive and tag != 'BEGIN_PROC':
+                lines_out.append(line)
             return
 
-        key = path
-        if path:
-            key = os.path.sep.join(path)
+        if tag == 'BEGIN_SKIP' and not after_skip:
+            self.skipping = True
+            if self.interactive:
+                lines_out.append(line)
 
-        if key not in self.loaders:
-            self.loaders[key] = NotebookLoader(path)
-        return self.loaders[key]
+        elif tag == 'SKIP_LINE':
+            if self.interactive:
+                lines_out.append(line)
 
+        elif tag == 'BEGIN_PROC':
+            try:
+                m_name = self.procname_re.match(line)
+                new_proc = Procedure(
+                    m_name.group('name'), m_name.group('params'), meta)
+                new_proc.origin = (self.cell, self.lineno)
+                if (self.checkpoint and self.interactive
+                        and not self.source_map and self.proc is None):
+                    self.checkpoint_start = (self.feeds, len(lines_out))
+                self.stack.append(self.proc)
+                self.proc = new_proc
+            except Exception as exc:
+                exc_type, exc, tb = sys.exc_info()
+                logger.error('Procedure header parsing error: %s, %s'
+                             % (exc_type, exc))
 
-class NotebookLoader(object):
+        elif (tag == 'END_PROC' and self.proc is not None
+              and type(self.proc) != Example):
+            text = self.proc.end(line, meta)
+            logger.debug('Defining a function:{text}'.format(text=text))
+            inner = self.ended = self.proc
+            self.procedures.append(inner.name)
+            self.graph[inner.name] = inner.node()
+            self.proc = self.stack.pop()
+            start = self.checkpoint_start
+            self.checkpoint_start = None
+            if (self.proc is None and start is not None
+                    and start[0] == self.feeds):
+                lines_out[start[1]:] = self.checkpoint_lines(
+                    inner, lines_out[start[1]:])
+            lines_out.append(text)
+            if self.proc is not None:
+                self.proc.add_call(inner, meta, (self.cell, self.lineno))
 
-    def __init__(self, path=None):
-        self.shell = InteractiveShell.instance()
-        self.path = path
+        elif tag == 'BEGIN_EXAMPLE':
+            try:
+                name = None
+                match = self.examplename_re.match(line)
+                if match and match.group('name') is not None:
+                    name = '_example_' + match.group('name')
+                new_proc = Example(name, meta)
+                new_proc.origin = (self.cell, self.lineno)
+                self.stack.append(self.proc)
+                self.proc = new_proc
+            except Exception as exc:
+                exc_type, exc, tb = sys.exc_info()
+                logger.error('Example header parsing error: %s, %s'
+                             % (exc_type, exc))
+
+        elif tag == 'END_EXAMPLE' and type(self.proc) == Example:
+            text = self.proc.end(line, meta)
+            logger.debug('Defining a function:{text}'.format(text=text))
+            if self.proc.name is not None:
+                self.procedures.append(self.proc.name)
+            self.ended = self.proc
+            lines_out.append(text)
+            self.proc = self.stack.pop()
+
+        else:
+            logger.error("Wrong state: tag=%s, line=%s" % (tag, line))
 
     @staticmethod
-    def process_ipynb(nb):
+    def checkpoint_lines(proc, lines):
         """
-        Pass the notebook through procedure collection filter and return parsed text.
+        Wrap the lines of the procedure executed inline: if its body and
+        parameter values are the same as in one of the previous runs,
+        its results are restored instead (see `Checkpoint`).
+
+        Procedures calling inner ones are executed as is (inner functions
+        should be defined anyway), as well as the ones with multiline
+        strings (they cannot be reindented).
         """
-        chain = fetch_tag(collect_proc(output_filter(is_module=True)))
-        lines_out = []
+        body = '\n'.join(proc.body)
+        if proc.calls or "'''" in body or '"""' in body:
+            return lines
+        indent = proc.indent
+        digest = md5(repr((proc.name, proc.params, proc.body))
+                     .encode('utf-8')).hexdigest()
+        params = {k: v for k, v in proc.params if k}
+        results = ', '.join('%r: %s' % (r, r) for r in proc.results if r)
+        var = '__iimport_checkpoint__'
+        return ([
+            "%s%s = __import__('iimport').Checkpoint(%r, %r, globals(), %r)"
+            % (indent, var, proc.name, digest, params),
+            '%sif not %s.restore(globals()):' % (indent, var),
+        ] + ['    ' + line if line.strip() else line for line in lines] + [
+            '%s    %s.save(lambda: {%s})' % (indent, var, results),
+            '%sdel %s' % (indent, var),
+        ])
+
+# Lines which may need IPython token transformations:
+# escaped commands (%magic, !shell, ?help, autocall), magic and shell
+# assignments (a = %magic, a = !shell) and help requests (obj?)
+_ipython_syntax_re = re.compile(
+    r'^[ \t]*[%!?/,;]|=[ \t]*[%!]|\?[ \t]*$', re.M)
 
-        for cell in nb.cells:
-            cell_lines = [l for l in cell.source.split('\n') if l is not None]
-            if cell.cell_type != 'code':
-                cell_lines = ['#### ' + l for l in cell_lines]
-            cell_lines_out = [l for l in (chain.send(l) for l in cell_lines)
-                              if l is not None]
-            if len(cell_lines_out) > 0:
-                lines_out += cell_lines_out
-                lines_out.append('\n')
+#
+# Compiled notebooks cache
+#
 
-        # Cut all ipython magic
-        magic_matcher = re.compile('^%.*')
-        lines_out = [l for l in lines_out if magic_matcher.match(l) is None]
+cache_opts = {
+    # Set to False to always parse and compile notebooks from scratch
+    'enabled': True,
+    # Directory to keep compiled notebooks in.
+    # None means `__pycache__` directory next to the notebook.
+    'dir': None,
+    # Max total size of cached files in one cache directory (bytes)
+    'max_size': 32 * 2**20,
+}
 
-        text = '\n'.join(lines_out)
+class NotebookCache(object):
+    """
+    Persistent cache of compiled notebooks, similar to `__pycache__`.
+
+    Entries are keyed by md5 of the notebook file contents, iimport version
+    and Python bytecode version (and, by `NotebookLoader`, of the import
+    mode, the markup parser and IPython input transformations), so any
+    change in the notebook or in the toolchain produces a new entry. When
+    a new entry for the notebook is stored, the old ones are evicted; if
+    the cache directory grows larger than `max_size`, least recently used
+    entries are evicted too. In a shared cache directory
+    (`cache_opts['dir']`) entry names include a hash of the notebook
+    directory.
+
+    Each entry holds the transformed module source, its code object
+    and some statistics of the notebook processing.
+    """
+    suffix = '.nbc'
 
-        # Cut newlines repeating more than 3 times
-        text = re.compile('\n\n\n\n*').sub('\n\n\n', text)
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
 
-        return text
+    @staticmethod
+    def key(raw, *extra):
+        """
+        Make cache key from notebook file contents and any extra values
+        which affect the result of compilation.
+        """
+        return NotebookCache._key(md5(raw).hexdigest(), extra)
 
     @staticmethod
-    def convert_ipynb(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            nb = nbformat.read(f, 4)
-        text = NotebookLoader.process_ipynb(nb)
+    def file_digest(path):
+        h = md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                h.update(chunk)
+        return h.hexdigest()
 
-        path_py = path.rsplit('.', 1)[0] + '.py'
-        with open(path_py, 'w', encoding='utf-8') as f:
-            f.writelines(text)
+    @staticmethod
+    def file_key(path, *extra):
+        """
+        The same as `key`, but the file is hashed chunk by chunk.
+        """
+        return NotebookCache._key(NotebookCache.file_digest(path), extra)
 
-    def load_module(self, fullname):
-        path = find_notebook(fullname, self.path)
+    @staticmethod
+    def _key(digest, extra):
+        h = md5(digest.encode('ascii'))
+        for item in (__version__, importlib.util.MAGIC_NUMBER) + extra:
+            h.update(repr(item).encode('utf-8'))
+        return h.hexdigest()
 
-        logger.info("Importing notebook %s" % path)
-        with open(path, 'r', encoding='utf-8') as f:
-            nb = nbformat.read(f, 4)
+    def notebook_key(self, nb_path, *extra):
+        """
+        The same as `file_key`, but the digest of the file is saved along
+        with its mtime and size (as `.pyc` files do), so notebooks with large
+        outputs are not hashed again until they are modified.
+        """
+        st = os.stat(nb_path)
+        stamp = '%i %i' % (st.st_mtime_ns, st.st_size)
+        stamp_path = self.cache_path(nb_path, 'stamp')[:-len(self.suffix)]
+        try:
+            with open(stamp_path, 'r') as f:
+                saved_stamp, digest = f.read().rsplit(' ', 1)
+            if saved_stamp == stamp:
+                return self._key(digest, extra)
+        except (OSError, ValueError):
+            pass
+
+        digest = self.file_digest(nb_path)
+        if not sys.dont_write_bytecode:
+            tmp_path = '%s.%i.%i.tmp' % (stamp_path, os.getpid(),
+                                          threading.get_ident())
+            try:
+                os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+                with open(tmp_path, 'w') as f:
+                    f.write('%s %s' % (stamp, digest))
+                os.replace(tmp_path, stamp_path)
+            except OSError:
+                pass
+        return self._key(digest, extra)
+
+    def _dir(self, nb_path):
+        if self.cache_dir is not None:
+            return self.cache_dir
+        return os.path.join(os.path.dirname(os.path.abspath(nb_path)),
+                            '__pycache__')
+
+    def _name(self, nb_path):
+        name = os.path.basename(nb_path).rsplit('.', 1)[0]
+        if self.cache_dir is None:
+            return name
+        # Notebooks with the same name in different directories
+        # share the cache directory
+        nb_dir = os.path.dirname(os.path.abspath(nb_path))
+        return '%s-%s' % (name, md5(nb_dir.encode('utf-8')).hexdigest()[:12])
+
+    def cache_path(self, nb_path, key):
+        return os.path.join(
+            self._dir(nb_path),
+            '{name}.{tag}.{key}{suffix}'.format(
+                name=self._name(nb_path), tag=sys.implementation.cache_tag,
+                key=key, suffix=self.suffix))
+
+    def load(self, nb_path, key):
+        """
+        Return (source, code, info) tuple or None if there's no valid entry.
+        """
+        path = self.cache_path(nb_path, key)
+        try:
+            with open(path, 'rb') as f:
+                source, code, info = marshal.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            exc_type, exc, tb = sys.exc_info()
+            logger.debug("Broken cache entry %s: %s" % (path, exc))
+            return None
+        # Mark entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        logger.debug("Using cached notebook %s" % path)
+        return source, code, info
 
-        mod = types.ModuleType(fullname)
-        mod.__file__ = path
-        mod.__loader__ = self
-        mod.__dict__['get_ipython'] = get_ipython
-        sys.modules[fullname] = mod
+    def store(self, nb_path, key, source, code, info=None):
+        """
+        Store the module source and code object along with `info` dict
+        (statistics of the notebook processing).
+        """
+        path = self.cache_path(nb_path, key)
+        tmp_path = '%s.%i.%i.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                marshal.dump((source, code, info or {}), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            exc_type, exc, tb = sys.exc_info()
+            logger.debug("Cannot write cache entry %s: %s" % (path, exc))
+            return
+        self.evict(nb_path, keep=path)
+
+    def evict(self, nb_path, keep=None):
+        """
+        Remove stale entries of the notebook made by this Python version
+        (entries of other versions are not stale for them) and trim cache
+        directory to `max_size`.
+        """
+        cache_dir = self._dir(nb_path)
+        name = self._name(nb_path)
+        try:
+            fnames = [fn for fn in os.listdir(cache_dir)
+                      if fn.endswith(self.suffix)]
+        except OSError:
+            return
+
+        entries = []
+        for fn in fnames:
+            path = os.path.join(cache_dir, fn)
+            try:
+                # name.tag.key.nbc
+                parts = fn.rsplit('.', 3)
+                if (parts[:2] == [name, sys.implementation.cache_tag]
+                        and len(parts) == 4 and path != keep):
+                    os.unlink(path)
+                    continue
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        if self.max_size is None:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def _get_cache():
+    if not cache_opts.get('enabled', True):
+        return None
+    return NotebookCache(cache_opts.get('dir'), cache_opts.get('max_size'))
+
+#
+# Procedure results cache
+#
+
+result_cache_opts = {
+    # Set to False to call procedures marked with %{cache}def directly
+    'enabled': True,
+    # Where to keep results of procedures marked with %{cache}def
+    # (%{cache,memory}def and %{cache,disk}def override it):
+    #   'memory' -- in this process, least recently used are evicted
+    #   'disk' -- pickled in `dir`, shared between processes and sessions
+    'storage': 'memory',
+    # Max number of results kept in memory
+    'max_entries': 128,
+    # Directory to keep pickled results in
+    'dir': os.path.join(os.path.expanduser('~'), '.cache', 'iimport'),
+    # Max total size of pickled results (bytes)
+    'max_size': 4 * 2**30,
+}
+
+class MemoryResultCache(object):
+    """
+    In-memory LRU cache of procedure results.
+    """
+    _missing = object()
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, self._missing)
+            if value is self._missing:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while (self.max_entries is not None
+                   and len(self.entries) > self.max_entries):
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries)}
+
+class DiskResultCache(object):
+    """
+    Cache of pickled procedure results in a directory.
+
+    Results are written atomically, so the directory may be shared by
+    several processes. When the total size of the results exceeds
+    `max_size`, least recently used ones are evicted (reading a result
+    updates its mtime).
+    """
+    suffix = '.result'
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
 
-        save_user_ns = self.shell.user_ns
-        self.shell.user_ns = mod.__dict__
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
 
-        text = self.process_ipynb(nb)
+    def get(self, key, default=None):
+        path = self.path(key)
         try:
-            mod._source = source = \
-                self.shell.input_transformer_manager.transform_cell(text)
-            mod._numbered_source = numbered_source = \
-                '\n'.join(['%4i %s' % (n+1, l)
-                           for n, l in enumerate(source.split('\n'))])
-            exec(source, mod.__dict__)
-        except Exception:
-            exc_type, exc, tb = sys.exc_info()
-            logger.error("Exception during module code execution: line %i, %s"
-                         % (tb.tb_lineno, exc))
-            logger.error("Executing module source:\n%s"
-                         % numbered_source)
-            raise e
-        finally:
-            self.shell.user_ns = save_user_ns
-            return mod
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return default
+        except Exception as exc:
+            # Truncated entry, or the class of the result was renamed
+            # or moved since it was saved
+            logger.debug("Dropping broken cache entry %s: %s" % (path, exc))
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except (OSError, pickle.PicklingError) as exc:
+            logger.warning("Cannot cache procedure result in %s: %s"
+                           % (path, exc))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def entries(self):
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        entries = []
+        for fn in names:
+            if not fn.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
 
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.hits = self.misses = 0
+
+    def info(self):
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(entries),
+                'size': sum(size for _, size, _ in entries)}
+
+result_storages = {
+    'memory': lambda: MemoryResultCache(result_cache_opts.get('max_entries')),
+    'disk': lambda: DiskResultCache(result_cache_opts['dir'],
+                                    result_cache_opts.get('max_size')),
+}
+_result_caches = {}
 
-# Registering ipynb import mechanism
-sys.meta_path.append(NotebookFinder())
+def get_result_cache(storage=None):
+    """
+    Results cache of the storage kind ('memory' or 'disk'),
+    `result_cache_opts['storage']` by default.
+    """
+    storage = storage or result_cache_opts.get('storage', 'memory')
+    if storage not in result_storages:
+        raise ValueError("Unknown results storage: {storage}"
+                         .format(storage=storage))
+    if storage not in _result_caches:
+        _result_caches[storage] = result_storages[storage]()
+    return _result_caches[storage]
+
+def _update_digest(h, value):
+    if type(value) is dict:
+        items = sorted(value_digest(item) for item in value.items())
+        h.update(b'dict %i ' % len(items) + b''.join(items))
+    elif type(value) in (set, frozenset):
+        items = sorted(value_digest(item) for item in value)
+        h.update(b'%s %i ' % (type(value).__name__.encode('ascii'),
+                              len(items)) + b''.join(items))
+    elif type(value) in (list, tuple):
+        h.update(b'%s %i ' % (type(value).__name__.encode('ascii'),
+                              len(value)))
+        for item in value:
+            _update_digest(h, item)
+    else:
+        h.update(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+def value_digest(value):
+    """
+    md5 digest of the pickled value. Digests of dicts and sets (also inside
+    lists and tuples) do not depend on the order of their items.
+    Raises an exception if the value cannot be pickled.
+    """
+    h = md5()
+    _update_digest(h, value)
+    return h.digest()
+
+def memoize(source_digest, storage=None):
+    """
+    Decorator caching results of the procedure marked with %{cache}def.
+
+    The key is `value_digest` of the procedure source digest and of
+    arguments (with defaults applied), so results are reused across calls,
+    notebooks and, with disk storage, sessions, and editing the procedure
+    invalidates them. Calls with arguments which cannot be pickled are not cached.
+    """
+    def decorator(fn):
+        sig = inspect.signature(fn)
+        missing = object()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not result_cache_opts.get('enabled', True):
+                return fn(*args, **kwargs)
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            try:
+                key = value_digest(
+                    (source_digest, bound.args, bound.kwargs)).hex()
+            except Exception as exc:
+                logger.debug("Not caching %s call: %s" % (fn.__name__, exc))
+                return fn(*args, **kwargs)
+            cache = get_result_cache(storage)
+            result = cache.get(key, missing)
+            if result is missing:
+                wrapper.misses += 1
+                result = fn(*args, **kwargs)
+                cache.set(key, result)
+            else:
+                wrapper.hits += 1
+            return result
+
+        wrapper.hits = 0
+        wrapper.misses = 0
+        wrapper.source_digest = source_digest
+        return wrapper
+    return decorator
 
 #
-# Extension activation function
+# Interactive checkpoints
 #
 
-def load_ipython_extension(ip):
+checkpoint_opts = {
+    # Restore results of procedures whose body and parameter values did not
+    # change instead of executing them again in the interactive session
+    # (`%iimport_checkpoint on`)
+    'enabled': False,
+    # Max total size of pickled results kept in memory (bytes)
+    'max_memory': 2 * 2**30,
+    # Directory to keep pickled results in, None to keep them in memory only
+    'dir': os.path.join(os.path.expanduser('~'), '.cache', 'iimport',
+                        'checkpoints'),
+    # Max total size of pickled results on disk (bytes)
+    'max_disk': 8 * 2**30,
+}
 
-    # Activating procedure collector
-    chain_opts = {'enabled': 0}
-    @CoroutineInputTransformer.wrap
-    def chain():
-        chain = fetch_tag(
-            collect_proc(output_filter(), ipython=ip),
-            opts=chain_opts)
-        line = yield
-        while True:
-            line = yield chain.send(line)
+class CheckpointStore(object):
+    """
+    Pickled results of procedures executed in the interactive session.
 
-    ip.input_splitter.physical_line_transforms.append(chain())
-    ip.input_transformer_manager.physical_line_transforms.append(chain())
+    Results are kept pickled, so restored objects are copies and changing
+    them does not change the checkpoint. Least recently used results are
+    evicted from memory when their size exceeds `max_memory`; if `cache_dir`
+    is set, all results are also written there (see `DiskResultCache`),
+    so they are reused after kernel restarts.
+    """
 
-    # Registering magics
-    def iimport_enabled(line):
-        """  Magic to toggle iimport mode
-        0 = disabled, all macro commands are ignored (cutted away from the code)
-        1 = enabled, all macro commands work
+    def __init__(self, max_memory=None, cache_dir=None, max_disk=None):
+        self.max_memory = max_memory
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.disk = None
+        if cache_dir is not None:
+            self.disk = DiskResultCache(cache_dir, max_disk)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
         """
-        enabled = int(line)
-        if enabled == 0:
-            chain_opts['enabled'] = 0
-            print("iimport macros disabled")
-        elif enabled == 1:
-            chain_opts['enabled'] = 1
-            print("iimport macros enabled")
-        else:
-            logger.error("Wrong argument supplied: {enabled}"
-                         .format(enabled=enabled))
+        Results dict saved with the key, or None.
+        """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+        if data is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                self._remember(key, data)
+        if data is None:
+            self.misses += 1
+            return None
+        try:
+            results = pickle.loads(data)
+        except Exception as exc:
+            # A class of the results was renamed or moved since they
+            # were saved
+            logger.debug("Dropping broken checkpoint %s: %s" % (key, exc))
+            self.discard(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return results
+
+    def discard(self, key):
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+        if self.disk is not None:
+            try:
+                os.unlink(self.disk.path(key))
+            except OSError:
+                pass
 
-    shell = InteractiveShell.instance()
-    def iimport(line):
-        path, *args = line.split()
-        if len(args) == 0:
-            name = reduce(lambda s, c: s.replace(c, '_'), ',. -', path).lower()
-        elif len(args) >= 1 and args[0] == 'as':
-            name = args[1]
-        else:
-            raise ImportError()
-        shell.user_ns[name] = importlib.import_module(path)
+    def set(self, key, results):
+        try:
+            data = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+        except Exception as exc:
+            logger.warning("Cannot checkpoint results %s: %s"
+                           % (', '.join(results), exc))
+            return
+        self._remember(key, data)
+        if self.disk is not None:
+            self.disk.set(key, data)
+
+    def _remember(self, key, data):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            if self.max_memory is not None and len(data) > self.max_memory:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            while self.max_memory is not None and self.size > self.max_memory:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        if self.disk is not None:
+            self.disk.clear()
+        self.hits = self.misses = 0
+
+    def info(self):
+        info = {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'size': self.size}
+        if self.disk is not None:
+            disk = self.disk.info()
+            info.update(disk_entries=disk['entries'], disk_size=disk['size'])
+        return info
+
+_checkpoint_store = None
+
+def get_checkpoint_store():
+    global _checkpoint_store
+    if _checkpoint_store is None:
+        _checkpoint_store = CheckpointStore(checkpoint_opts.get('max_memory'),
+                                            checkpoint_opts.get('dir'),
+                                            checkpoint_opts.get('max_disk'))
+    return _checkpoint_store
+
+class Checkpoint(object):
+    """
+    Checkpoint of a procedure executed inline in the interactive session
+    (see `MarkupParser` in checkpoint mode).
+
+    The key is `value_digest` of the procedure digest and of values of its
+    parameters before the body is executed. The inline body sees the
+    parameters as namespace variables, so their values are taken from
+    `ns`; default expressions (`params` maps names to them) are evaluated
+    only for the parameters not defined there. If the values cannot be
+    evaluated or pickled, the procedure is executed as usual and its
+    results are not saved.
+    """
 
-    register_line_magic(iimport_enabled)
-    register_line_magic(iimport)
+    def __init__(self, name, digest, ns, params):
+        self.name = name
+        self.key = None
+        try:
+            values = {}
+            for param, default in params.items():
+                if param in ns:
+                    values[param] = ns[param]
+                elif default is not None:
+                    values[param] = eval(default, ns)
+                else:
+                    raise NameError("name %r is not defined" % param)
+            key = value_digest((digest, values))
+        except Exception as exc:
+            logger.debug("No checkpoint for %s: %s" % (name, exc))
+            return
+        self.key = key.hex()
 
-    print('iimport loaded.')
+    def restore(self, ns):
+        """
+        Put saved results into the namespace, return False if there are none.
+        """
+        if self.key is None:
+            return False
+        results = get_checkpoint_store().get(self.key)
+        if results is None:
+            return False
+        ns.update(results)
+        print("%s: restored %s from checkpoint"
+              % (self.name, ', '.join(results) or 'nothing'))
+        return True
+
+    def save(self, results):
+        """
+        Save the results returned by `results` function.
+        """
+        if self.key is None:
+            return
+        try:
+            results = results()
+        except NameError as exc:
+            logger.warning("Not saving checkpoint of %s: %s"
+                           % (self.name, exc))
+            return
+        get_checkpoint_store().set(self.key, results)
 
-def unload_ipython_extension(ip):
-    print("Unloading this extension is currently not implemented,"
-          " please restart the kernel.")
+#
+# .ipynb import mechanism
+#
+
+class NotebookIndex(object):
+    """
+    Cache of directory listings used to look up notebooks.
 
+    For every directory it keeps a mapping of importable module names to
+    notebook file names, so a lookup costs one `stat` of the directory
+    (to check its mtime) instead of several `isfile` calls, and negative
+    lookups are answered from memory.
 
-def save_ipynb_to_py(model, os_path, contents_manager, **kwargs):
+    Notebook `My notebook.ipynb` or `My-notebook.ipynb` is importable
+    as `My_notebook`, exact names take precedence.
+    """
+
+    def __init__(self):
+        # {directory: (mtime, {module name: file name})}
+        self.dirs = {}
+
+    @staticmethod
+    def list_notebooks(d):
+        names = {}
+        variants = []
+        for fn in os.listdir(d):
+            if not fn.endswith('.ipynb'):
+                continue
+            base = fn[:-len('.ipynb')]
+            names.setdefault(base, fn)
+            if '_' not in base:
+                variants.append((1, base.replace('-', '_'), fn))
+                variants.append((2, base.replace(' ', '_'), fn))
+        # hyphens are tried before spaces
+        for _, name, fn in sorted(variants):
+            names.setdefault(name, fn)
+        return names
+
+    def names(self, d):
+        key = os.path.abspath(d)
+        try:
+            mtime = os.stat(key).st_mtime
+        except OSError:
+            self.dirs.pop(key, None)
+            return {}
+        entry = self.dirs.get(key)
+        if entry is None or entry[0] != mtime:
+            try:
+                entry = (mtime, self.list_notebooks(key))
+            except OSError:
+                return {}
+            self.dirs[key] = entry
+        return entry[1]
+
+    def find(self, name, path):
+        for d in path:
+            fn = self.names(d).get(name)
+            if fn is not None:
+                nb_path = os.path.join(d, fn)
+                if os.path.isfile(nb_path):
+                    return nb_path
+                # The file is gone but directory mtime is the same
+                # (e.g. coarse mtime resolution). Rescan on next lookup.
+                self.dirs.pop(os.path.abspath(d), None)
+
+    def invalidate(self):
+        self.dirs.clear()
+
+_notebook_index = NotebookIndex()
+
+import_opts = {
+    # Defer reading and execution of imported notebooks
+    # until the first attribute access (see `lazy_import`)
+    'lazy': False,
+    # Read notebooks with nbformat and validate them against the schema
+    # instead of extracting only cell sources (see `read_ipynb`)
+    'validate': False,
+    # Markup processing engine (see `NotebookLoader.process_ipynb`)
+    'parser': 'markup',
+    # Measure memory allocated on every import stage (see `ImportStats`)
+    'trace_memory': False,
+    # What to execute on import:
+    #   'module' -- all the code except procedures bodies and skipped lines
+    #   'definitions' -- only imports and function definitions
+    #                    (see `definitions_only`)
+    #   'slice' -- only the code needed for the names taken from the module,
+    #              on their first access (see `ModuleSlicer`)
+    'mode': 'module',
+    # Number of threads reading and compiling notebooks imported by the one
+    # being imported before they are reached (see `NotebookPrefetcher`),
+    # 0 to disable (prefetched notebooks may be never imported)
+    'prefetch': 0,
+    # What to do when the notebook code raises an exception on import:
+    #   'raise' -- remove the module from `sys.modules` and re-raise
+    #   'log' -- log the error and keep the partially executed module
+    #            (notebooks with lines which work only interactively)
+    'errors': 'raise',
+}
+
+class NotebookSourceReader(object):
+    """
+    Streaming reader of notebook JSON which extracts only cell types
+    and sources.
+
+    Everything else (outputs, attachments, metadata) is scanned through
+    without being decoded, so memory usage is bounded by the chunk size
+    plus the size of the code, regardless of the size of outputs.
+    """
+    chunk_size = 2**16
+    # Files up to this size are faster to parse with `json` as a whole
+    small_size = 2**20
+
+    _ws_re = re.compile(r'[ \t\n\r]*')
+    _struct_re = re.compile(r'["\[\]{}]')
+    _scalar_re = re.compile(r'[^,\]}\s]*')
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        """
+        Drop consumed part of the buffer and read the next chunk.
+        """
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _fill_or_fail(self):
+        if not self._fill():
+            raise ValueError("Unexpected end of notebook JSON")
+
+    def _peek(self):
+        """
+        Skip whitespace and return the next character.
+        """
+        while True:
+            self.pos = self._ws_re.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self._fill_or_fail()
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError("Malformed notebook JSON: expected %r, found %r"
+                             % (char, found))
+        self.pos += 1
+
+    def _string(self, keep=True):
+        """
+        Scan a string and return its value (or None if `keep` is False).
+        """
+        self._expect('"')
+        parts = []
+        start = self.pos
+        while True:
+            # str.find is much faster than regex search on long strings
+            # like base64-encoded images
+            quote = self.buf.find('"', self.pos)
+            end = len(self.buf) if quote < 0 else quote
+            escape = self.buf.find('\\', self.pos, end)
+            if escape >= 0:
+                if escape + 1 < len(self.buf):
+                    self.pos = escape + 2
+                    continue
+                # Escape sequence is cut by the chunk boundary
+                end = escape
+            elif quote >= 0:
+                if keep:
+                    parts.append(self.buf[start:quote])
+                self.pos = quote + 1
+                break
+            if keep:
+                parts.append(self.buf[start:end])
+            self.pos = end
+            self._fill_or_fail()
+            start = self.pos
+        if keep:
+            return json.loads('"%s"' % ''.join(parts))
+
+    def _scalar(self):
+        self._peek()
+        m = self._scalar_re.match(self.buf, self.pos)
+        while m.end() == len(self.buf) and self._fill():
+            m = self._scalar_re.match(self.buf, self.pos)
+        self.pos = m.end()
+        return json.loads(m.group())
+
+    def _skip(self):
+        """
+        Skip a value of any type without decoding it.
+        """
+        char = self._peek()
+        if char == '"':
+            self._string(keep=False)
+        elif char in '[{':
+            depth = 0
+            while True:
+                m = self._struct_re.search(self.buf, self.pos)
+                if m is None:
+                    self.pos = len(self.buf)
+                    self._fill_or_fail()
+                    continue
+                self.pos = m.start()
+                if m.group() == '"':
+                    self._string(keep=False)
+                    continue
+                self.pos += 1
+                depth += 1 if m.group() in '[{' else -1
+                if depth == 0:
+                    break
+        else:
+            self._scalar()
+
+    def _keys(self):
+        """
+        Iterate over object keys. The caller must consume each value.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._string()
+            self._expect(':')
+            yield key
+            char = self._peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError("Malformed notebook JSON: unexpected %r"
+                                 % char)
+
+    def _items(self):
+        """
+        Iterate over array items. The caller must consume each item.
+        """
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self._peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError("Malformed notebook JSON: unexpected %r"
+                                 % char)
+
+    def _source(self):
+        # Multiline strings are stored either as a string
+        # or as a list of lines
+        if self._peek() == '[':
+            return ''.join(self._string() for _ in self._items())
+        return self._string()
+
+    def _cell(self):
+        cell = NotebookNode(cell_type=None, source='')
+        for key in self._keys():
+            if key == 'cell_type':
+                cell.cell_type = self._string()
+            elif key == 'source':
+                cell.source = self._source()
+            else:
+                self._skip()
+        return cell
+
+    @staticmethod
+    def from_dict(data):
+        """
+        Make the same notebook structure from already parsed JSON.
+        """
+        def source(value):
+            return value if isinstance(value, str) else ''.join(value)
+        return NotebookNode(
+            nbformat=data.get('nbformat'),
+            cells=[NotebookNode(cell_type=cell.get('cell_type'),
+                                source=source(cell.get('source', '')))
+                   for cell in data.get('cells', [])])
+
+    def read(self):
+        nb = NotebookNode(nbformat=None, cells=[])
+        for key in self._keys():
+            if key == 'cells':
+                for _ in self._items():
+                    nb.cells.append(self._cell())
+            elif key == 'nbformat':
+                nb.nbformat = self._scalar()
+            else:
+                self._skip()
+        return nb
+
+def read_ipynb(path, validate=None):
+    """
+    Read the notebook for processing.
+
+    By default only cell types and sources are extracted: small files are
+    parsed with `json`, larger ones are scanned with `NotebookSourceReader`.
+    If `validate` is set (or the notebook is not in format version 4),
+    the notebook is read and validated by nbformat.
+    """
+    if validate is None:
+        validate = import_opts.get('validate', False)
+    if not validate:
+        with open(path, 'r', encoding='utf-8') as f:
+            if os.fstat(f.fileno()).st_size <= NotebookSourceReader.small_size:
+                nb = NotebookSourceReader.from_dict(json.load(f))
+            else:
+                nb = NotebookSourceReader(f).read()
+        if nb.nbformat == 4:
+            return nb
+    with open(path, 'r', encoding='utf-8') as f:
+        return nbformat.read(f, 4)
+
+# Locks of the notebooks executed outside of the import machinery (lazy
+# modules, legacy `load_module`) ({module name: lock}); `import` statement
+# uses its own
+_module_locks = weakref.WeakValueDictionary()
+_module_locks_lock = threading.Lock()
+
+@contextlib.contextmanager
+def module_lock(fullname):
+    """
+    Hold the lock of the module while it is being created and put into
+    `sys.modules`, so concurrent imports of the same notebook wait for
+    each other instead of executing it twice. The lock is reentrant.
+    """
+    with _module_locks_lock:
+        lock = _module_locks.get(fullname)
+        if lock is None:
+            lock = _module_locks[fullname] = threading.RLock()
+    with lock:
+        yield
+
+# Namespaces of the notebooks being executed, per thread
+_executing = threading.local()
+
+@contextlib.contextmanager
+def executing_in(ns):
+    """
+    Mark `ns` as the namespace of the code executed in this thread
+    (see `current_namespace`).
+    """
+    stack = _executing.__dict__.setdefault('namespaces', [])
+    stack.append(ns)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+def current_namespace(shell=None):
+    """
+    Namespace of the notebook being imported in this thread, or the user
+    namespace of the shell. `%iimport` in an imported notebook binds
+    the name there.
+    """
+    stack = getattr(_executing, 'namespaces', None)
+    if stack:
+        return stack[-1]
+    if shell is None:
+        shell = InteractiveShell.instance()
+    return shell.user_ns
+
+def find_notebook(fullname, path=None):
+    name = fullname.rsplit('.', 1)[-1]
+    if not path:
+        path = ['']
+    return _notebook_index.find(name, path)
+
+# Notebooks being imported by `lazy_import`, per thread
+_lazy_requests = threading.local()
+
+class NotebookFinder(object):
+    """
+    Meta path finder (PEP 451) for notebook files.
+
+    Top-level notebooks are looked up in the current directory,
+    notebooks inside packages -- in the package's `__path__`.
+    """
+    def __init__(self):
+        self.loaders = {}
+        self.lock = threading.Lock()
+
+    def find_spec(self, fullname, path=None, target=None):
+        if path is not None:
+            path = list(path)
+        nb_path = find_notebook(fullname, path)
+        if not nb_path:
+            return
+
+        key = path
+        if path:
+            key = os.path.sep.join(path)
+
+        with self.lock:
+            loader = self.loaders.get(key)
+            if loader is None:
+                loader = self.loaders[key] = NotebookLoader(path)
+        spec = importlib.util.spec_from_file_location(
+            fullname, nb_path, loader=loader)
+        if (import_opts.get('lazy', False)
+                or fullname in getattr(_lazy_requests, 'names', ())):
+            spec.loader = LazyNotebookLoader(spec.loader)
+        return spec
+
+    def find_module(self, fullname, path=None):
+        spec = self.find_spec(fullname, path)
+        if spec is not None:
+            return spec.loader
+
+    def invalidate_caches(self):
+        _notebook_index.invalidate()
+        _prefetcher.clear()
+
+
+#
+# Definitions-only import
+#
+
+class LazyDefault(object):
+    """
+    Default value of a procedure parameter which refers to notebook-level
+    code not executed in definitions-only import mode.
+
+    It is evaluated in the module namespace when the procedure is called
+    without this argument, so it can be provided by setting the module
+    variable before the call (`nb.f1_path = ...`).
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def __repr__(self):
+        return '<lazy default: %s>' % self.expr
+
+def resolve_lazy_defaults(fn):
+    """
+    Decorator evaluating `LazyDefault` parameter values on call.
+    """
+    sig = inspect.signature(fn)
+    lazy = [name for name, param in sig.parameters.items()
+            if isinstance(param.default, LazyDefault)]
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        bound = sig.bind(*args, **kwargs)
+        for name in lazy:
+            if name in bound.arguments:
+                continue
+            expr = sig.parameters[name].default.expr
+            try:
+                bound.arguments[name] = eval(expr, fn.__globals__)
+            except NameError as exc:
+                raise TypeError(
+                    "{fn}() missing argument '{name}': its default value "
+                    "`{expr}` is defined by notebook code which is not "
+                    "executed on definitions-only import ({exc})"
+                    .format(fn=fn.__name__, name=name, expr=expr, exc=exc))
+        return fn(*bound.args, **bound.kwargs)
+    return wrapper
+
+def _bound_names(node):
+    """
+    Names bound in the module namespace by the statement.
+    """
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return [(alias.asname or alias.name).split('.')[0]
+                for alias in node.names]
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                         ast.ClassDef)):
+        return [node.name]
+    return []
+
+def _is_import_block(node):
+    """
+    `try: import x except ImportError: ...` and similar blocks.
+    """
+    if isinstance(node, (ast.Import, ast.ImportFrom, ast.Pass)):
+        return True
+    if isinstance(node, ast.Try):
+        return all(_is_import_block(n) for n in
+                   node.body + node.orelse + node.finalbody
+                   + [n for h in node.handlers for n in h.body])
+    return False
+
+def _free_names(node):
+    return {n.id for n in ast.walk(node)
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)}
+
+def definitions_only(source):
+    """
+    Leave only imports and function definitions in the module source.
+
+    Default values of function parameters referring to names which are not
+    defined by these statements are replaced by `LazyDefault` (evaluated on
+    call). Functions with decorators referring to such names are dropped.
+
+    Returns (tree, info): the module AST, which keeps line numbers
+    of the source, and the dict with names of functions with lazy defaults
+    and number of skipped statements.
+    """
+    tree = ast.parse(source)
+    defined = set(dir(builtins)) | {
+        '__name__', '__file__', '__doc__', '__loader__', '__spec__',
+        'get_ipython', '__iimport__'}
+    body = []
+    for node in tree.body:
+        if (_is_import_block(node)
+                or isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))):
+            body.append(node)
+            for n in ast.walk(node) if isinstance(node, ast.Try) else [node]:
+                defined.update(_bound_names(n))
+
+    lazy_defaults = {}
+    skipped = len(tree.body) - len(body)
+    kept = []
+    for node in body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if any(_free_names(d) - defined for d in node.decorator_list):
+                skipped += 1
+                continue
+            lazy = []
+            args = node.args
+            params = args.posonlyargs + args.args
+            params = list(zip(params[len(params) - len(args.defaults):],
+                              range(len(args.defaults))))
+            for param, i in params:
+                if _free_names(args.defaults[i]) - defined:
+                    args.defaults[i] = _lazy_default_node(args.defaults[i])
+                    lazy.append(param.arg)
+            for i, param in enumerate(args.kwonlyargs):
+                default = args.kw_defaults[i]
+                if default is not None and _free_names(default) - defined:
+                    args.kw_defaults[i] = _lazy_default_node(default)
+                    lazy.append(param.arg)
+            if lazy:
+                node.decorator_list.append(ast.copy_location(
+                    _iimport_attr('resolve_lazy_defaults'), node))
+                lazy_defaults[node.name] = lazy
+        kept.append(node)
+
+    tree.body = kept
+    ast.fix_missing_locations(tree)
+    return tree, {'lazy_defaults': lazy_defaults, 'skipped': skipped}
+
+def _iimport_attr(name):
+    return ast.Attribute(value=ast.Name(id='__iimport__', ctx=ast.Load()),
+                         attr=name, ctx=ast.Load())
+
+def _lazy_default_node(node):
+    call = ast.Call(func=_iimport_attr('LazyDefault'),
+                    args=[ast.Constant(ast.unparse(node))], keywords=[])
+    return ast.copy_location(call, node)
+
+#
+# Selective import
+#
+
+class ModuleSlicer(object):
+    """
+    Executes only the top-level statements of the module needed to define
+    the names taken from it.
+
+    The slice of a name consists of the statements binding or modifying
+    it and, recursively, of the statements they depend on: for the names
+    read when a statement is executed -- the preceding statements binding
+    or modifying them, for the names read in function bodies -- all such
+    statements, as the functions are called later. Assignments to items
+    and attributes (`df['a'] = ...`) and expression statements
+    (`df.dropna(inplace=True)`, `fit(model, df)`) are considered
+    as modifying the names they refer to, except for imported modules.
+
+    Statements are executed in their original order, each one once.
+    If a slice needs a statement preceding already executed ones which
+    change the names it uses, the slice is executed in a separate
+    namespace and only the requested names are copied to the module.
+    Modules using `globals()`, `eval` or `exec` are executed completely.
+
+        slicer = ModuleSlicer(source, path)
+        slicer.define(mod.__dict__, ['calc_sums'])
+    """
+    dynamic_names = {'globals', 'locals', 'vars', 'eval', 'exec'}
+
+    def __init__(self, source, filename):
+        self.filename = filename
+        self.statements = ast.parse(source).body
+        self.futures = [stmt for stmt in self.statements
+                        if isinstance(stmt, ast.ImportFrom)
+                        and stmt.module == '__future__']
+        self.binds, self.reads, self.deferred = [], [], []
+        modifies = []
+        imported = set()
+        for stmt in self.statements:
+            binds, mods, reads, deferred = self.names(stmt)
+            if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+                imported |= binds
+            self.binds.append(binds)
+            modifies.append(mods)
+            self.reads.append(reads)
+            self.deferred.append(deferred)
+
+        # name -> indices of statements binding or modifying it
+        self.binders = {}
+        assigned = set().union(*self.binds) - imported
+        for i, binds in enumerate(self.binds):
+            binds |= modifies[i] & assigned
+            for name in binds:
+                self.binders.setdefault(name, []).append(i)
+        self.star_imports = self.binders.pop('*', [])
+        self.executed = set()
+        self._code = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def names(stmt):
+        """
+        Names bound, modified, read on execution and read in function
+        bodies by the top-level statement.
+        """
+        binds, modifies, reads, deferred = set(), set(), set(), set()
+
+        def base_name(node):
+            while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call)):
+                node = node.func if isinstance(node, ast.Call) else node.value
+            return node.id if isinstance(node, ast.Name) else None
+
+        def visit(node, in_function):
+            if isinstance(node, ast.Name):
+                if isinstance(node.ctx, ast.Load):
+                    (deferred if in_function else reads).add(node.id)
+                elif not in_function:
+                    binds.add(node.id)
+                return
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                 ast.Lambda)):
+                # Decorators, defaults and annotations are evaluated
+                # on definition, the body -- on call
+                if not isinstance(node, ast.Lambda):
+                    if not in_function:
+                        binds.add(node.name)
+                    for n in node.decorator_list + [node.returns]:
+                        if n is not None:
+                            visit(n, in_function)
+                visit(node.args, in_function)
+                body = (node.body if isinstance(node.body, list)
+                        else [node.body])
+                for n in body:
+                    visit(n, True)
+                return
+            if isinstance(node, ast.arguments):
+                for n in ast.iter_child_nodes(node):
+                    if isinstance(n, ast.arg):
+                        if n.annotation is not None:
+                            visit(n.annotation, in_function)
+                    else:
+                        visit(n, in_function)
+                return
+            if isinstance(node, ast.comprehension):
+                # Comprehension variables are local
+                for n in [node.iter] + node.ifs:
+                    visit(n, in_function)
+                return
+            if isinstance(node, ast.ClassDef) and not in_function:
+                binds.add(node.name)
+            elif isinstance(node, ast.alias) and not in_function:
+                binds.add((node.asname or node.name).split('.')[0])
+            elif isinstance(node, ast.Global):
+                # Functions assigning module variables
+                binds.update(node.names)
+            elif (isinstance(node, (ast.Attribute, ast.Subscript))
+                    and not isinstance(node.ctx, ast.Load) and not in_function):
+                modifies.add(base_name(node))
+            for n in ast.iter_child_nodes(node):
+                visit(n, in_function)
+
+        visit(stmt, False)
+        if isinstance(stmt, ast.Expr):
+            for node in ast.walk(stmt):
+                if isinstance(node, ast.Call):
+                    if isinstance(node.func, ast.Attribute):
+                        modifies.add(base_name(node.func.value))
+                    modifies.update(base_name(arg) for arg in node.args)
+        modifies.discard(None)
+        return binds, modifies, reads, deferred
+
+    def slice(self, names):
+        """
+        Indices of the statements needed to define the names, in order.
+        """
+        needed = set(self.star_imports)
+        stack = []
+
+        def require(name, before=None):
+            for i in self.binders.get(name, ()):
+                if before is not None and i >= before:
+                    break
+                if i not in needed:
+                    needed.add(i)
+                    stack.append(i)
+
+        for name in names:
+            require(name)
+        while stack:
+            i = stack.pop()
+            for name in self.reads[i]:
+                require(name, before=i)
+            for name in self.deferred[i]:
+                require(name)
+        return sorted(needed)
+
+    def code(self, i):
+        if i not in self._code:
+            body = [self.statements[i]]
+            if body[0] not in self.futures:
+                body = self.futures + body
+            self._code[i] = compile(ast.Module(body=body, type_ignores=[]),
+                                    self.filename, 'exec')
+        return self._code[i]
+
+    def _conflicts(self, todo):
+        """
+        Whether executing the statements after the already executed ones
+        gives different values.
+        """
+        last = max(self.executed, default=-1)
+        for i in todo:
+            if i > last:
+                break
+            used = self.reads[i] | self.binds[i]
+            if any(used & self.binds[k] for k in self.executed if k > i):
+                return True
+        return False
+
+    def define(self, ns, names):
+        """
+        Execute the statements needed to define the names in the module
+        namespace `ns`.
+        """
+        with self.lock:
+            needed = self.slice(names)
+            if any(self.reads[i] & self.dynamic_names
+                   or self.deferred[i] & self.dynamic_names for i in needed):
+                logger.info("Module %s uses dynamic name lookups, executing "
+                            "it completely" % ns.get('__name__'))
+                needed = range(len(self.statements))
+            todo = [i for i in needed if i not in self.executed]
+            separate = self._conflicts(todo)
+            if separate:
+                target = {k: v for k, v in ns.items()
+                          if k not in self.binders and k != '__getattr__'}
+                todo = needed
+            else:
+                target = ns
+
+            with executing_in(target):
+                for i in todo:
+                    exec(self.code(i), target)
+                    if not separate:
+                        self.executed.add(i)
+
+            if separate:
+                for name in names:
+                    if name in target:
+                        ns[name] = target[name]
+            elif len(self.executed) == len(self.statements):
+                ns.pop('__getattr__', None)
+
+    def getattr_hook(self, ns, defined=None):
+        """
+        Module `__getattr__` function (PEP 562) defining the requested
+        names on first access. `defined` is called with the name after
+        its definition.
+        """
+        def __getattr__(name):
+            if name in self.binders:
+                self.define(ns, [name])
+                if name in ns:
+                    if defined is not None:
+                        defined(name)
+                    return ns[name]
+            raise AttributeError("module %r has no attribute %r"
+                                 % (ns.get('__name__'), name))
+        return __getattr__
+
+#
+# Concurrent execution of procedures
+#
+
+class ProcedureScheduler(object):
+    """
+    Runs a procedure of the imported notebook executing its independent
+    inner procedure calls concurrently.
+
+    The body of the procedure is split into statements. Calls of other
+    procedures of the module (`results = inner(params)` lines, see
+    `Procedure.add_call`) are submitted to the pool as soon as their
+    arguments are computed; the rest of statements are executed in
+    the calling thread in their original order. A statement waits for
+    calls which assign or read any name it uses.
+
+    Procedures are supposed not to modify their arguments in place.
+    Inner procedures are called as usual functions, so only one level
+    of nesting is parallelized. With `backend='process'` results and
+    arguments must be picklable and the workers must be able to import
+    the notebook (which is the case for the `fork` start method).
+
+        scheduler = ProcedureScheduler(nb, workers=4)
+        objs = scheduler.run('load_objs', df)
+    """
+    backends = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+    }
+
+    def __init__(self, module, workers=None, backend='thread'):
+        if backend not in self.backends:
+            raise ValueError("Unknown backend: {backend}"
+                             .format(backend=backend))
+        self.module = module
+        self.workers = workers
+        self.backend = backend
+        self._source = None
+        self._functions = None
+        self._plans = {}
+
+    def function_def(self, name):
+        if self._source is not self.module._source:
+            # The module was (re)loaded since the last run
+            self._source = self.module._source
+            self._functions = None
+            self._plans.clear()
+        if self._functions is None:
+            tree = ast.parse(self.module._source)
+            self._functions = {
+                node.name: node for node in tree.body
+                if isinstance(node, ast.FunctionDef)}
+        return self._functions.get(name)
+
+    @staticmethod
+    def names(node):
+        """
+        Names read and assigned by the statement.
+        """
+        reads, writes = set(), set()
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name):
+                if isinstance(n.ctx, ast.Load):
+                    reads.add(n.id)
+                else:
+                    writes.add(n.id)
+            elif isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                ast.ClassDef)):
+                writes.add(n.name)
+            elif isinstance(n, ast.alias):
+                writes.add((n.asname or n.name).split('.')[0])
+        return reads, writes
+
+    def call_targets(self, stmt):
+        """
+        Names assigned by the inner procedure call statement,
+        None if the statement is not such a call.
+        """
+        if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                and isinstance(stmt.value, ast.Call)
+                and isinstance(stmt.value.func, ast.Name)
+                and stmt.value.func.id in self.module.__procedures__):
+            return None
+        target = stmt.targets[0]
+        elts = target.elts if isinstance(target, ast.Tuple) else [target]
+        if not all(isinstance(e, ast.Name) for e in elts):
+            return None
+        return [e.id for e in elts]
+
+    def plan(self, name):
+        """
+        Split the procedure body into steps. Returns the list of dicts:
+          'call' -- name of the called procedure, None for other statements
+          'targets' -- names the call results are assigned to
+          'depends' -- indices of the steps to wait for
+          'code', 'args' -- compiled statement or call arguments
+        and the compiled return value expression, or None if the procedure
+        cannot be scheduled (e.g. it returns from the middle of the body).
+        """
+        fn = self.function_def(name)
+        if name in self._plans:
+            return self._plans[name]
+        plan = None
+        if fn is not None:
+            plan = self._plan(fn)
+        self._plans[name] = plan
+        return plan
+
+    def _plan(self, fn):
+        body = list(fn.body)
+        if (body and isinstance(body[0], ast.Expr)
+                and isinstance(body[0].value, ast.Constant)):
+            body = body[1:]
+        if not body or not isinstance(body[-1], ast.Return):
+            return None
+        ret, body = body[-1], body[:-1]
+        for node in ast.walk(ast.Module(body=body, type_ignores=[])):
+            if isinstance(node, (ast.Return, ast.Yield, ast.YieldFrom,
+                                 ast.Await, ast.Global, ast.Nonlocal)):
+                return None
+
+        filename = self.module.__spec__.origin
+        steps = []
+        last_statement = None
+        for i, stmt in enumerate(body):
+            reads, writes = self.names(stmt)
+            targets = self.call_targets(stmt)
+            step = {'call': None, 'targets': targets, 'depends': set(),
+                    'reads': reads, 'writes': writes}
+            if targets is not None and not (
+                    any(isinstance(a, ast.Starred) for a in stmt.value.args)
+                    or any(k.arg is None for k in stmt.value.keywords)):
+                call = stmt.value
+                step['call'] = call.func.id
+                args = ast.copy_location(ast.Tuple(
+                    elts=[ast.Tuple(elts=call.args, ctx=ast.Load()),
+                          ast.Dict(keys=[ast.Constant(k.arg)
+                                         for k in call.keywords],
+                                   values=[k.value for k in call.keywords])],
+                    ctx=ast.Load()), call)
+                step['args'] = compile(
+                    ast.fix_missing_locations(ast.Expression(args)),
+                    filename, 'eval')
+            if step['call'] is None:
+                step['code'] = compile(
+                    ast.Module(body=[stmt], type_ignores=[]), filename, 'exec')
+                if last_statement is not None:
+                    step['depends'].add(last_statement)
+                last_statement = i
+            for j, other in enumerate(steps):
+                if step['call'] is None or other['call'] is None:
+                    # Statements may modify any object they refer to
+                    conflict = ((reads | writes)
+                                & (other['reads'] | other['writes']))
+                else:
+                    conflict = ((writes & (other['reads'] | other['writes']))
+                                or (reads & other['writes']))
+                if conflict:
+                    step['depends'].add(j)
+            steps.append(step)
+        ret_code = compile(ast.Expression(
+            ret.value if ret.value is not None else ast.Constant(None)),
+            filename, 'eval')
+        return steps, ret_code
+
+    def run(self, name, *args, **kwargs):
+        """
+        Call the procedure `name` of the module with the arguments.
+        """
+        fn = getattr(self.module, name)
+        plan = self.plan(name)
+        if plan is None:
+            logger.debug("Procedure %s cannot be scheduled, calling it"
+                         % name)
+            return fn(*args, **kwargs)
+        steps, ret_code = plan
+
+        bound = inspect.signature(fn).bind(*args, **kwargs)
+        bound.apply_defaults()
+        # Statements are executed as module-level code in a copy
+        # of the module namespace, so that comprehensions and nested
+        # functions see the local variables
+        ns = dict(self.module.__dict__)
+        ns.update(bound.arguments)
+
+        done = set()
+        running = {}
+        waiting = list(range(len(steps)))
+        with self.backends[self.backend](self.workers) as executor:
+            try:
+                while waiting or running:
+                    ready = [i for i in waiting if steps[i]['depends'] <= done]
+                    for i in ready:
+                        waiting.remove(i)
+                        step = steps[i]
+                        if step['call'] is None:
+                            exec(step['code'], ns)
+                            done.add(i)
+                        else:
+                            call_args, call_kwargs = eval(step['args'], ns)
+                            future = executor.submit(
+                                ns[step['call']], *call_args, **call_kwargs)
+                            running[future] = i
+                    if ready:
+                        continue
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        i = running.pop(future)
+                        self.assign(steps[i]['targets'], future.result(), ns)
+                        done.add(i)
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
+        return eval(ret_code, ns)
+
+    @staticmethod
+    def assign(targets, result, ns):
+        if len(targets) == 1:
+            ns[targets[0]] = result
+            return
+        result = tuple(result)
+        if len(result) != len(targets):
+            raise ValueError("Expected %i values to unpack, got %i"
+                             % (len(targets), len(result)))
+        ns.update(zip(targets, result))
+
+#
+# Parameter sweeps
+#
+
+def param_sets(param_grid):
+    """
+    Parameter sets of the grid: either a dict of lists of parameter values
+    (all combinations are taken), or an iterable of dicts (keyword
+    arguments), tuples (positional arguments) or single values (the first
+    argument). Yields (params, args, kwargs).
+    """
+    if isinstance(param_grid, dict):
+        keys = list(param_grid)
+        for values in itertools.product(*(param_grid[k] for k in keys)):
+            params = dict(zip(keys, values))
+            yield params, (), params
+        return
+    for params in param_grid:
+        if isinstance(params, dict):
+            yield params, (), params
+        elif isinstance(params, tuple):
+            yield params, params, {}
+        else:
+            yield params, (params,), {}
+
+def _init_procedure_worker(name, path, source):
+    """
+    Define the notebook module in the worker process from the source
+    compiled in the parent process. Procedures are defined on the first
+    call, executing only the code they depend on (see `ModuleSlicer`).
+    """
+    mod = sys.modules.get(name)
+    if mod is not None and mod.__dict__.get('_source') == source:
+        # Forked from the process which has imported the notebook
+        return
+    loader = NotebookLoader()
+    spec = importlib.util.spec_from_file_location(name, path, loader=loader)
+    mod = importlib.util.module_from_spec(spec)
+    mod.__dict__['get_ipython'] = get_ipython
+    mod.__dict__['__iimport__'] = sys.modules[__name__]
+    mod._source = source
+    register_source(path, source)
+    slicer = ModuleSlicer(source, path)
+    mod.__iimport_slicer__ = slicer
+    mod.__getattr__ = slicer.getattr_hook(mod.__dict__)
+    sys.modules[name] = mod
+
+def _call_procedure(name, proc, args, kwargs):
+    return getattr(sys.modules[name], proc)(*args, **kwargs)
+
+def _split_results(result, n):
+    """
+    Split the result of the vectorized call into n results,
+    None if it is not an array of n elements (or a tuple of such).
+    """
+    if isinstance(result, tuple):
+        parts = [_split_results(r, n) for r in result]
+        if any(p is None for p in parts):
+            return None
+        return list(zip(*parts))
+    if isinstance(result, np.ndarray) and result.shape == (n,):
+        return list(result)
+    return None
+
+def _same_result(a, b):
+    """
+    Whether the results are close and of the same shape and dtype
+    (elementwise for tuples).
+    """
+    if isinstance(a, tuple) or isinstance(b, tuple):
+        return (isinstance(a, tuple) and isinstance(b, tuple)
+                and len(a) == len(b)
+                and all(_same_result(x, y) for x, y in zip(a, b)))
+    a, b = np.asarray(a), np.asarray(b)
+    if a.shape != b.shape or a.dtype != b.dtype:
+        return False
+    try:
+        return bool(np.allclose(a, b, equal_nan=True))
+    except (TypeError, ValueError):
+        return bool(np.array_equal(a, b))
+
+def _map_vectorized(fn, sets):
+    """
+    Call the procedure once with arrays of numeric parameter values.
+    Returns the list of results, or None if the procedure cannot be
+    called so (it is checked that the results for the first and the last
+    parameter sets are the same as of the usual calls).
+    """
+    sig = inspect.signature(fn)
+    try:
+        bound = [sig.bind(*args, **kwargs) for _, args, kwargs in sets]
+    except TypeError:
+        return None
+    for b in bound:
+        b.apply_defaults()
+    call = bound[0].arguments.copy()
+    vectorized = False
+    for name in call:
+        values = [b.arguments[name] for b in bound]
+        if all(isinstance(v, numbers.Number) and not isinstance(v, bool)
+               for v in values):
+            call[name] = np.asarray(values)
+            vectorized = True
+        elif any(v is not values[0] for v in values):
+            return None
+    if not vectorized:
+        return None
+    call = inspect.BoundArguments(sig, call)
+    try:
+        results = _split_results(fn(*call.args, **call.kwargs), len(sets))
+    except Exception as exc:
+        logger.debug("Vectorized call of %s failed: %s" % (fn.__name__, exc))
+        return None
+    if results is None:
+        return None
+    for i in sorted({0, len(bound) - 1}):
+        result = fn(*bound[i].args, **bound[i].kwargs)
+        if not _same_result(results[i], result):
+            return None
+        results[i] = result
+    return results
+
+def map_procedure(fn, param_grid, workers=None, backend='process',
+                  ordered=False, vectorize=False, return_exceptions=False,
+                  mp_context=None):
+    """
+    Call the procedure of the imported notebook with every parameter set
+    of the grid (see `param_sets`) in a pool of workers. Returns an iterator
+    of (params, result) pairs yielded as the calls complete (in the order
+    of the grid if `ordered`). Procedures are available as their `map`
+    method too:
+
+        for params, sums in nb.calc_sums.map({'f1_path': paths}, workers=8):
+            ...
+
+    Process workers get the module source compiled by the parent process
+    and execute only the code the procedure depends on; workers forked
+    from the parent use the module as it is. Arguments and results must
+    be picklable.
+
+    If a call fails, the rest of calls are cancelled and the exception is
+    raised, or, with `return_exceptions`, yielded as the result.
+
+    With `vectorize` the procedure is first called once with NumPy arrays
+    of numeric parameter values; if it works element-wise (returns arrays
+    of results), the results are yielded without running the pool.
+    """
+    if backend not in ProcedureScheduler.backends:
+        raise ValueError("Unknown backend: {backend}".format(backend=backend))
+    # The module of the procedure may be not in `sys.modules`
+    # (see `import_in_mode`), or another module may be there by its name
+    module_globals = getattr(fn, '__globals__', {})
+    source = module_globals.get('_source')
+    if backend == 'process' and not isinstance(source, str):
+        raise ValueError("%s is not a procedure of an imported notebook"
+                         % fn.__name__)
+    module_state = (module_globals.get('__name__'),
+                    module_globals.get('__file__'), source)
+    sets = list(param_sets(param_grid))
+    return _map_procedure(fn, module_state, sets, workers, backend, ordered,
+                          vectorize, return_exceptions, mp_context)
+
+def _map_procedure(fn, module_state, sets, workers, backend, ordered,
+                   vectorize, return_exceptions, mp_context):
+    if vectorize and sets:
+        results = _map_vectorized(fn, sets)
+        if results is not None:
+            yield from zip([params for params, _, _ in sets], results)
+            return
+        logger.debug("Procedure %s cannot be vectorized, calling it for "
+                     "every parameter set" % fn.__name__)
+
+    if backend == 'process':
+        executor = ProcessPoolExecutor(
+            workers, mp_context=mp_context,
+            initializer=_init_procedure_worker,
+            initargs=module_state)
+        def submit(args, kwargs):
+            return executor.submit(_call_procedure, module_state[0],
+                                   fn.__name__, args, kwargs)
+    else:
+        executor = ThreadPoolExecutor(workers)
+        def submit(args, kwargs):
+            return executor.submit(fn, *args, **kwargs)
+
+    try:
+        futures = OrderedDict((submit(args, kwargs), params)
+                              for params, args, kwargs in sets)
+        for future in (futures if ordered else as_completed(futures)):
+            try:
+                result = future.result()
+            except Exception as exc:
+                if not return_exceptions:
+                    raise
+                result = exc
+            yield futures[future], result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _attach_map(ns, names):
+    """
+    Add `map` method (see `map_procedure`) to the procedures.
+    """
+    for name in names:
+        fn = ns.get(name)
+        if isinstance(fn, types.FunctionType) and not hasattr(fn, 'map'):
+            fn.map = functools.partial(map_procedure, fn)
+
+#
+# Reloading of changed procedures
+#
+
+def notebook_stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+def function_digests(source):
+    """
+    Split module source into top-level functions and the rest of the code.
+
+    Returns ({function name: (digest, node)}, digest of the rest).
+    Digests do not depend on line numbers and comments, so functions
+    are not considered changed when the code above them is.
+    """
+    functions = {}
+    rest = md5()
+    for node in ast.parse(source).body:
+        dump = ast.dump(node).encode('utf-8')
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            functions[node.name] = (md5(dump).hexdigest(), node)
+        else:
+            rest.update(dump)
+    return functions, rest.hexdigest()
+
+def _replace_function(old, new):
+    """
+    Update the function object in place, so references to it kept
+    outside the module (`from nb import f`) call the new code too.
+    """
+    if not (isinstance(old, types.FunctionType)
+            and isinstance(new, types.FunctionType)
+            and old.__closure__ is None and new.__closure__ is None):
+        return False
+    for attr in ('__code__', '__defaults__', '__kwdefaults__', '__doc__',
+                 '__annotations__'):
+        setattr(old, attr, getattr(new, attr))
+    return True
+
+def reload_procedures(mod, force=False):
+    """
+    Rebind functions of the imported notebook which were changed in
+    the notebook since the import, without executing the rest of its code.
+
+    The notebook is parsed again only if its mtime or size has changed
+    (or `force` is set). Functions are compared by the digests of their
+    code; changed and added ones are defined in the existing module
+    namespace, so module-level state is kept. Removed functions are kept
+    too. Changes of the top-level code are not executed, a warning
+    is logged instead.
+
+    Returns dict with lists of 'changed', 'added' and 'removed' function
+    names, or None if the notebook file is not modified.
+    """
+    path = mod.__spec__.origin
+    stamp = notebook_stamp(path)
+    if not force and stamp == getattr(mod, '__iimport_stamp__', None):
+        return None
+
+    loader = NotebookLoader(os.path.dirname(path))
+    new_source, _, info = loader.compile_ipynb(path)
+    old_functions, old_rest = function_digests(mod._source)
+    new_functions, new_rest = function_digests(new_source)
+
+    result = {'changed': [], 'added': [], 'removed': []}
+    for name, (digest, node) in new_functions.items():
+        if name not in old_functions:
+            kind = 'added'
+        elif digest != old_functions[name][0]:
+            kind = 'changed'
+        else:
+            continue
+        code = compile(ast.Module(body=[node], type_ignores=[]), path, 'exec')
+        old = mod.__dict__.get(name)
+        try:
+            exec(code, mod.__dict__)
+        except Exception as exc:
+            logger.error("Cannot reload function %s of %s: %s"
+                         % (name, mod.__name__, exc))
+            if old is not None:
+                mod.__dict__[name] = old
+            continue
+        if old is not None and _replace_function(old, mod.__dict__[name]):
+            mod.__dict__[name] = old
+        result[kind].append(name)
+    result['removed'] = [name for name in old_functions
+                         if name not in new_functions]
+    procedures = info.get('graph', {})
+    _attach_map(mod.__dict__, [name for name in
+                               result['changed'] + result['added']
+                               if name in procedures])
+
+    if new_rest != old_rest:
+        logger.warning("Top-level code of %s has changed, it is not "
+                       "executed on procedures reload; use "
+                       "importlib.reload(%s) to run it" % (path, mod.__name__))
+    mod._source = new_source
+    register_source(path, new_source)
+    mod.__procedures__ = procedures
+    mod.__iimport_stamp__ = stamp
+    logger.info("Reloaded procedures of %s: %s" % (mod.__name__, result))
+    return result
+
+def notebook_modules():
+    """
+    Imported notebook modules (except lazy ones not loaded yet).
+    """
+    return [mod for mod in list(sys.modules.values())
+            if type(mod) is types.ModuleType
+            and isinstance(getattr(mod.__spec__, 'loader', None),
+                           NotebookLoader)
+            and '_source' in mod.__dict__]
+
+def reload_all_procedures():
+    """
+    Reload changed procedures of all imported notebooks.
+    """
+    results = {}
+    for mod in notebook_modules():
+        try:
+            result = reload_procedures(mod)
+        except Exception as exc:
+            logger.error("Cannot reload procedures of %s: %s"
+                         % (mod.__name__, exc))
+            continue
+        if result is not None:
+            results[mod.__name__] = result
+    return results
+
+#
+# Source maps
+#
+
+class SourceMap(object):
+    """
+    Map of module source lines to notebook cells and their lines.
+
+    Holds runs of consecutive lines, so lookups cost one binary search.
+    Cells and lines are numbered from 1, all cells (including markdown
+    ones) are counted.
+    """
+
+    def __init__(self, runs):
+        # [(first module line, cell or None, first cell line)]
+        self.runs = runs
+        self.starts = [run[0] for run in runs]
+
+    def lookup(self, lineno):
+        """
+        (cell, line) of the module source line, or None if the line
+        does not come from the notebook.
+        """
+        i = bisect_right(self.starts, lineno) - 1
+        if i < 0:
+            return None
+        start, cell, line = self.runs[i]
+        if cell is None:
+            return None
+        return cell, line + lineno - start
+
+    @staticmethod
+    def from_origins(origins):
+        runs = []
+        prev = None
+        for lineno, origin in enumerate(origins, 1):
+            if origin is None:
+                if prev is not None or not runs:
+                    runs.append((lineno, None, None))
+            elif prev is None or origin != (prev[0], prev[1] + 1):
+                runs.append((lineno, origin[0], origin[1]))
+            prev = origin
+        return SourceMap(runs)
+
+    @staticmethod
+    def build(nb, source):
+        """
+        Parse the notebook again recording positions of the lines
+        and align them with the module `source`. Returns None if
+        the source does not correspond to the notebook.
+        """
+        parser = MarkupParser(source_map=True)
+        cells_lines_out = []
+        items, origins = [], []
+        for cell in nb.cells:
+            lines_out = parser.feed(NotebookLoader.cell_text(cell))
+            cells_lines_out.append(lines_out)
+            if len(lines_out) > 0:
+                items += lines_out + ['\n']
+                origins += parser.origins_out + [[None, None]]
+
+        # The same filtering as in `NotebookLoader.join_cells`
+        magic_matcher = re.compile('^%.*')
+        lines = []
+        line_origins = []
+        for item, item_origins in zip(items, origins):
+            if magic_matcher.match(item) is None:
+                lines += item.split('\n')
+                line_origins += item_origins
+        text = NotebookLoader.join_cells(cells_lines_out)
+        if text.count('\n') + 1 > len(lines):
+            return None
+
+        # Repeating empty lines were cut from the text: skip them
+        aligned = []
+        i = 0
+        for line in text.split('\n'):
+            while i < len(lines) and lines[i] != line:
+                i += 1
+            if i == len(lines):
+                return None
+            aligned.append(line_origins[i])
+            i += 1
+
+        # IPython transformations keep the number of lines,
+        # except leading empty lines which are removed
+        skip = (text.rstrip('\n').count('\n')
+                - source.rstrip('\n').count('\n'))
+        if skip < 0 or text[:skip].strip('\n'):
+            return None
+        return SourceMap.from_origins(aligned[skip:])
+
+class SourceLines(list):
+    """
+    List of the source lines for `linecache`, split on the first access.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            self.extend(self.source.splitlines(True))
+
+    def __len__(self):
+        self.load()
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        self.load()
+        return list.__getitem__(self, index)
+
+    def __iter__(self):
+        self.load()
+        return list.__iter__(self)
+
+def register_source(path, source):
+    """
+    Make the generated module source visible to tracebacks, `inspect`
+    and debuggers instead of the notebook JSON.
+    """
+    linecache.cache[path] = (len(source), None, SourceLines(source), path)
+
+# {notebook path: (module source, SourceMap or None)}
+_source_maps = {}
+
+def source_location(path, lineno):
+    """
+    (cell, line) in the notebook corresponding to the line of the imported
+    module source, or None if it cannot be found (e.g. the notebook
+    has been modified since the import).
+    """
+    mods = [mod for mod in notebook_modules()
+            if mod.__spec__.origin == path]
+    if not mods:
+        return None
+    mod = mods[0]
+    entry = _source_maps.get(path)
+    if entry is None or entry[0] is not mod._source:
+        source_map = None
+        try:
+            if notebook_stamp(path) == getattr(mod, '__iimport_stamp__',
+                                               None):
+                source_map = SourceMap.build(read_ipynb(path), mod._source)
+        except Exception as exc:
+            logger.debug("Cannot build source map of %s: %s" % (path, exc))
+        entry = _source_maps[path] = (mod._source, source_map)
+    if entry[1] is None:
+        return None
+    return entry[1].lookup(lineno)
+
+def format_location(path, lineno):
+    """
+    'notebook.ipynb:cell 12:line 4' or 'notebook.ipynb:57' if the line
+    cannot be mapped to the cell.
+    """
+    location = source_location(path, lineno)
+    if location is None:
+        return '%s:%i' % (path, lineno)
+    return '%s:cell %i:line %i' % ((path,) + location)
+
+def numbered_source(source, lineno=None, context=5):
+    """
+    Source with line numbers, only `context` lines around `lineno` if given.
+    """
+    lines = source.split('\n')
+    first, last = 1, len(lines)
+    if lineno is not None:
+        first = max(lineno - context, 1)
+        last = min(lineno + context, len(lines))
+    return '\n'.join('%s%4i %s' % ('>' if n == lineno else ' ', n,
+                                    lines[n - 1])
+                     for n in range(first, last + 1))
+
+#
+# Import statistics
+#
+
+# Statistics of notebook imports in this session, {module name: stats}
+import_stats = OrderedDict()
+# Functions called with statistics of every notebook import
+import_stats_hooks = []
+
+class ImportStats(object):
+    """
+    Collects wall time (and, if `import_opts['trace_memory']` is set,
+    memory allocated by `tracemalloc`) of the notebook import stages:
+    cache lookup, reading, markup parsing, IPython transformations,
+    compilation and execution.
+
+    Used as context manager around the whole import: on exit statistics
+    are saved to `import_stats` and passed to `import_stats_hooks`.
+    """
+
+    def __init__(self, name, path, trace_memory=None):
+        if trace_memory is None:
+            trace_memory = import_opts.get('trace_memory', False)
+        self.trace_memory = trace_memory
+        self.data = {
+            'name': name,
+            'path': path,
+            'stages': OrderedDict(),
+        }
+        self._started_tracing = False
+
+    def update(self, info, **kwargs):
+        self.data.update(info, **kwargs)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            mem_start = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = {'time': time.perf_counter() - start}
+            if tracing:
+                stage['memory'] = tracemalloc.get_traced_memory()[1] - mem_start
+            self.data['stages'][name] = stage
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.data['time'] = time.perf_counter() - self._start
+        if self._started_tracing:
+            tracemalloc.stop()
+        import_stats[self.data['name']] = self.data
+        for hook in import_stats_hooks:
+            try:
+                hook(self.data)
+            except Exception:
+                logger.exception("Import statistics hook failed")
+
+def format_import_stats(stats=None):
+    """
+    Format statistics of notebook imports as a table,
+    slowest imports first.
+    """
+    if stats is None:
+        stats = import_stats.values()
+    stages = ['cache', 'read', 'parse', 'transform', 'compile', 'exec']
+    header = ('%-24s %9s' % ('notebook', 'total')
+              + ''.join(' %9s' % s for s in stages)
+              + ' %7s %6s %6s' % ('lines', 'procs', 'cached'))
+    rows = [header]
+    for data in sorted(stats, key=lambda d: -d.get('time', 0)):
+        row = '%-24s %8.3fs' % (data['name'], data.get('time', 0))
+        for stage in stages:
+            if stage in data['stages']:
+                row += ' %8.3fs' % data['stages'][stage]['time']
+            else:
+                row += ' %9s' % '-'
+        row += ' %7s %6s %6s' % (data.get('lines', '-'),
+                                 data.get('procedures', '-'),
+                                 data.get('cached', '-'))
+        rows.append(row)
+        memory = ['%s %.1f MiB' % (stage, s['memory'] / 2**20)
+                  for stage, s in data['stages'].items() if 'memory' in s]
+        if memory:
+            rows.append('%-24s memory: %s' % ('', ', '.join(memory)))
+    return '\n'.join(rows)
+
+
+class NotebookLoader(object):
+
+    def __init__(self, path=None):
+        self.shell = InteractiveShell.instance()
+        self.path = path
+
+    @staticmethod
+    def process_ipynb(nb, parser=None):
+        """
+        Pass the notebook through procedure collection filter and return parsed text.
+
+        parser:
+          'markup' -- single-pass `MarkupParser` (default)
+          'chain' -- line by line coroutines chain
+          or an instance of `MarkupParser` to collect information
+          about procedures
+        """
+        if parser is None:
+            parser = import_opts.get('parser', 'markup')
+        if isinstance(parser, MarkupParser):
+            feed = parser.feed
+        elif parser == 'markup':
+            feed = MarkupParser().feed
+        elif parser == 'chain':
+            chain = fetch_tag(collect_proc(output_filter(is_module=True)))
+            def feed(text):
+                return [l for l in (chain.send(l) for l in text.split('\n'))
+                        if l is not None]
+        else:
+            raise ValueError("Unknown parser: {parser}".format(parser=parser))
+
+        return NotebookLoader.join_cells(
+            feed(NotebookLoader.cell_text(cell)) for cell in nb.cells)
+
+    @staticmethod
+    def cell_text(cell):
+        if cell.cell_type != 'code':
+            return '#### ' + cell.source.replace('\n', '\n#### ')
+        return cell.source
+
+    @staticmethod
+    def join_cells(cells_lines_out):
+        """
+        Make module text from output lines of the cells.
+        """
+        lines_out = []
+        for cell_lines_out in cells_lines_out:
+            if len(cell_lines_out) > 0:
+                lines_out += cell_lines_out
+                lines_out.append('\n')
+
+        # Cut all ipython magic
+        magic_matcher = re.compile('^%.*')
+        lines_out = [l for l in lines_out if magic_matcher.match(l) is None]
+
+        text = '\n'.join(lines_out)
+
+        # Cut newlines repeating more than 3 times
+        text = re.compile('\n\n\n\n*').sub('\n\n\n', text)
+
+        return text
+
+    @staticmethod
+    def convert_ipynb(path):
+        nb = read_ipynb(path)
+        text = NotebookLoader.process_ipynb(nb)
+
+        path_py = path.rsplit('.', 1)[0] + '.py'
+        return write_if_changed(path_py, text)
+
+    def transformer_manager(self):
+        """
+        Copy of the shell input transformer manager without `CellTransformer`,
+        which holds the markup state of the interactive session and must not
+        see the notebooks being imported. The copy is made on every call,
+        so that notebooks prefetched in other threads do not share it.
+        """
+        manager = self.shell.input_transformer_manager
+        if not hasattr(manager, 'cleanup_transforms'):
+            return manager
+        manager = copy.copy(manager)
+        manager.cleanup_transforms = [
+            transform for transform in manager.cleanup_transforms
+            if not isinstance(transform, CellTransformer)]
+        manager.line_transforms = list(manager.line_transforms)
+        return manager
+
+    def transformer_names(self):
+        """
+        Names of the input transformations applied by `transform_source`
+        (they are a part of the compiled notebooks cache key).
+        """
+        manager = self.transformer_manager()
+        transforms = []
+        for attr in ('cleanup_transforms', 'line_transforms',
+                     'token_transformers'):
+            transforms += getattr(manager, attr, [])
+        return tuple(
+            '%s.%s' % (getattr(t, '__module__', None) or type(t).__module__,
+                       getattr(t, '__qualname__', None)
+                       or type(t).__qualname__)
+            for t in transforms)
+
+    def transform_source(self, text):
+        """
+        Apply IPython input transformations to the module text.
+
+        Token transformations require tokenizing the whole module, so they
+        are skipped if there are no lines which may contain IPython syntax.
+        """
+        manager = self.transformer_manager()
+        if (_ipython_syntax_re.search(text)
+                or not hasattr(manager, 'cleanup_transforms')):
+            return manager.transform_cell(text)
+        if not text.endswith('\n'):
+            text += '\n'
+        lines = text.splitlines(keepends=True)
+        for transform in manager.cleanup_transforms + manager.line_transforms:
+            lines = transform(lines)
+        return ''.join(lines)
+
+    def compile_ipynb(self, path, stats=None, mode=None, prefetched=True):
+        """
+        Turn the notebook into transformed module source and its code object,
+        using the compiled notebooks cache if possible.
+
+        Returns (source, code, info), where info holds statistics
+        of the notebook processing (number of cells, lines and procedures;
+        in definitions mode also lazy defaults and skipped statements).
+        `mode` defaults to `import_opts['mode']`. Unless `prefetched` is
+        False, the result of `NotebookPrefetcher` is used if there is one.
+        """
+        if stats is None:
+            stats = ImportStats(None, path)
+        if mode is None:
+            mode = import_opts.get('mode', 'module')
+        if mode not in ('module', 'definitions', 'slice'):
+            raise ValueError("Unknown import mode: {mode}".format(mode=mode))
+        if prefetched:
+            result = _prefetcher.take(path, mode, stats)
+            if result is not None:
+                return result
+        parser = import_opts.get('parser', 'markup')
+        cache = _get_cache()
+        if cache is not None:
+            with stats.stage('cache'):
+                # The whole module is compiled for slicing too
+                key = cache.notebook_key(
+                    path, 'module' if mode == 'slice' else mode,
+                    parser if isinstance(parser, str)
+                    else type(parser).__name__,
+                    self.transformer_names())
+                cached = cache.load(path, key)
+            if cached is not None:
+                stats.update(cached[2], cached=True)
+                return cached
+
+        with stats.stage('read'):
+            nb = read_ipynb(path)
+        if parser == 'markup':
+            parser = MarkupParser()
+        with stats.stage('parse'):
+            text = self.process_ipynb(nb, parser=parser)
+        with stats.stage('transform'):
+            source = self.transform_source(text)
+        info = {
+            'cells': len(nb.cells),
+            'lines': source.count('\n'),
+        }
+        with stats.stage('compile'):
+            if mode == 'definitions':
+                tree, defs_info = definitions_only(source)
+                info.update(defs_info)
+                code = compile(tree, path, 'exec')
+            else:
+                code = compile(source, path, 'exec')
+        if isinstance(parser, MarkupParser):
+            info['procedures'] = len(parser.procedures)
+            info['graph'] = dict(parser.graph)
+        stats.update(info, cached=False)
+
+        if cache is not None and not sys.dont_write_bytecode:
+            cache.store(path, key, source, code, info)
+        return source, code, info
+
+    def create_module(self, spec):
+        # Default module creation
+        return None
+
+    def exec_module(self, mod):
+        path = mod.__spec__.origin
+
+        logger.info("Importing notebook %s" % path)
+        mod.__dict__['get_ipython'] = get_ipython
+        mod.__dict__['__iimport__'] = sys.modules[__name__]
+
+        # Mode of this import only (see `import_in_mode`)
+        mode = (mod.__spec__.loader_state or {}).get('mode')
+        if mode is None:
+            mode = import_opts.get('mode', 'module')
+
+        stats = ImportStats(mod.__name__, path)
+        mod.__iimport_stats__ = stats.data
+        mod.__iimport_stamp__ = notebook_stamp(path)
+        try:
+            with stats, executing_in(mod.__dict__):
+                mod._source, code, info = self.compile_ipynb(path, stats,
+                                                             mode)
+                if import_opts.get('prefetch'):
+                    _prefetcher.prefetch(mod._source)
+                mod.__procedures__ = info.get('graph', {})
+                register_source(path, mod._source)
+                if info.get('lazy_defaults'):
+                    logger.info("Notebook %s: defaults of these parameters "
+                                "are evaluated on call: %s"
+                                % (path, info['lazy_defaults']))
+                if mode == 'slice':
+                    slicer = ModuleSlicer(mod._source, path)
+                    mod.__iimport_slicer__ = slicer
+                    def defined(name):
+                        if name in mod.__procedures__:
+                            _attach_map(mod.__dict__, [name])
+                    mod.__getattr__ = slicer.getattr_hook(mod.__dict__,
+                                                          defined)
+                else:
+                    with stats.stage('exec'):
+                        exec(code, mod.__dict__)
+                    _attach_map(mod.__dict__, mod.__procedures__)
+        except Exception:
+            exc_type, exc, tb = sys.exc_info()
+            lineno = None
+            while tb is not None:
+                if tb.tb_frame.f_code.co_filename == path:
+                    lineno = tb.tb_lineno
+                tb = tb.tb_next
+            if lineno is None:
+                logger.error("Exception during module code execution: %s"
+                             % exc)
+            else:
+                logger.error("Exception during module code execution: %s, %s"
+                             % (format_location(path, lineno), exc))
+                # Not set if the notebook could not be compiled
+                if '_source' in mod.__dict__:
+                    logger.error("Executing module source:\n%s"
+                                 % numbered_source(mod._source, lineno))
+            if import_opts.get('errors', 'raise') == 'log':
+                return mod
+            # Lazy modules are executed outside of the import machinery,
+            # which would remove the half-initialized module otherwise
+            if sys.modules.get(mod.__name__) is mod:
+                del sys.modules[mod.__name__]
+            raise
+        return mod
+
+    def load_module(self, fullname):
+        """
+        Legacy (PEP 302) loader interface.
+        """
+        with module_lock(fullname):
+            if fullname in sys.modules:
+                return sys.modules[fullname]
+            path = find_notebook(fullname, self.path)
+            spec = importlib.util.spec_from_file_location(
+                fullname, path, loader=self)
+            mod = importlib.util.module_from_spec(spec)
+            sys.modules[fullname] = mod
+            try:
+                return self.exec_module(mod)
+            except BaseException:
+                sys.modules.pop(fullname, None)
+                raise
+
+
+class _LazyNotebookModule(types.ModuleType):
+    """
+    Module of the lazily imported notebook, executed on the first access
+    to its attributes. Other threads accessing it meanwhile wait until
+    the execution is finished (`importlib.util.LazyLoader` module lets
+    them see the half-initialized module before Python 3.12).
+    """
+
+    def __getattribute__(self, attr):
+        ns = object.__getattribute__(self, '__dict__')
+        with module_lock(ns['__name__']):
+            # Attributes accessed by the loader itself are taken as is
+            if (type(self) is _LazyNotebookModule
+                    and not ns.get('__iimport_loading__')):
+                ns['__iimport_loading__'] = True
+                try:
+                    ns['__spec__'].loader.exec_module(self)
+                    self.__class__ = types.ModuleType
+                finally:
+                    ns.pop('__iimport_loading__', None)
+        return object.__getattribute__(self, attr)
+
+class LazyNotebookLoader(importlib.util.LazyLoader):
+    """
+    Loader deferring the notebook execution until the first attribute
+    access, thread-safe (see `_LazyNotebookModule`).
+    """
+
+    def exec_module(self, module):
+        module.__spec__.loader = self.loader
+        module.__loader__ = self.loader
+        module.__class__ = _LazyNotebookModule
+
+def lazy_import(fullname):
+    """
+    Import the notebook lazily: the module object is returned at once,
+    and the notebook is read, parsed and executed on the first access
+    to any of its attributes.
+    """
+    # Imported by the import machinery, so a concurrent `import` of the
+    # notebook waits for it and gets the same module
+    names = _lazy_requests.__dict__.setdefault('names', set())
+    names.add(fullname)
+    try:
+        return importlib.import_module(fullname)
+    finally:
+        names.discard(fullname)
+
+def import_in_mode(fullname, mode):
+    """
+    Import the notebook in the given mode (see `import_opts`) regardless
+    of `import_opts['mode']`.
+
+    Unless the mode is the global one, the module is executed anew and is
+    not put into `sys.modules`: it lacks the code the usual import would
+    execute, so other imports of the notebook should not get it.
+    """
+    if mode == import_opts.get('mode', 'module'):
+        return importlib.import_module(fullname)
+    spec = importlib.util.find_spec(fullname)
+    loader = getattr(spec, 'loader', None)
+    if isinstance(loader, LazyNotebookLoader):
+        loader = loader.loader
+    if not isinstance(loader, NotebookLoader):
+        raise ImportError("No notebook named %r" % fullname, name=fullname)
+    # The spec of the imported module is returned if there is one
+    spec = importlib.util.spec_from_file_location(fullname, spec.origin,
+                                                  loader=loader)
+    spec.loader_state = {'mode': mode}
+    mod = importlib.util.module_from_spec(spec)
+    loader.exec_module(mod)
+    return mod
+
+def import_notebooks(names, workers=None):
+    """
+    Import the notebooks concurrently on a thread pool, e.g. to warm up
+    a service on startup. Returns {name: module}; if some imports fail,
+    the first error (in the order of `names`) is raised after all the
+    imports are finished.
+    """
+    # The shell keeps sqlite connections usable only in the thread
+    # which has created it
+    InteractiveShell.instance()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(name, executor.submit(importlib.import_module, name))
+                   for name in names]
+    return OrderedDict((name, future.result()) for name, future in futures)
+
+
+#
+# Prefetching imported notebooks
+#
+
+class NotebookPrefetcher(object):
+    """
+    Reads and compiles notebooks imported by the notebook being imported
+    (with `import` statements or `%iimport`) on background threads, while
+    the importing notebook is being executed. Notebooks imported by them
+    are prefetched too, so the whole tree is read and parsed concurrently.
+
+    Notebooks are still executed by the imports themselves, in their
+    usual order: `compile_ipynb` takes the prefetched result (waiting for
+    it if needed) instead of compiling the notebook again. Results of
+    notebooks modified since the prefetch are discarded, as well as the
+    results not taken within `expire` seconds or beyond `max_pending`
+    oldest ones (a notebook may be found by name but never imported).
+    """
+    expire = 300
+    max_pending = 64
+
+    # Lines are matched instead of parsing the source: it is several times
+    # faster, and a false match only costs reading a notebook in advance
+    import_re = re.compile(
+        r'^[ \t]*(?:import[ \t]+([\w., \t]+)'
+        r'|from[ \t]+(\w+)[ \t]+import\b'
+        r'|.*run_line_magic\([\'"]iimport[\'"], *[\'"]([^\'"]*))', re.M)
+
+    def __init__(self):
+        self.executor = None
+        # {(notebook path, mode): (stamp, submission time, future)},
+        # future is None while it is being submitted
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def imported_names(cls, source):
+        """
+        Names of top-level modules imported by the module source
+        with `import` statements or `%iimport` magic.
+        """
+        names = []
+        for imports, from_import, magic in cls.import_re.findall(source):
+            if imports:
+                names += [name.split()[0] for name in imports.split(',')
+                          if name.strip()]
+            elif from_import:
+                names.append(from_import)
+            else:
+                args = [arg for arg in magic.split()
+                        if not arg.startswith('--')]
+                if args:
+                    names.append(args[0])
+        return [name for name in dict.fromkeys(names)
+                if name.isidentifier()]
+
+    def prefetch(self, source, mode=None):
+        """
+        Start prefetching notebooks imported by the module source.
+        """
+        if mode is None:
+            mode = import_opts.get('mode', 'module')
+        self._submit(self._scan, source, mode)
+
+    def _submit(self, fn, *args):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=import_opts.get('prefetch') or 1,
+                    thread_name_prefix='iimport-prefetch')
+            return self.executor.submit(fn, *args)
+
+    def _scan(self, source, mode):
+        for name in self.imported_names(source):
+            if name in sys.modules:
+                continue
+            nb_path = find_notebook(name)
+            if nb_path is None:
+                continue
+            nb_path = os.path.abspath(nb_path)
+            key = self._key(nb_path, mode)
+            try:
+                stamp = notebook_stamp(nb_path)
+            except OSError:
+                continue
+            with self.lock:
+                if key in self.futures:
+                    continue
+                self._expire()
+                self.futures[key] = (stamp, time.monotonic(), None)
+            future = self._submit(self._compile, nb_path, mode)
+            with self.lock:
+                entry = self.futures.get(key)
+                # Taken or expired while being submitted
+                if entry is None or entry[2] is not None:
+                    future.cancel()
+                    continue
+                self.futures[key] = entry[:2] + (future,)
+
+    def _expire(self):
+        """
+        Drop expired results and the oldest ones over `max_pending`, leaving
+        room for one more (called with the lock held).
+        """
+        now = time.monotonic()
+        entries = sorted(self.futures.items(), key=lambda item: item[1][1])
+        excess = len(entries) - self.max_pending + 1
+        for i, (key, (stamp, submitted, future)) in enumerate(entries):
+            if i >= excess and now - submitted < self.expire:
+                break
+            del self.futures[key]
+            if future is not None:
+                future.cancel()
+
+    @staticmethod
+    def _key(path, mode):
+        # The whole module is compiled for slicing too
+        return os.path.abspath(path), 'module' if mode == 'slice' else mode
+
+    def _compile(self, path, mode):
+        stats = ImportStats(None, path, trace_memory=False)
+        result = NotebookLoader().compile_ipynb(path, stats, mode,
+                                                prefetched=False)
+        self._scan(result[0], mode)
+        return result, stats.data
+
+    def take(self, path, mode, stats=None):
+        """
+        (source, code, info) of the prefetched notebook,
+        or None if it has not been prefetched.
+        """
+        if not self.futures:
+            return None
+        with self.lock:
+            entry = self.futures.pop(self._key(path, mode), None)
+            self._expire()
+        if entry is None or entry[2] is None:
+            return None
+        stamp, _, future = entry
+        if future.cancel():
+            # Not started yet, it is faster to compile it now
+            return None
+        try:
+            result, data = future.result()
+            if notebook_stamp(path) != stamp:
+                return None
+        except Exception:
+            # Compile it again to report the error
+            return None
+        if stats is not None:
+            stats.data['stages'].update(data['stages'])
+            stats.update(result[2], cached=data.get('cached'),
+                         prefetched=True)
+        return result
+
+    def clear(self):
+        with self.lock:
+            futures, self.futures = self.futures, {}
+            executor, self.executor = self.executor, None
+        for entry in futures.values():
+            if entry[2] is not None:
+                entry[2].cancel()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+_prefetcher = NotebookPrefetcher()
+
+
+# Registering ipynb import mechanism
+sys.meta_path.append(NotebookFinder())
+
+#
+# Extension activation function
+#
+
+class CellTransformer(object):
+    """
+    IPython cell transformer processing the markup of executed cells.
+
+    When enabled, procedures are declared as functions in the notebook
+    (see `MarkupParser` in interactive mode), otherwise markup tags are
+    stripped and the rest of the code is executed as is. Cells without `%`
+    are passed through untouched unless a procedure is being collected.
+
+    Time spent on every cell is accumulated in `cells`, `skipped`, `time`
+    and `max_time` (shown by `%iimport_stats`).
+    """
+    # Do not run on completeness checks of terminal input:
+    # the parser state should change only when the cell is executed
+    has_side_effects = True
+
+    tag_re = re.compile(_tag_re)
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.parser = MarkupParser(interactive=True)
+        self.cells = 0
+        self.skipped = 0
+        self.time = 0.
+        self.max_time = 0.
+
+    def __call__(self, lines):
+        start = time.perf_counter()
+        self.parser.checkpoint = checkpoint_opts.get('enabled', False)
+        cell = ''.join(lines)
+        if '%' in cell or (self.enabled and not self.parser.is_clean()):
+            if cell.endswith('\n'):
+                cell = cell[:-1]
+            if self.enabled:
+                lines_out = self.parser.feed(cell)
+            else:
+                lines_out = self.strip_tags(cell)
+            lines = ('\n'.join(lines_out) + '\n').splitlines(True)
+            if not lines_out:
+                lines = []
+        else:
+            self.skipped += 1
+        elapsed = time.perf_counter() - start
+        self.cells += 1
+        self.time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return lines
+
+    def strip_tags(self, cell):
+        """
+        Cut markup tags off the lines, drop procedure headers.
+        """
+        lines_out = []
+        for line in cell.split('\n'):
+            m = self.tag_re.match(line)
+            if m is not None and m.group('tagcode') in tags:
+                assert len(m.group('indent')) % 4 == 0
+                if tags[m.group('tagcode')] == 'BEGIN_PROC':
+                    continue
+                line = line[len(m.group(0)):]
+            lines_out.append(line)
+        return lines_out
+
+    def format_stats(self):
+        mean = self.time / self.cells if self.cells else 0
+        return ("Markup processing: %i cells (%i without markup), "
+                "mean %.3f ms, max %.3f ms per cell"
+                % (self.cells, self.skipped, mean * 1000,
+                   self.max_time * 1000))
+
+_cell_transformer = None
+
+def load_ipython_extension(ip):
+    global _cell_transformer
+
+    # Activating procedure collector
+    transformers = ip.input_transformers_cleanup
+    if _cell_transformer in transformers:
+        transformers.remove(_cell_transformer)
+    _cell_transformer = CellTransformer()
+    transformers.append(_cell_transformer)
+
+    # Registering magics
+    def iimport_enabled(line):
+        """  Magic to toggle iimport mode
+        0 = disabled, all macro commands are ignored (cutted away from the code)
+        1 = enabled, all macro commands work
+        """
+        enabled = int(line)
+        if enabled == 0:
+            _cell_transformer.enabled = False
+            print("iimport macros disabled")
+        elif enabled == 1:
+            _cell_transformer.enabled = True
+            print("iimport macros enabled")
+        else:
+            logger.error("Wrong argument supplied: {enabled}"
+                         .format(enabled=enabled))
+
+    shell = InteractiveShell.instance()
+    def iimport(line):
+        """  Magic to import a notebook
+        %iimport [--lazy] [--definitions | --slice] notebook [as name]
+        --lazy = execute the notebook on the first access to its attributes
+        --definitions = execute only imports and function definitions
+        --slice = execute only the code needed for the names taken
+                  from the notebook, on their first access
+        """
+        args = line.split()
+        lazy = '--lazy' in args
+        if lazy:
+            args.remove('--lazy')
+        mode = None
+        for flag in ('--definitions', '--slice'):
+            if flag in args:
+                if mode is not None:
+                    raise ImportError("--definitions and --slice "
+                                      "cannot be combined")
+                args.remove(flag)
+                mode = flag[2:]
+                if lazy:
+                    # The notebook would be loaded later, in an unknown mode
+                    raise ImportError("--lazy and %s cannot be combined"
+                                      % flag)
+        path, *args = args
+        if len(args) == 0:
+            name = reduce(lambda s, c: s.replace(c, '_'), ',. -', path).lower()
+        elif len(args) >= 1 and args[0] == 'as':
+            name = args[1]
+        else:
+            raise ImportError()
+        ns = current_namespace(shell)
+        if lazy:
+            ns[name] = lazy_import(path)
+        elif mode is not None:
+            ns[name] = import_in_mode(path, mode)
+        else:
+            ns[name] = importlib.import_module(path)
+
+    def iimport_stats(line):
+        """  Magic to show time spent on notebook imports in this session
+        %iimport_stats -- show statistics table
+        %iimport_stats reset -- clear statistics
+        """
+        if line.strip() == 'reset':
+            import_stats.clear()
+            _cell_transformer.cells = _cell_transformer.skipped = 0
+            _cell_transformer.time = _cell_transformer.max_time = 0.
+        else:
+            print(format_import_stats())
+            print(_cell_transformer.format_stats())
+
+    def reload_before_cell(info=None):
+        reload_all_procedures()
+
+    def iimport_reload(line):
+        """  Magic to reload procedures changed in imported notebooks
+        %iimport_reload -- reload them now
+        %iimport_reload on -- reload them before every cell execution
+        %iimport_reload off -- stop reloading them automatically
+        """
+        arg = line.strip()
+        callbacks = ip.events.callbacks['pre_run_cell']
+        if arg == 'on':
+            if reload_before_cell not in callbacks:
+                ip.events.register('pre_run_cell', reload_before_cell)
+        elif arg == 'off':
+            if reload_before_cell in callbacks:
+                ip.events.unregister('pre_run_cell', reload_before_cell)
+        elif arg == '':
+            for name, result in reload_all_procedures().items():
+                print('%s: %s' % (name, ', '.join(
+                    '%s %s' % (kind, ' '.join(names))
+                    for kind, names in result.items() if names) or
+                    'no procedures changed'))
+        else:
+            logger.error("Wrong argument supplied: {arg}".format(arg=arg))
+
+    def iimport_bench(line):
+        """  Magic to run named examples of notebooks as benchmarks
+        %iimport_bench [notebook ...] [-e example] [-j N] [-r N]
+                       [--save file.json] [--compare file.json]
+        Without notebooks, examples of all imported notebooks are run
+        (see `iimport-bench --help`)
+        """
+        from .bench import main
+        try:
+            main(shlex.split(line))
+        except SystemExit:
+            pass
+
+    def iimport_checkpoint(line):
+        """  Magic to restore results of unchanged procedures
+        instead of executing them again (with `%iimport_enabled 1`)
+        %iimport_checkpoint on -- restore them when the procedure code
+                                  and parameter values are the same
+        %iimport_checkpoint off -- always execute procedures
+        %iimport_checkpoint clear -- forget saved results
+        %iimport_checkpoint -- show checkpoint statistics
+        """
+        global _checkpoint_store
+        arg = line.strip()
+        if arg == 'on':
+            checkpoint_opts['enabled'] = True
+            # Limits might be changed
+            _checkpoint_store = None
+        elif arg == 'off':
+            checkpoint_opts['enabled'] = False
+        elif arg == 'clear':
+            get_checkpoint_store().clear()
+        elif arg == '':
+            info = get_checkpoint_store().info()
+            print(', '.join('%s: %s' % item for item in info.items()))
+        else:
+            logger.error("Wrong argument supplied: {arg}".format(arg=arg))
+
+    register_line_magic(iimport_enabled)
+    register_line_magic(iimport)
+    register_line_magic(iimport_stats)
+    register_line_magic(iimport_reload)
+    register_line_magic(iimport_bench)
+    register_line_magic(iimport_checkpoint)
+
+    print('iimport loaded.')
+
+def unload_ipython_extension(ip):
+    print("Unloading this extension is currently not implemented,"
+          " please restart the kernel.")
+
+
+#
+# Export to .py
+#
+
+def write_if_changed(path, text):
+    """
+    Atomically write the text file unless it already has this contents.
+    Returns True if the file was written.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            if f.read() == text:
+                return False
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        mode = None
+    tmp_path = '%s.%i.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+class IncrementalConverter(object):
+    """
+    Notebook to .py converter which re-processes only changed cells.
+
+    Output of every cell is cached by the digest of the cell text and of
+    the parser state at the cell entry (procedures may span several cells),
+    together with the parser state at the cell exit. Up to `max_cells`
+    recently used cells are kept.
+    """
+
+    def __init__(self, max_cells=10000):
+        self.max_cells = max_cells
+        self.cells = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Converter is shared by background export workers
+        self.lock = threading.Lock()
+
+    def process_ipynb(self, nb):
+        parser = MarkupParser()
+        cells_lines_out = []
+        for cell in nb.cells:
+            text = NotebookLoader.cell_text(cell)
+            key = (md5(text.encode('utf-8')).hexdigest(),
+                   parser.state_digest())
+            with self.lock:
+                entry = self.cells.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    self.cells.move_to_end(key)
+            if entry is None:
+                lines_out = parser.feed(text)
+                with self.lock:
+                    self.misses += 1
+                    self.cells[key] = (lines_out, parser.get_state())
+                    if len(self.cells) > self.max_cells:
+                        self.cells.popitem(last=False)
+            else:
+                lines_out, state = entry
+                parser.set_state(state)
+            cells_lines_out.append(lines_out)
+        return NotebookLoader.join_cells(cells_lines_out)
+
+    def convert_ipynb(self, path):
+        """
+        Convert the notebook to .py file next to it. The file is written
+        only if its contents changed. Returns True if the file was written.
+        """
+        text = self.process_ipynb(read_ipynb(path))
+        path_py = path.rsplit('.', 1)[0] + '.py'
+        return write_if_changed(path_py, text)
+
+_converter = IncrementalConverter()
+
+def save_ipynb_to_py(model, os_path, contents_manager, **kwargs):
+    if model['type'] != 'notebook':
+        return
+    if _converter.convert_ipynb(os_path):
+        contents_manager.log.info("File {os_path} exported to py"
+                                  .format(os_path=os_path))
+    else:
+        contents_manager.log.debug("File {os_path} is up to date in py"
+                                   .format(os_path=os_path))
+
+export_opts = {
+    # Number of threads converting notebooks in `save_ipynb_to_py_async`
+    'workers': 2,
+}
+
+class BackgroundExporter(object):
+    """
+    Exports notebooks to .py on a pool of worker threads, so that saving
+    a notebook does not wait for the conversion.
+
+    Saves of the same notebook coalesce: while its export is waiting in the
+    queue, new requests are dropped; if the export is already running,
+    the notebook is exported once more after it ends.
+    """
+
+    def __init__(self, workers=2, converter=None):
+        self.converter = converter or _converter
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='iimport-export')
+        self.lock = threading.Lock()
+        # {path: 'queued' | 'running' | 'rerun'}
+        self.states = {}
+        self.exported = 0
+        self.coalesced = 0
+        self.last_latency = None
+
+    @property
+    def queue_depth(self):
+        """
+        Number of notebooks waiting to be exported.
+        """
+        with self.lock:
+            return sum(1 for state in self.states.values()
+                       if state != 'running')
+
+    def submit(self, path, log=None):
+        """
+        Request export of the notebook. Returns at once.
+        """
+        with self.lock:
+            state = self.states.get(path)
+            if state is not None:
+                self.coalesced += 1
+                if state == 'running':
+                    self.states[path] = 'rerun'
+                return
+            self.states[path] = 'queued'
+        self.executor.submit(self._export, path, time.perf_counter(),
+                             log or logger)
+
+    def _export(self, path, requested, log):
+        while True:
+            with self.lock:
+                self.states[path] = 'running'
+            start = time.perf_counter()
+            try:
+                written = self.converter.convert_ipynb(path)
+            except Exception:
+                written = None
+                log.exception("Failed to export {path} to py"
+                              .format(path=path))
+            end = time.perf_counter()
+            with self.lock:
+                self.last_latency = end - requested
+                rerun = self.states[path] == 'rerun'
+                if rerun:
+                    requested = end
+                else:
+                    del self.states[path]
+                if written is not None:
+                    self.exported += 1
+            if written is not None:
+                log.info("File {path} {result} in {convert:.3f}s "
+                         "(latency {latency:.3f}s, queue depth {depth})"
+                         .format(path=path,
+                                 result=('exported to py' if written
+                                         else 'is up to date in py'),
+                                 convert=end - start,
+                                 latency=self.last_latency,
+                                 depth=self.queue_depth))
+            if not rerun:
+                break
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+def save_ipynb_to_py_async(model, os_path, contents_manager, **kwargs):
+    """
+    The same as `save_ipynb_to_py`, but the notebook is exported
+    in background by `BackgroundExporter`.
+    """
+    global _exporter
     if model['type'] != 'notebook':
         return
-    NotebookLoader.convert_ipynb(os_path)
-    contents_manager.log.info("File {os_path} exported to py"
-                              .format(os_path=os_path))
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = BackgroundExporter(export_opts.get('workers', 2))
+    _exporter.submit(os_path, log=contents_manager.log)
 
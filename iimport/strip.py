@@ -0,0 +1,636 @@
+"""
+iimport-strip: remove outputs, execution counts and cell metadata from
+notebooks before they are committed.
+
+    $ iimport-strip notebooks/ -j 8        # strip notebooks in place
+    $ iimport-strip --check .              # list notebooks with outputs
+    $ iimport-strip < in.ipynb > out.ipynb
+
+Notebooks are rewritten in a single streaming pass: only the objects on
+the way to cells and notebook metadata are parsed, outputs are scanned
+through without being decoded and everything else is copied as is.
+Memory usage does not depend on the size of outputs, and clean notebooks
+stay the same byte for byte. In batch mode notebooks are first checked
+without writing anything, and clean ones are left untouched.
+
+To use it as a git clean filter:
+
+    $ iimport-strip --install
+    $ echo '*.ipynb filter=iimport-strip' >> .gitattributes
+
+This sets up the long-running filter process (started once per git
+command instead of once per notebook) and a per-file clean filter for
+git versions without it.
+
+The module depends on the standard library only, so the filter is run
+as a script without importing iimport and IPython.
+"""
+import argparse
+import codecs
+import io
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+filter_name = 'iimport-strip'
+
+# Actions on object members besides replacing the value
+DROP = object()
+COPY = object()
+
+
+class Dirty(Exception):
+    """
+    Raised on the first change when the notebook is only checked.
+    """
+
+
+class NotebookStripper(object):
+    """
+    Streaming rewriter of notebook JSON.
+
+    Reads the notebook from `f` and writes the stripped notebook to `out`.
+    Without `out` the notebook is only checked, and `Dirty` is raised as
+    soon as something is to be stripped.
+    """
+    chunk_size = 2**16
+    # Values longer than this are never the same as the replacement
+    sample_size = 256
+
+    _ws_re = re.compile(r'[ \t\n\r]*')
+    # Strings complete in the buffer are matched as a whole
+    _struct_re = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|["\[\]{}]')
+    _scalar_re = re.compile(r'[^,\]}\s]*')
+
+    def __init__(self, f, out=None):
+        self.f = f
+        self.out = out
+        self.buf = ''
+        self.pos = 0
+        self.changed = False
+
+    def _fill(self):
+        """
+        Drop consumed part of the buffer and read the next chunk.
+        """
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _fill_or_fail(self):
+        if not self._fill():
+            raise ValueError("Unexpected end of notebook JSON")
+
+    def _write(self, text):
+        if self.out is not None and text:
+            self.out.write(text)
+
+    def _change(self):
+        self.changed = True
+        if self.out is None:
+            raise Dirty()
+
+    def _ws(self):
+        """
+        Consume whitespace and return it.
+        """
+        parts = []
+        while True:
+            end = self._ws_re.match(self.buf, self.pos).end()
+            parts.append(self.buf[self.pos:end])
+            self.pos = end
+            if end < len(self.buf) or not self._fill():
+                return ''.join(parts)
+
+    def _char(self):
+        if self.pos == len(self.buf):
+            self._fill_or_fail()
+        return self.buf[self.pos]
+
+    def _expect(self, char):
+        found = self._char()
+        if found != char:
+            raise ValueError("Malformed notebook JSON: expected %r, found %r"
+                             % (char, found))
+        self.pos += 1
+
+    def _string(self, emit):
+        """
+        Scan a string, passing its raw text to `emit` piece by piece.
+        """
+        self._expect('"')
+        start = self.pos - 1
+        while True:
+            # str.find is much faster than regex search on long strings
+            # like base64-encoded images
+            quote = self.buf.find('"', self.pos)
+            end = len(self.buf) if quote < 0 else quote
+            escape = self.buf.find('\\', self.pos, end)
+            if escape >= 0:
+                if escape + 1 < len(self.buf):
+                    self.pos = escape + 2
+                    continue
+                # Escape sequence is cut by the chunk boundary
+                end = escape
+            elif quote >= 0:
+                self.pos = quote + 1
+                emit(self.buf[start:self.pos])
+                return
+            emit(self.buf[start:end])
+            self.pos = end
+            self._fill_or_fail()
+            start = self.pos
+
+    def _scalar(self):
+        m = self._scalar_re.match(self.buf, self.pos)
+        while m.end() == len(self.buf) and self._fill():
+            m = self._scalar_re.match(self.buf, self.pos)
+        if not m.group():
+            raise ValueError("Malformed notebook JSON: unexpected %r"
+                             % self._char())
+        self.pos = m.end()
+        return m.group()
+
+    def _value(self, emit):
+        """
+        Scan a value of any type, passing its raw text to `emit`.
+        """
+        char = self._char()
+        if char == '"':
+            self._string(emit)
+        elif char in '[{':
+            start = self.pos
+            depth = 0
+            while True:
+                m = self._struct_re.search(self.buf, self.pos)
+                if m is None:
+                    emit(self.buf[start:])
+                    self.pos = len(self.buf)
+                    self._fill_or_fail()
+                    start = self.pos
+                    continue
+                self.pos = m.end()
+                token = m.group()
+                if token[0] == '"':
+                    if len(token) == 1:
+                        # String continues in the next chunk
+                        emit(self.buf[start:m.start()])
+                        self.pos = m.start()
+                        self._string(emit)
+                        start = self.pos
+                    continue
+                depth += 1 if token in '[{' else -1
+                if depth == 0:
+                    emit(self.buf[start:self.pos])
+                    return
+        else:
+            emit(self._scalar())
+
+    def _replace(self, value):
+        """
+        Replace the value with `value`. The original text is kept if it
+        is the same value.
+        """
+        sample = []
+        size = 0
+
+        def collect(text):
+            nonlocal size
+            size += len(text)
+            if size <= self.sample_size:
+                sample.append(text)
+
+        self._value(collect)
+        if size <= self.sample_size:
+            raw = ''.join(sample)
+            if json.loads(raw) == value:
+                self._write(raw)
+                return
+        self._change()
+        self._write(json.dumps(value))
+
+    def _object(self, fields):
+        """
+        Copy an object, processing the members listed in `fields`:
+        DROP removes the member, a function processes its value, other
+        values replace it. Anything but an object is copied as is.
+        """
+        if self._char() != '{':
+            return self._value(self._write)
+        self.pos += 1
+        self._write('{')
+        lead = self._ws()
+        if self._char() == '}':
+            self.pos += 1
+            self._write(lead + '}')
+            return
+        first = True
+        while True:
+            key = []
+            self._string(key.append)
+            key = ''.join(key)
+            sep = self._ws()
+            self._expect(':')
+            sep += ':' + self._ws()
+
+            action = fields.get(json.loads(key), COPY)
+            if action is DROP:
+                self._value(lambda text: None)
+                self._change()
+            else:
+                self._write(lead + key + sep if first
+                            else ',' + lead + key + sep)
+                first = False
+                if action is COPY:
+                    self._value(self._write)
+                elif callable(action):
+                    action()
+                else:
+                    self._replace(action)
+
+            trail = self._ws()
+            char = self._char()
+            self.pos += 1
+            if char == '}':
+                # Closing brace goes on its own line unless everything
+                # has been dropped
+                self._write('}' if first else trail + '}')
+                return
+            if char != ',':
+                raise ValueError("Malformed notebook JSON: unexpected %r"
+                                 % char)
+            lead = self._ws()
+
+    def _array(self, item):
+        """
+        Copy an array, processing its items with `item`.
+        """
+        if self._char() != '[':
+            return self._value(self._write)
+        self.pos += 1
+        self._write('[' + self._ws())
+        if self._char() == ']':
+            self.pos += 1
+            self._write(']')
+            return
+        while True:
+            item()
+            self._write(self._ws())
+            char = self._char()
+            self.pos += 1
+            self._write(char)
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError("Malformed notebook JSON: unexpected %r"
+                                 % char)
+            self._write(self._ws())
+
+    def _cell(self):
+        self._object({
+            'outputs': [],
+            'execution_count': None,
+            'metadata': {},
+            # nbformat 3
+            'prompt_number': DROP,
+            'execution_number': DROP,
+        })
+
+    def _cells(self):
+        self._array(self._cell)
+
+    def _metadata(self):
+        self._object({
+            'widgets': DROP,
+            'signature': '',
+            'language_info': lambda: self._object({'version': DROP}),
+        })
+
+    def _worksheet(self):
+        self._object({'cells': self._cells, 'metadata': self._metadata})
+
+    def strip(self):
+        """
+        Rewrite the notebook. Returns True if anything has been stripped.
+        """
+        self._write(self._ws())
+        self._object({
+            'cells': self._cells,
+            'metadata': self._metadata,
+            # nbformat 3
+            'worksheets': lambda: self._array(self._worksheet),
+        })
+        rest = self._ws()
+        if self.pos < len(self.buf):
+            raise ValueError("Malformed notebook JSON: data after the end")
+        self._write(rest)
+        return self.changed
+
+
+def open_notebook(path, mode='r'):
+    # Line endings are kept as they are
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def is_clean(path):
+    """
+    Check that the notebook has nothing to strip. Stops reading at the
+    first output.
+    """
+    with open_notebook(path) as f:
+        try:
+            NotebookStripper(f).strip()
+        except Dirty:
+            return False
+    return True
+
+
+def strip_file(path, check=False):
+    """
+    Strip the notebook in place (the file is replaced only if it is not
+    clean). Returns (status, seconds), status is one of 'clean', 'stripped'
+    and, if `check` is set, 'dirty'.
+    """
+    start = time.perf_counter()
+    if is_clean(path):
+        status = 'clean'
+    elif check:
+        status = 'dirty'
+    else:
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        try:
+            with open_notebook(path) as f, open_notebook(tmp_path, 'w') as out:
+                NotebookStripper(f, out).strip()
+            shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        status = 'stripped'
+    return status, time.perf_counter() - start
+
+
+def find_notebooks(paths):
+    """
+    Yield notebook files given as paths and found in given directories,
+    skipping hidden directories (including `.git` and `.ipynb_checkpoints`).
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for fn in sorted(filenames):
+                if fn.endswith('.ipynb'):
+                    yield os.path.join(dirpath, fn)
+
+
+def strip_files(paths, jobs=None, check=False, report=print):
+    """
+    Strip notebooks in parallel worker processes. Returns ({path: status},
+    {path: error}) of processed and failed notebooks.
+    """
+    statuses = {}
+    failures = {}
+
+    def done(path, status, seconds):
+        statuses[path] = status
+        report('%-9s %8.3fs  %s' % (status, seconds, path))
+
+    def failed(path, exc):
+        failures[path] = exc
+        report('%-9s %8s   %s: %s' % ('FAILED', '', path, exc))
+
+    paths = list(find_notebooks(paths))
+    if jobs == 1 or len(paths) < 2:
+        for path in paths:
+            try:
+                done(path, *strip_file(path, check))
+            except Exception as exc:
+                failed(path, exc)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(strip_file, path, check): path
+                       for path in paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    done(path, *future.result())
+                except Exception as exc:
+                    failed(path, exc)
+    return statuses, failures
+
+
+#
+# Git long-running filter process
+# (see "Long Running Filter Process" in gitattributes(5))
+#
+
+max_packet_size = 65516
+
+
+def read_packet(f):
+    """
+    Read pkt-line, returns None for the flush packet.
+    """
+    header = f.read(4)
+    if len(header) < 4:
+        raise EOFError()
+    size = int(header, 16)
+    if size == 0:
+        return None
+    data = f.read(size - 4)
+    if len(data) < size - 4:
+        raise EOFError()
+    return data
+
+
+def write_packet(f, data=None):
+    if data is None:
+        f.write(b'0000')
+    else:
+        f.write(b'%04x' % (len(data) + 4) + data)
+
+
+def read_packet_lines(f):
+    lines = []
+    while True:
+        data = read_packet(f)
+        if data is None:
+            return lines
+        lines.append(data.decode('utf-8').rstrip('\n'))
+
+
+def write_packet_lines(f, lines):
+    for line in lines:
+        write_packet(f, line.encode('utf-8') + b'\n')
+    write_packet(f)
+
+
+class PacketReader(object):
+    """
+    Text file interface to the content sent by git as pkt-lines up to
+    the flush packet.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done:
+            data = read_packet(self.f)
+            if data is None:
+                self.done = True
+                return self.decoder.decode(b'', final=True)
+            text = self.decoder.decode(data)
+            if text:
+                return text
+        return ''
+
+    def drain(self):
+        while not self.done:
+            self.done = read_packet(self.f) is None
+
+
+def git_filter_process(stdin=None, stdout=None):
+    """
+    Serve clean requests of git until it closes the pipe.
+
+    Git sends the whole file before reading the result, so the stripped
+    notebook is kept in memory until the input ends.
+    """
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+
+    welcome = read_packet_lines(stdin)
+    if welcome[:1] != ['git-filter-client'] or 'version=2' not in welcome:
+        raise ValueError("Unknown filter protocol: %r" % welcome)
+    write_packet_lines(stdout, ['git-filter-server', 'version=2'])
+    capabilities = read_packet_lines(stdin)
+    write_packet_lines(stdout, [c for c in capabilities
+                                if c == 'capability=clean'])
+    stdout.flush()
+
+    while True:
+        try:
+            request = dict(line.split('=', 1)
+                           for line in read_packet_lines(stdin))
+        except EOFError:
+            return
+        content = PacketReader(stdin)
+        out = io.StringIO()
+        try:
+            if request.get('command') != 'clean':
+                raise ValueError("Unsupported command %r"
+                                 % request.get('command'))
+            NotebookStripper(content, out).strip()
+        except ValueError as exc:
+            content.drain()
+            print('%s: %s: %s' % (filter_name, request.get('pathname'), exc),
+                  file=sys.stderr)
+            write_packet_lines(stdout, ['status=error'])
+        else:
+            write_packet_lines(stdout, ['status=success'])
+            data = out.getvalue().encode('utf-8')
+            for pos in range(0, len(data), max_packet_size):
+                write_packet(stdout, data[pos:pos + max_packet_size])
+            write_packet(stdout)
+            # Empty list keeps the status
+            write_packet(stdout)
+        stdout.flush()
+
+
+def install_git_filter(repo='.'):
+    """
+    Configure the filter in the git repository. The notebooks are
+    selected in .gitattributes with `*.ipynb filter=iimport-strip`.
+    """
+    command = '%s %s' % (shlex.quote(sys.executable),
+                         shlex.quote(os.path.abspath(__file__)))
+    config = [
+        ('clean', command),
+        ('process', command + ' --git-process'),
+        ('required', 'false'),
+    ]
+    for key, value in config:
+        subprocess.check_call(['git', 'config', 'filter.%s.%s'
+                               % (filter_name, key), value], cwd=repo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog=filter_name,
+        description='Strip outputs, execution counts and metadata from '
+                    'notebooks. Without paths, filters stdin to stdout.')
+    parser.add_argument('paths', nargs='*',
+                        help='notebooks and directories to strip in place')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes '
+                             '(default: number of CPUs)')
+    parser.add_argument('-c', '--check', action='store_true',
+                        help='only report notebooks which are not clean')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='report changes and failures only')
+    parser.add_argument('--install', action='store_true',
+                        help='configure git filter in the current repository')
+    parser.add_argument('--git-process', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.install:
+        install_git_filter()
+        return 0
+    if args.git_process:
+        git_filter_process()
+        return 0
+
+    if not args.paths:
+        f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+        out = None
+        if not args.check:
+            out = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8',
+                                   newline='')
+        try:
+            NotebookStripper(f, out).strip()
+        except Dirty:
+            return 1
+        except ValueError as exc:
+            print('%s: %s' % (filter_name, exc), file=sys.stderr)
+            return 1
+        finally:
+            if out is not None:
+                out.flush()
+        return 0
+
+    def report(line):
+        if not args.quiet or not line.startswith('clean'):
+            print(line)
+
+    start = time.perf_counter()
+    statuses, failures = strip_files(args.paths, args.jobs, args.check,
+                                     report=report)
+    changed = sum(status != 'clean' for status in statuses.values())
+    print('Done in %.1fs, %i %s, %i failed'
+          % (time.perf_counter() - start, changed,
+             'not clean' if args.check else 'stripped', len(failures)),
+          file=sys.stderr)
+    return 1 if failures or (args.check and changed) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
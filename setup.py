@@ -24,6 +24,14 @@ config = {
         ],
     'packages': find_packages(exclude=['docs', 'contrib', 'tests']),
     'scripts': [],
+    'entry_points': {
+        'console_scripts': [
+            'iimport-convert = iimport.convert:main',
+            'iimport-bundle = iimport.bundle:main',
+            'iimport-strip = iimport.strip:main',
+            'iimport-bench = iimport.bench:main',
+        ],
+    },
 }
 
 setup(**config)
@@ -0,0 +1,99 @@
+import unittest
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import redirect_stdout, redirect_stderr
+
+import nbformat
+
+from iimport import bench
+
+
+def write_notebook(path, *sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(source) for source in sources]
+    with open(path, 'w', encoding='utf-8') as f:
+        nbformat.write(nb, f)
+
+
+class TestBench(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.nb_path = os.path.join(self.root, 'benched_nb.ipynb')
+        write_notebook(self.nb_path,
+                       '%def total(x):\ny = sum(range(x))\n%return y',
+                       '%example small\nz = total(10)\n%end_example',
+                       '%example large\nw = [total(1000)] * 1000\n'
+                       '%end_example',
+                       '%example broken\n1 / 0\n%end_example',
+                       '%example\nunnamed = total(1)\n%end_example')
+        self.lines = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        sys.modules.pop('benched_nb', None)
+
+    def test_find_examples(self):
+        tasks = bench.find_examples([self.nb_path])
+        self.assertEqual(tasks, [('benched_nb', self.nb_path, 'small'),
+                                 ('benched_nb', self.nb_path, 'large'),
+                                 ('benched_nb', self.nb_path, 'broken')])
+        self.assertNotIn('benched_nb', sys.modules)
+        self.assertEqual(bench.find_examples(['benched_nb'], [self.root]),
+                         tasks)
+        with self.assertRaises(ImportError):
+            bench.find_examples(['missing_nb'], [self.root])
+
+    def test_bench_examples(self):
+        tasks = bench.find_examples([self.nb_path])
+        for jobs in (1, 2):
+            results, failures = bench.bench_examples(
+                tasks, jobs=jobs, warmup=0, repeat=3,
+                report=self.lines.append)
+            self.assertEqual(list(failures), ['benched_nb:broken'])
+            stats = results['benched_nb']
+            self.assertEqual(sorted(stats), ['large', 'small'])
+            for example in stats.values():
+                self.assertLessEqual(example['time_min'],
+                                     example['time_median'])
+                self.assertGreaterEqual(example['time_stdev'], 0)
+            self.assertGreater(stats['large']['peak_kb'],
+                               stats['small']['peak_kb'])
+
+    def test_compare(self):
+        stats = {'time_min': 1., 'peak_kb': 100.}
+        results = {'nb': {'same': stats, 'slower': dict(stats, time_min=2.),
+                          'fatter': dict(stats, peak_kb=200.),
+                          'new': stats}}
+        baseline = {'nb': {'same': stats, 'slower': stats, 'fatter': stats}}
+        self.assertEqual(bench.compare(results, baseline, 1.2,
+                                       report=self.lines.append), 2)
+        self.assertEqual(len(self.lines), 3)
+        self.assertEqual(bench.compare(results, baseline, 3,
+                                       report=self.lines.append), 0)
+
+    def test_main(self):
+        saved = os.path.join(self.root, 'baseline.json')
+        out = io.StringIO()
+        with redirect_stdout(out), redirect_stderr(io.StringIO()):
+            self.assertEqual(bench.main([self.nb_path, '-e', 'small',
+                                         '-j', '1', '-r', '2',
+                                         '--save', saved]), 0)
+            with open(saved) as f:
+                data = json.load(f)
+            self.assertEqual(list(data['results']['benched_nb']), ['small'])
+            # Any ratio is a regression with the zero threshold
+            self.assertEqual(bench.main([self.nb_path, '-e', 'small',
+                                         '-j', '1', '-r', '2',
+                                         '--compare', saved,
+                                         '--threshold', '0']), 1)
+            self.assertEqual(bench.main([self.nb_path, '-e', 'none']), 1)
+        self.assertIn('REGRESSION', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
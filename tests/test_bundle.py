@@ -0,0 +1,94 @@
+import unittest
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from unittest import mock
+
+import nbformat
+
+import iimport
+from iimport import bundle
+
+
+def write_notebook(path, *sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(source) for source in sources]
+    with open(path, 'w', encoding='utf-8') as f:
+        nbformat.write(nb, f)
+
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.nb_dir = os.path.join(self.root, 'notebooks')
+        os.makedirs(self.nb_dir)
+        write_notebook(os.path.join(self.nb_dir, 'main.ipynb'),
+                       '%load_ext iimport\n%iimport helpers\n'
+                       'import second',
+                       'if True:\n    %iimport helpers as h',
+                       '%def total(x):\ny = h.double(x) + second.one\n'
+                       '%return y',
+                       '%{cache}def square(x):\nz = x * x\n%return z',
+                       'files = !echo bundled')
+        write_notebook(os.path.join(self.nb_dir, 'helpers.ipynb'),
+                       '%matplotlib inline\n%def double(x):\ny = 2 * x\n'
+                       '%return y')
+        write_notebook(os.path.join(self.nb_dir, 'second.ipynb'), 'one = 1')
+        self.archive = os.path.join(self.root, 'bundle.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_python(self, code):
+        # Run with the clean environment: neither iimport nor IPython
+        # are importable from the bundle
+        env = dict(os.environ, PYTHONPATH=self.archive)
+        return subprocess.check_output(
+            [sys.executable, '-c', code], env=env, cwd=self.root,
+            stderr=subprocess.STDOUT).decode()
+
+    def test_bundle(self):
+        lines = []
+        manifest = bundle.bundle_notebooks(
+            [os.path.join(self.nb_dir, 'main.ipynb')], self.archive,
+            report=lines.append)
+        assert sorted(manifest['modules']) == ['helpers', 'main', 'second']
+        with zipfile.ZipFile(self.archive) as zf:
+            names = zf.namelist()
+            assert json.loads(zf.read(bundle.manifest_name)) == manifest
+        assert 'main.pyc' in names and '_iimport_runtime.py' in names
+
+        out = self.run_python(
+            'import sys, main\n'
+            'print(main.total(3), main.square(4), main.square(4),'
+            ' main.square.hits, main.files)\n'
+            'print(sorted(m for m in ["IPython", "nbformat", "iimport"]'
+            ' if m in sys.modules))')
+        assert out.split('\n')[:2] == ["7 16 16 1 ['bundled']", '[]']
+
+    def test_global_mode_not_changed(self):
+        path = os.path.join(self.nb_dir, 'second.ipynb')
+        compile_ipynb = iimport.NotebookLoader.compile_ipynb
+        modes = []
+        def spy(loader, *args, **kwargs):
+            modes.append(iimport.import_opts['mode'])
+            return compile_ipynb(loader, *args, **kwargs)
+        with mock.patch.dict(iimport.import_opts, {'mode': 'definitions'}), \
+                mock.patch.object(iimport.NotebookLoader, 'compile_ipynb',
+                                  spy):
+            source, _, _ = bundle.compile_notebook(path, path)
+        # The whole module is compiled, the global option is kept as is
+        assert 'one = 1' in source
+        assert modes == ['definitions']
+
+    def test_missing_notebook(self):
+        self.assertRaises(ImportError, bundle.bundle_notebooks,
+                          ['missing'], self.archive, [self.nb_dir])
+        assert bundle.main(['-q', '-o', self.archive, '-p', self.nb_dir,
+                            'helpers']) == 0
+        assert bundle.main(['-q', '-o', self.archive, 'missing']) == 1
@@ -0,0 +1,75 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import nbformat
+
+from iimport import convert
+
+
+def write_notebook(path, *sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(source) for source in sources]
+    with open(path, 'w', encoding='utf-8') as f:
+        nbformat.write(nb, f)
+
+
+class TestConvertTree(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'sub'))
+        os.makedirs(os.path.join(self.root, '.ipynb_checkpoints'))
+        write_notebook(os.path.join(self.root, 'a.ipynb'), 'a = 1')
+        write_notebook(os.path.join(self.root, 'sub', 'b.ipynb'),
+                       '%def f(x):\ny = x\n%return y')
+        write_notebook(
+            os.path.join(self.root, '.ipynb_checkpoints', 'a-checkpoint.ipynb'),
+            'a = 1')
+        self.lines = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def convert(self, jobs=1, **kwargs):
+        self.lines = []
+        return convert.convert_tree(self.root, jobs=jobs,
+                                    report=self.lines.append, **kwargs)
+
+    def statuses(self):
+        return sorted(line.split()[0] for line in self.lines)
+
+    def test_find_notebooks(self):
+        paths = list(convert.find_notebooks(self.root))
+        assert [os.path.relpath(p, self.root) for p in paths] == \
+            ['a.ipynb', os.path.join('sub', 'b.ipynb')]
+
+    def test_convert_and_skip(self):
+        assert self.convert() == {}
+        assert self.statuses() == ['converted', 'converted']
+        assert os.path.isfile(os.path.join(self.root, 'sub', 'b.py'))
+
+        self.convert()
+        assert self.statuses() == ['skipped', 'skipped']
+
+        write_notebook(os.path.join(self.root, 'a.ipynb'), 'a = 2')
+        self.convert()
+        assert self.statuses() == ['converted', 'skipped']
+
+        self.convert(force=True)
+        assert self.statuses() == ['unchanged', 'unchanged']
+
+    def test_failures_do_not_stop_batch(self):
+        with open(os.path.join(self.root, 'broken.ipynb'), 'w') as f:
+            f.write('{not json')
+        failures = self.convert(jobs=2)
+        assert list(failures) == [os.path.join(self.root, 'broken.ipynb')]
+        assert self.statuses() == ['FAILED', 'converted', 'converted']
+
+    def test_main(self):
+        assert convert.main([self.root, '-q', '-j', '1']) == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,28 @@
 import unittest
+import threading
+import multiprocessing
+import importlib
+import inspect
+import json
 import pytest
 import os
+import sys
+import types
+import shutil
+import subprocess
+import concurrent.futures
+import tempfile
+import time
+from unittest import mock
 import nbformat
+import numpy as np
 
 import iimport
 from iimport import fetch_tag, collect_proc, output_filter
 
-import sample_notebook
+# The sample notebook has lines which work only interactively
+with mock.patch.dict(iimport.import_opts, {'errors': 'log'}):
+    import sample_notebook
 path_nb = './sample_notebook.ipynb'
 
 
@@ -64,6 +80,1344 @@ class TestImportIpynb(unittest.TestCase):
         assert 'skipped_fn' not in sample_notebook.__dict__
 
 
+class TestProcedure(unittest.TestCase):
+
+    def make_proc(self, params):
+        return iimport.Procedure('proc', params, {'indent': ''})
+
+    def test_param_substitution(self):
+        proc = self.make_proc("args.path, args['n'], k=10")
+        for line in ["x = args.path + args.path_extra",
+                     "y = self.args.path",
+                     "z = args['n'] * 10 + 100"]:
+            proc.add_line(line, {})
+        assert proc.body == ["x = args_path + args.path_extra",
+                             "y = self.args.path",
+                             "z = args_n * k + 100"]
+
+    def test_longest_value_first(self):
+        proc = self.make_proc("a=x, b=x.y")
+        proc.add_line("x.y + x", {})
+        assert proc.body == ["b + a"]
+
+    def test_no_substitutions(self):
+        proc = self.make_proc("f1_path=f1_path, x")
+        assert proc.subst_re is None
+        proc.add_line("f1_path + x", {})
+        assert proc.body == ["f1_path + x"]
+
+
+class TestMarkupParser(unittest.TestCase):
+
+    def assert_same_text(self, nb):
+        text_chain = iimport.NotebookLoader.process_ipynb(nb, parser='chain')
+        text_markup = iimport.NotebookLoader.process_ipynb(nb, parser='markup')
+        assert text_markup == text_chain
+
+    def test_sample_notebook(self):
+        with open(path_nb, 'r') as f:
+            nb = nbformat.read(f, as_version=4)
+        self.assert_same_text(nb)
+
+    def test_tags(self):
+        nb = nbformat.v4.new_notebook()
+        nb.cells = [
+            nbformat.v4.new_code_cell(
+                'a = 1\n%def outer(x, y=args.path):\n'
+                '%/*\nskipped = 1\n%*/\n%/*\nz = x\n%- print(z)'),
+            nbformat.v4.new_markdown_cell('Cell\n%def not_a_tag(x):'),
+            nbformat.v4.new_code_cell(
+                'for i in range(3):\n'
+                '    %def inner(i):\n    w = i\n    %return w\n'
+                '%example ex\nprint(1)\n%end_example\n'
+                '%matplotlib inline\n%return z\n%return z'),
+        ]
+        self.assert_same_text(nb)
+
+    def test_unknown_parser(self):
+        nb = nbformat.v4.new_notebook()
+        with pytest.raises(ValueError):
+            iimport.NotebookLoader.process_ipynb(nb, parser='unknown')
+
+    def test_transform_source(self):
+        loader = iimport.NotebookLoader()
+        manager = loader.shell.input_transformer_manager
+        for text in ['\n\nx = 1\nprint("%s" % x)',
+                     '    x = 1\n    y = 2',
+                     'x = 1\n    %time y = 2\nfiles = !ls']:
+            assert loader.transform_source(text) == manager.transform_cell(text)
+
+
+class TestCellTransformer(unittest.TestCase):
+
+    def run_cells(self, transformer, *cells):
+        return [''.join(transformer(cell.splitlines(True))) for cell in cells]
+
+    def test_same_text_as_chain(self):
+        with open(path_nb, 'r') as f:
+            nb = nbformat.read(f, as_version=4)
+        cells = [cell.source for cell in nb.cells if cell.cell_type == 'code']
+        for enabled in [0, 1]:
+            chain = fetch_tag(collect_proc(output_filter()),
+                              opts={'enabled': enabled})
+            expected = []
+            for cell in cells:
+                lines_out = [chain.send(l) for l in cell.split('\n')]
+                expected.append('\n'.join(l for l in lines_out
+                                          if l is not None))
+            transformer = iimport.CellTransformer(enabled=bool(enabled))
+            texts = self.run_cells(transformer, *[c + '\n' for c in cells])
+            assert [t[:-1] for t in texts] == expected
+
+    def test_cells_without_markup_skipped(self):
+        transformer = iimport.CellTransformer(enabled=True)
+        texts = self.run_cells(transformer,
+                               'a = 1\n',
+                               '%def f(x):\ny = x\n',
+                               'z = y\n',
+                               '%return z\nb = 2\n',
+                               'c = 3\n')
+        assert texts[2] == 'z = y\n'
+        assert 'def f(x):' in texts[3] and '    z = y' in texts[3]
+        assert (transformer.cells, transformer.skipped) == (5, 2)
+        assert transformer.max_time > 0
+        assert 'mean' in transformer.format_stats()
+
+    def test_disabled(self):
+        transformer = iimport.CellTransformer()
+        texts = self.run_cells(transformer,
+                               '%def f(x):\ny = x\n%- print(y)\n%return y\n')
+        assert texts == ['y = x\nprint(y)\ny\n']
+        assert transformer.parser.is_clean()
+
+    def test_not_run_on_imported_source(self):
+        shell = iimport.InteractiveShell.instance()
+        transformer = iimport.CellTransformer(enabled=True)
+        self.run_cells(transformer, '%def f(x):\ny = x\n')
+        shell.input_transformers_cleanup.append(transformer)
+        try:
+            source = iimport.NotebookLoader().transform_source(
+                'if True:\n    %time a = 1\n    %return a\n')
+        finally:
+            shell.input_transformers_cleanup.remove(transformer)
+        assert 'run_line_magic' in source
+        assert transformer.cells == 1
+        assert transformer.parser.proc.name == 'f'
+        assert 'def f(x):' in self.run_cells(transformer, '%return y\n')[0]
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    cell = ('n = 3\n'
+            '%def load(size=n):\n'
+            'runs.append(n)\n'
+            'data = list(range(n))\n'
+            '%return data\n')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        patches = [
+            mock.patch.dict(iimport.checkpoint_opts,
+                            {'enabled': True, 'dir': self.tmpdir}),
+            mock.patch.object(iimport.iimport, '_checkpoint_store', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.transformer = iimport.CellTransformer(enabled=True)
+        self.ns = {'runs': []}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_cell(self, cell):
+        text = ''.join(self.transformer(cell.splitlines(True)))
+        exec(text, self.ns)
+        return text
+
+    def test_unchanged_procedure_restored(self):
+        self.run_cell(self.cell)
+        self.ns['data'].append(99)
+        self.run_cell(self.cell)
+        assert self.ns['runs'] == [3]
+        assert self.ns['data'] == [0, 1, 2]
+        assert self.ns['load'](2) == [0, 1]
+        # Parameter value changed
+        self.run_cell(self.cell.replace('n = 3', 'n = 4'))
+        # Body changed
+        self.run_cell(self.cell.replace('%return', 'data.reverse()\n%return'))
+        assert self.ns['runs'] == [3, 2, 4, 3]
+        assert self.ns['data'] == [2, 1, 0]
+        # Disabled
+        iimport.checkpoint_opts['enabled'] = False
+        self.run_cell(self.cell)
+        assert self.ns['runs'] == [3, 2, 4, 3, 3]
+
+    def test_parameter_value(self):
+        cell = ('%def f(x=5):\n'
+                'runs.append(x)\n'
+                'z = x * 10\n'
+                '%return z\n')
+        # The inline body uses the namespace value, not the default
+        for x in (3, 4, 3):
+            self.run_cell('x = %i' % x)
+            self.run_cell(cell)
+            assert self.ns['z'] == x * 10
+        assert self.ns['runs'] == [3, 4]
+        # The default is used while the parameter is undefined
+        self.run_cell('x = 5')
+        self.run_cell(cell)
+        del self.ns['x'], self.ns['z']
+        self.run_cell(cell)
+        assert self.ns['z'] == 50
+        assert self.ns['runs'] == [3, 4, 5]
+
+    def test_restored_from_disk(self):
+        self.run_cell(self.cell)
+        iimport.iimport._checkpoint_store = None
+        self.run_cell(self.cell)
+        assert self.ns['runs'] == [3]
+        assert iimport.get_checkpoint_store().info()['hits'] == 1
+
+    def test_not_wrapped(self):
+        nested = ('%def outer(x):\n'
+                  '%def inner(x):\n'
+                  'y = x + 1\n'
+                  '%return y\n'
+                  'z = y * 2\n'
+                  '%return z\n')
+        docstring = '%def f(x):\ny = """a"""\n%return y\n'
+        for cell in nested, docstring:
+            text = ''.join(self.transformer(cell.splitlines(True)))
+            assert 'Checkpoint' not in text
+        # Procedures spanning cells
+        texts = [''.join(self.transformer(cell.splitlines(True)))
+                 for cell in ('%def f(x):\ny = x\n', '%return y\n')]
+        assert not any('Checkpoint' in text for text in texts)
+
+    def test_broken_results_dropped(self):
+        store = iimport.CheckpointStore(cache_dir=self.tmpdir)
+        moved = types.ModuleType('moved_module')
+        exec('class Result(object):\n    pass', moved.__dict__)
+        moved.Result.__module__ = 'moved_module'
+        with mock.patch.dict(sys.modules, {'moved_module': moved}):
+            store.set('a', {'x': moved.Result()})
+        assert store.get('a') is None
+        assert store.info()['entries'] == 0
+        assert store.info()['disk_entries'] == 0
+
+    def test_memory_limit(self):
+        store = iimport.CheckpointStore(max_memory=300)
+        store.set('a', {'x': b'a' * 100})
+        store.set('b', {'x': b'b' * 100})
+        store.set('c', {'x': b'c' * 100})
+        assert store.get('a') is None
+        assert store.get('c') == {'x': b'c' * 100}
+        store.set('big', {'x': b'd' * 1000})
+        assert store.get('big') is None
+        assert store.size <= 300
+
+
+class TestSourceMap(unittest.TestCase):
+
+    def setUp(self):
+        self.path = sample_notebook.__spec__.origin
+        with open(path_nb, 'r') as f:
+            self.nb = nbformat.read(f, as_version=4)
+
+    def cell_line(self, location):
+        cell, line = location
+        text = iimport.NotebookLoader.cell_text(self.nb.cells[cell - 1])
+        return text.split('\n')[line - 1]
+
+    def test_lines_mapped_to_cells(self):
+        lines = sample_notebook._source.split('\n')
+        for lineno, line in enumerate(lines, 1):
+            location = iimport.source_location(self.path, lineno)
+            if line.strip() == 'c = x + y':
+                assert self.cell_line(location) == 'c = x + y'
+            elif line.startswith('def outer_fn('):
+                assert self.cell_line(location).startswith('%def outer_fn(')
+            elif line == 'u, v':
+                assert self.cell_line(location) == 'u, v'
+                assert iimport.format_location(self.path, lineno) == (
+                    '%s:cell %i:line %i' % ((self.path,) + location))
+
+    def test_linecache(self):
+        source = inspect.getsource(sample_notebook.outer_fn)
+        assert source.startswith('def outer_fn(x, y):')
+
+    def test_numbered_source(self):
+        text = iimport.numbered_source('a\nb\nc\nd', lineno=2, context=1)
+        assert text == '    1 a\n>   2 b\n    3 c'
+
+
+class TestNotebookCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.nb_path = os.path.join(self.tmpdir, 'cached_notebook.ipynb')
+        shutil.copy(path_nb, self.nb_path)
+        self.cache = iimport.NotebookCache(os.path.join(self.tmpdir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def entries(self):
+        return [fn for fn in os.listdir(self.cache.cache_dir)
+                if fn.endswith(self.cache.suffix)]
+
+    def test_store_and_load(self):
+        code = compile('a = 1', self.nb_path, 'exec')
+        key = self.cache.key(b'raw')
+        assert self.cache.load(self.nb_path, key) is None
+        self.cache.store(self.nb_path, key, 'a = 1', code, {'lines': 1})
+        source, cached_code, info = self.cache.load(self.nb_path, key)
+        assert source == 'a = 1'
+        assert info == {'lines': 1}
+        ns = {}
+        exec(cached_code, ns)
+        assert ns['a'] == 1
+
+    def test_key_depends_on_contents(self):
+        assert self.cache.key(b'one') != self.cache.key(b'two')
+        assert self.cache.key(b'one') != self.cache.key(b'one', 'mode')
+
+    def test_notebook_key_not_rehashed(self):
+        with mock.patch.object(sys, 'dont_write_bytecode', False):
+            key = self.cache.notebook_key(self.nb_path)
+            assert key == self.cache.file_key(self.nb_path)
+            with mock.patch.object(iimport.NotebookCache, 'file_digest') as m:
+                assert self.cache.notebook_key(self.nb_path) == key
+                assert not m.called
+            with open(self.nb_path, 'a') as f:
+                f.write(' ')
+            assert self.cache.notebook_key(self.nb_path) != key
+
+    def test_stale_entries_evicted(self):
+        code = compile('', self.nb_path, 'exec')
+        self.cache.store(self.nb_path, self.cache.key(b'old'), '', code)
+        self.cache.store(self.nb_path, self.cache.key(b'new'), '', code)
+        assert len(self.entries()) == 1
+        assert self.cache.load(self.nb_path, self.cache.key(b'new'))
+
+    def test_other_versions_and_directories_kept(self):
+        code = compile('', self.nb_path, 'exec')
+        key = self.cache.key(b'raw')
+        self.cache.store(self.nb_path, key, 'a = 1', code)
+        other_dir = os.path.join(self.tmpdir, 'other')
+        os.mkdir(other_dir)
+        other_path = os.path.join(other_dir, 'cached_notebook.ipynb')
+        shutil.copy(path_nb, other_path)
+        self.cache.store(other_path, key, 'a = 2', code)
+        assert self.cache.load(self.nb_path, key)[0] == 'a = 1'
+        assert self.cache.load(other_path, key)[0] == 'a = 2'
+        assert (self.cache.cache_path(self.nb_path, 'stamp')
+                != self.cache.cache_path(other_path, 'stamp'))
+        with mock.patch.object(sys.implementation, 'cache_tag', 'other-99'):
+            self.cache.store(self.nb_path, key, 'a = 3', code)
+        self.cache.store(self.nb_path, self.cache.key(b'new'), '', code)
+        assert len(self.entries()) == 3
+        with mock.patch.object(sys.implementation, 'cache_tag', 'other-99'):
+            assert self.cache.load(self.nb_path, key)[0] == 'a = 3'
+
+    def test_size_limit(self):
+        self.cache.max_size = 0
+        code = compile('', self.nb_path, 'exec')
+        self.cache.store(self.nb_path, self.cache.key(b'raw'), '', code)
+        assert len(self.entries()) == 0
+
+    def test_loader_uses_cache(self):
+        loader = iimport.NotebookLoader()
+        opts = {'dir': self.cache.cache_dir}
+        with mock.patch.dict(iimport.cache_opts, opts), \
+                mock.patch.object(sys, 'dont_write_bytecode', False):
+            source, code, info = loader.compile_ipynb(self.nb_path)
+            assert len(self.entries()) == 1
+            assert loader.compile_ipynb(self.nb_path)[0] == source
+
+    def test_key_depends_on_parser_and_transformers(self):
+        def mark(lines):
+            return lines + ['transformed = True\n']
+        shell = iimport.InteractiveShell.instance()
+        loader = iimport.NotebookLoader()
+        opts = {'dir': self.cache.cache_dir}
+        with mock.patch.dict(iimport.cache_opts, opts), \
+                mock.patch.object(sys, 'dont_write_bytecode', False):
+            source = loader.compile_ipynb(self.nb_path)[0]
+            shell.input_transformers_cleanup.append(mark)
+            try:
+                marked = loader.compile_ipynb(self.nb_path)[0]
+            finally:
+                shell.input_transformers_cleanup.remove(mark)
+            assert 'transformed = True' not in source
+            assert 'transformed = True' in marked
+            with mock.patch.dict(iimport.import_opts, {'parser': 'chain'}), \
+                    mock.patch.object(iimport.NotebookLoader, 'process_ipynb',
+                                      return_value='chained = 1\n'):
+                assert loader.compile_ipynb(self.nb_path)[0] == 'chained = 1\n'
+            assert loader.compile_ipynb(self.nb_path)[0] == source
+
+
+def write_notebook(path, *sources):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [nbformat.v4.new_code_cell(source) for source in sources]
+    with open(path, 'w', encoding='utf-8') as f:
+        nbformat.write(nb, f)
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        opts = {'dir': self.tmpdir, 'storage': 'memory'}
+        self.patches = [mock.patch.dict(iimport.result_cache_opts, opts),
+                        mock.patch.dict(iimport.iimport._result_caches,
+                                        clear=True)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def define(self, options, body='z = x + y'):
+        nb = nbformat.v4.new_notebook()
+        nb.cells = [nbformat.v4.new_code_cell(
+            'calls = []\n%%{%s}def add(x, y=2):\ncalls.append(x)\n'
+            '%s\n%%return z' % (options, body))]
+        text = iimport.NotebookLoader.process_ipynb(nb)
+        assert text == iimport.NotebookLoader.process_ipynb(nb,
+                                                           parser='chain')
+        ns = {}
+        exec(text, ns)
+        return ns
+
+    def test_memory(self):
+        ns = self.define('cache')
+        add = ns['add']
+        assert [add(1), add(1, 2), add(x=1), add(2)] == [3, 3, 3, 4]
+        assert ns['calls'] == [1, 2]
+        assert (add.hits, add.misses) == (2, 2)
+        # Editing the procedure invalidates results
+        ns = self.define('cache', 'z = x * y')
+        assert ns['add'](1) == 2
+        assert ns['calls'] == [1]
+
+    def test_lru_eviction(self):
+        with mock.patch.dict(iimport.result_cache_opts, {'max_entries': 2}):
+            ns = self.define('cache')
+            for x in [1, 2, 1, 3, 2, 1]:
+                ns['add'](x)
+        assert ns['calls'] == [1, 2, 3, 2, 1]
+
+    def test_disk(self):
+        ns = self.define('cache,disk')
+        assert ns['add'](1) == 3
+        # Results survive the session
+        iimport.iimport._result_caches.clear()
+        ns = self.define('cache,disk')
+        assert ns['add'](1) == 3
+        assert ns['calls'] == []
+        info = iimport.get_result_cache('disk').info()
+        assert (info['hits'], info['entries']) == (1, 1)
+        assert 'memory' not in iimport.iimport._result_caches
+
+    def test_disk_broken_entries(self):
+        cache = iimport.DiskResultCache(self.tmpdir)
+        cache.set('truncated', list(range(100)))
+        with open(cache.path('truncated'), 'r+b') as f:
+            f.truncate(10)
+        moved = types.ModuleType('moved_module')
+        exec('class Result(object):\n    pass', moved.__dict__)
+        moved.Result.__module__ = 'moved_module'
+        with mock.patch.dict(sys.modules, {'moved_module': moved}):
+            cache.set('moved', moved.Result())
+        for key in ('truncated', 'moved'):
+            assert cache.get(key, 'missing') == 'missing'
+            assert not os.path.exists(cache.path(key))
+        assert cache.misses == 2
+
+    def test_disk_size_limit(self):
+        cache = iimport.DiskResultCache(self.tmpdir, max_size=3000)
+        for i in range(5):
+            cache.set(str(i), b'x' * 1000)
+        assert cache.info()['entries'] <= 2
+        assert cache.get('4') == b'x' * 1000
+
+    def test_unpicklable_arguments(self):
+        add = self.define('cache')['add']
+        assert add(1, y=True) == 2
+        gen = (i for i in [])
+        self.assertRaises(TypeError, add, gen)
+        assert add.misses == 1
+
+    def test_no_options(self):
+        ns = self.define('')
+        assert not hasattr(ns['add'], 'hits')
+
+    def test_inner_procedure_invalidates(self):
+        def digest(inner_body):
+            nb = nbformat.v4.new_notebook()
+            nb.cells = [nbformat.v4.new_code_cell(
+                '%%{cache}def outer(x):\n%%def inner(x):\n%s\n'
+                '%%return y\nz = y + 1\n%%return z' % inner_body)]
+            text = iimport.NotebookLoader.process_ipynb(nb)
+            return text.split('memoize(')[1].split(',')[0]
+        assert digest('y = x * 2') == digest('y = x * 2')
+        assert digest('y = x * 2') != digest('y = x * 3')
+
+    def test_argument_order(self):
+        digest = iimport.iimport.value_digest
+        assert digest({'a': 1, 'b': {2, 3}}) == digest({'b': {3, 2}, 'a': 1})
+        assert digest(({1: 2},)) != digest(([1, 2],))
+        assert digest([1, 2]) != digest((1, 2))
+        add = self.define('cache', 'z = len(x) + len(y)')['add']
+        assert add({'a': 1, 'b': 2}, {}) == add({'b': 2, 'a': 1}, {})
+        assert (add.hits, add.misses) == (1, 1)
+
+
+class TestNotebookIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = iimport.NotebookIndex()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        importlib.invalidate_caches()
+
+    def test_name_variants(self):
+        for fn in ['plain.ipynb', 'with-hyphens.ipynb', 'with spaces.ipynb']:
+            write_notebook(os.path.join(self.tmpdir, fn))
+        path = [self.tmpdir]
+        assert self.index.find('plain', path).endswith('plain.ipynb')
+        assert self.index.find('with_hyphens', path).endswith('with-hyphens.ipynb')
+        assert self.index.find('with_spaces', path).endswith('with spaces.ipynb')
+        assert self.index.find('missing', path) is None
+
+    def test_negative_lookup_and_invalidation(self):
+        path = [self.tmpdir]
+        assert self.index.find('late', path) is None
+        write_notebook(os.path.join(self.tmpdir, 'late.ipynb'))
+        self.index.invalidate()
+        assert self.index.find('late', path) is not None
+
+    def test_notebook_in_package(self):
+        pkg_dir = os.path.join(self.tmpdir, 'nb_package')
+        os.mkdir(pkg_dir)
+        open(os.path.join(pkg_dir, '__init__.py'), 'w').close()
+        write_notebook(os.path.join(pkg_dir, 'pkg_notebook.ipynb'),
+                       'answer = 42')
+        sys.path.insert(0, self.tmpdir)
+        try:
+            mod = importlib.import_module('nb_package.pkg_notebook')
+            assert mod.answer == 42
+            assert mod.__spec__.origin.endswith('pkg_notebook.ipynb')
+        finally:
+            sys.path.remove(self.tmpdir)
+            for name in ['nb_package', 'nb_package.pkg_notebook']:
+                sys.modules.pop(name, None)
+
+
+class TestNotebookSourceReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, path, chunk_size=None):
+        with open(path, 'r', encoding='utf-8') as f:
+            reader = iimport.NotebookSourceReader(f)
+            if chunk_size:
+                reader.chunk_size = chunk_size
+            return reader.read()
+
+    def test_same_text_as_nbformat(self):
+        with open(path_nb, 'r') as f:
+            nb = nbformat.read(f, as_version=4)
+        expected = iimport.NotebookLoader.process_ipynb(nb)
+        for chunk_size in [None, 1, 7]:
+            nb_fast = self.read(path_nb, chunk_size)
+            assert iimport.NotebookLoader.process_ipynb(nb_fast) == expected
+
+    def test_outputs_skipped(self):
+        nb = nbformat.v4.new_notebook()
+        cell = nbformat.v4.new_code_cell('x = "\\"\nprint("\\u044e")')
+        cell.outputs = [nbformat.v4.new_output(
+            'display_data', {'image/png': 'A' * 10**5, 'text/plain': '"}]'})]
+        nb.cells = [nbformat.v4.new_markdown_cell('# Title'), cell]
+        path = os.path.join(self.tmpdir, 'outputs.ipynb')
+        with open(path, 'w', encoding='utf-8') as f:
+            nbformat.write(nb, f)
+
+        nb_fast = self.read(path, chunk_size=5)
+        assert [c.cell_type for c in nb_fast.cells] == ['markdown', 'code']
+        assert nb_fast.cells[1].source == cell.source
+        assert 'outputs' not in nb_fast.cells[1]
+
+    def test_small_notebook(self):
+        with open(path_nb, 'r') as f:
+            nb_json = iimport.NotebookSourceReader.from_dict(json.load(f))
+        assert nb_json == self.read(path_nb)
+
+    def test_read_ipynb_validate(self):
+        nb = iimport.read_ipynb(path_nb, validate=True)
+        assert 'outputs' in nb.cells[0]
+        nb = iimport.read_ipynb(path_nb)
+        assert 'outputs' not in nb.cells[0]
+
+
+class TestImportStats(unittest.TestCase):
+
+    def test_sample_notebook_stats(self):
+        stats = sample_notebook.__iimport_stats__
+        assert stats is iimport.import_stats['sample_notebook']
+        assert stats['time'] > 0
+        assert 'exec' in stats['stages']
+        if not stats['cached']:
+            assert stats['procedures'] == 9
+            assert {'read', 'parse', 'transform', 'compile'} <= set(stats['stages'])
+        assert 'sample_notebook' in iimport.format_import_stats()
+
+    def test_hooks_and_memory(self):
+        collected = []
+        loader = iimport.NotebookLoader()
+        with mock.patch.object(iimport.iimport, 'import_stats_hooks',
+                               [collected.append]), \
+                mock.patch.dict(iimport.cache_opts, {'enabled': False}):
+            stats = iimport.ImportStats('stats_test', path_nb, trace_memory=True)
+            with stats:
+                loader.compile_ipynb(path_nb, stats)
+        assert collected == [stats.data]
+        assert stats.data['lines'] > 0
+        assert stats.data['stages']['read']['memory'] > 0
+        del iimport.import_stats['stats_test']
+
+
+class TestLazyImport(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        write_notebook('lazy_notebook.ipynb',
+                       'import sys\nsys._lazy_notebook_executed = True',
+                       'answer = 42')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        sys.modules.pop('lazy_notebook', None)
+        if hasattr(sys, '_lazy_notebook_executed'):
+            del sys._lazy_notebook_executed
+
+    def test_executed_on_attribute_access(self):
+        mod = iimport.lazy_import('lazy_notebook')
+        assert not hasattr(sys, '_lazy_notebook_executed')
+        assert mod.answer == 42
+        assert sys._lazy_notebook_executed
+
+    def test_lazy_import_option(self):
+        with mock.patch.dict(iimport.import_opts, {'lazy': True}):
+            import lazy_notebook
+        assert not hasattr(sys, '_lazy_notebook_executed')
+        assert lazy_notebook.answer == 42
+
+
+class TestConcurrentImport(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.names = ['concurrent_%i' % i for i in range(4)]
+        for i, name in enumerate(self.names):
+            write_notebook(name + '.ipynb',
+                           # Magics at the line start are not imported
+                           'if True:\n'
+                           '    %load_ext iimport\n'
+                           '    %iimport concurrent_leaf as leaf',
+                           'import time\ntime.sleep(0.05)\n'
+                           'value = leaf.counter + %i' % i)
+        write_notebook('concurrent_leaf.ipynb',
+                       'import sys, time\n'
+                       'sys._concurrent_leaf_runs = '
+                       'getattr(sys, "_concurrent_leaf_runs", 0) + 1\n'
+                       'time.sleep(0.1)\n'
+                       'counter = 100')
+        self.modules = self.names + ['concurrent_leaf']
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        for name in self.modules:
+            sys.modules.pop(name, None)
+        if hasattr(sys, '_concurrent_leaf_runs'):
+            del sys._concurrent_leaf_runs
+
+    def test_import_notebooks(self):
+        shell = iimport.InteractiveShell.instance()
+        user_ns = shell.user_ns
+        modules = iimport.import_notebooks(self.names, workers=4)
+        assert list(modules) == self.names
+        for i, name in enumerate(self.names):
+            assert modules[name].value == 100 + i
+            assert modules[name].leaf is sys.modules['concurrent_leaf']
+        assert sys._concurrent_leaf_runs == 1
+        assert shell.user_ns is user_ns
+        assert 'leaf' not in user_ns
+
+    def test_import_error(self):
+        with pytest.raises(ImportError):
+            iimport.import_notebooks(self.names + ['concurrent_missing'])
+        assert all(name in sys.modules for name in self.names)
+
+    def test_broken_notebooks(self):
+        write_notebook('concurrent_bad.ipynb', 'x = 1\n1 / 0\ny = 2')
+        write_notebook('concurrent_syntax.ipynb', 'x = (')
+        self.modules += ['concurrent_bad', 'concurrent_syntax']
+        with pytest.raises(ZeroDivisionError):
+            importlib.import_module('concurrent_bad')
+        assert 'concurrent_bad' not in sys.modules
+        with pytest.raises(ZeroDivisionError):
+            iimport.import_notebooks(['concurrent_bad', 'concurrent_syntax'])
+        with pytest.raises(SyntaxError):
+            iimport.import_notebooks(['concurrent_syntax'])
+        assert 'concurrent_bad' not in sys.modules
+        assert 'concurrent_syntax' not in sys.modules
+        with pytest.raises(ZeroDivisionError):
+            iimport.lazy_import('concurrent_bad').x
+        assert 'concurrent_bad' not in sys.modules
+
+    def test_errors_logged(self):
+        write_notebook('concurrent_bad.ipynb', 'x = 1\n1 / 0\ny = 2')
+        self.modules.append('concurrent_bad')
+        with mock.patch.dict(iimport.import_opts, {'errors': 'log'}), \
+                self.assertLogs('iimport', 'ERROR') as logs:
+            mod = importlib.import_module('concurrent_bad')
+        assert sys.modules['concurrent_bad'] is mod
+        assert mod.x == 1 and not hasattr(mod, 'y')
+        assert 'division by zero' in logs.output[0]
+
+    def test_compile_error_reported(self):
+        # The error raised in the code compiled with the notebook path
+        # before the module source is set
+        def compile_ipynb(loader, path, *args, **kwargs):
+            exec(compile('1 / 0', path, 'exec'), {})
+        with mock.patch.object(iimport.NotebookLoader, 'compile_ipynb',
+                               compile_ipynb):
+            with pytest.raises(ZeroDivisionError):
+                importlib.import_module('concurrent_leaf')
+        assert 'concurrent_leaf' not in sys.modules
+
+    def test_lazy_and_regular_import(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       iimport.lazy_import('concurrent_leaf').counter)),
+                   threading.Thread(target=lambda: results.append(
+                       importlib.import_module('concurrent_leaf').counter))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [100, 100]
+        assert sys._concurrent_leaf_runs == 1
+
+    def test_shell_created_in_calling_thread(self):
+        # No shell exists in a fresh process
+        code = ('import iimport\n'
+                'iimport.import_notebooks(%r)\n' % self.names)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(
+            os.path.dirname(os.path.abspath(iimport.__file__))))
+        result = subprocess.run([sys.executable, '-c', code], env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = result.stdout.decode()
+        assert result.returncode == 0, output
+        assert 'ProgrammingError' not in output
+
+    def test_concurrent_lazy_import(self):
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(
+                iimport.lazy_import('concurrent_leaf')))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(map(id, results))) == 1
+        assert results[0].counter == 100
+        assert sys._concurrent_leaf_runs == 1
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        write_notebook('prefetch_top.ipynb',
+                       'import time\ntime.sleep(0.3)',
+                       'import prefetch_mid\n'
+                       'if True:\n'
+                       '    %load_ext iimport\n'
+                       '    %iimport --slice prefetch_other as other\n'
+                       'value = prefetch_mid.value + other.value')
+        write_notebook('prefetch_mid.ipynb',
+                       'from prefetch_leaf import value as leaf_value\n'
+                       'value = leaf_value * 10')
+        write_notebook('prefetch_leaf.ipynb', 'value = 1')
+        write_notebook('prefetch_other.ipynb', 'value = 100')
+        self.modules = ['prefetch_top', 'prefetch_mid', 'prefetch_leaf',
+                        'prefetch_other']
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        for name in self.modules:
+            sys.modules.pop(name, None)
+        iimport.iimport._prefetcher.clear()
+
+    def test_imported_names(self):
+        source = ('import a, b as c\n'
+                  'import pkg.sub\n'
+                  'from d import x\n'
+                  'from .rel import y\n'
+                  'if True:\n'
+                  '    import e\n'
+                  "    get_ipython().run_line_magic('iimport', "
+                  "'--lazy f as g')\n")
+        assert (iimport.NotebookPrefetcher.imported_names(source)
+                == ['a', 'b', 'd', 'e', 'f'])
+
+    def test_prefetch(self):
+        with mock.patch.dict(iimport.import_opts, {'prefetch': 2}):
+            top = importlib.import_module('prefetch_top')
+        assert top.value == 110
+        prefetched = {name: iimport.import_stats[name].get('prefetched')
+                      for name in self.modules}
+        assert prefetched == {'prefetch_top': None, 'prefetch_mid': True,
+                              'prefetch_leaf': True, 'prefetch_other': True}
+        assert 'read' in iimport.import_stats['prefetch_mid']['stages'] \
+            or 'cache' in iimport.import_stats['prefetch_mid']['stages']
+
+    def test_modified_notebook_is_compiled_again(self):
+        with mock.patch.dict(iimport.import_opts, {'prefetch': 2}):
+            loader = iimport.NotebookLoader()
+            source, _, _ = loader.compile_ipynb('prefetch_mid.ipynb')
+            iimport.iimport._prefetcher.prefetch(source)
+            time.sleep(0.3)
+            write_notebook('prefetch_leaf.ipynb', 'value = 2')
+            st = os.stat('prefetch_leaf.ipynb')
+            os.utime('prefetch_leaf.ipynb',
+                     ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            import prefetch_leaf
+        assert prefetch_leaf.value == 2
+        assert 'prefetched' not in iimport.import_stats['prefetch_leaf']
+
+    def test_pending_results_bounded(self):
+        prefetcher = iimport.NotebookPrefetcher()
+        submitted = []
+        def submit(fn, *args):
+            submitted.append(concurrent.futures.Future())
+            return submitted[-1]
+        prefetcher._submit = submit
+        source = 'import prefetch_mid, prefetch_leaf, prefetch_other\n'
+        with mock.patch.object(iimport.iimport, 'notebook_stamp',
+                               side_effect=OSError):
+            prefetcher._scan(source, 'module')
+        assert prefetcher.futures == {}
+        prefetcher.max_pending = 2
+        prefetcher._scan(source, 'module')
+        names = [os.path.basename(key[0]) for key in prefetcher.futures]
+        assert names == ['prefetch_leaf.ipynb', 'prefetch_other.ipynb']
+        assert [f.cancelled() for f in submitted] == [True, False, False]
+        prefetcher.clear()
+        prefetcher.expire = 0
+        prefetcher._scan(source, 'module')
+        names = [os.path.basename(key[0]) for key in prefetcher.futures]
+        assert names == ['prefetch_other.ipynb']
+        assert all(f.cancelled() for f in submitted[:-1])
+        # Expired results are dropped when other results are taken too
+        assert prefetcher.take('prefetch_mid.ipynb', 'module') is None
+        assert prefetcher.futures == {}
+        assert submitted[-1].cancelled()
+
+    def test_disabled_by_default(self):
+        importlib.import_module('prefetch_top')
+        prefetcher = iimport.iimport._prefetcher
+        assert prefetcher.futures == {} and prefetcher.executor is None
+        assert 'prefetched' not in iimport.import_stats['prefetch_mid']
+
+    def test_cell_transformer_not_used(self):
+        shell = iimport.InteractiveShell.instance()
+        transformer = iimport.CellTransformer(enabled=True)
+        shell.input_transformers_cleanup.append(transformer)
+        try:
+            with mock.patch.dict(iimport.import_opts, {'prefetch': 2}):
+                top = importlib.import_module('prefetch_top')
+        finally:
+            shell.input_transformers_cleanup.remove(transformer)
+        assert top.value == 110
+        assert transformer.cells == 0
+
+
+class TestDefinitionsImport(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        write_notebook('defs_notebook.ipynb',
+                       'import os, types\n'
+                       'cfg = types.SimpleNamespace(path="data.csv")',
+                       '%def load(sep, cfg.path):\n'
+                       'name = os.path.basename(cfg.path)\n'
+                       '%return name + sep',
+                       'raise RuntimeError("top-level code executed")')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        sys.modules.pop('defs_notebook', None)
+
+    def import_definitions(self):
+        with mock.patch.dict(iimport.import_opts, {'mode': 'definitions'}):
+            return importlib.import_module('defs_notebook')
+
+    def test_only_definitions_executed(self):
+        nb = self.import_definitions()
+        assert callable(nb.load)
+        assert not hasattr(nb, 'cfg')
+        assert nb.__iimport_stats__['skipped'] == 2
+        assert nb.__iimport_stats__['lazy_defaults'] == {'load': ['cfg_path']}
+
+    def test_lazy_default(self):
+        nb = self.import_definitions()
+        assert nb.load(',', 'dir/other.csv') == 'other.csv,'
+        self.assertRaisesRegex(TypeError, 'cfg.path', nb.load, ',')
+        nb.cfg = types.SimpleNamespace(path='dir/set.csv')
+        assert nb.load(';') == 'set.csv;'
+
+    def test_unknown_mode(self):
+        with mock.patch.dict(iimport.import_opts, {'mode': 'bogus'}):
+            self.assertRaises(ValueError, iimport.NotebookLoader().compile_ipynb,
+                              'defs_notebook.ipynb')
+
+
+class TestSliceImport(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        write_notebook('slice_notebook.ipynb',
+                       'import math\n'
+                       'log = []\n'
+                       'data = [1, 2, 3]\n'
+                       'data.append(4)',
+                       '%def calc_sums(values=data):\n'
+                       'total = sum(values) + offset\n'
+                       '%return total',
+                       'offset = 10',
+                       'log.append("heavy")\n'
+                       'results = [calc_sums(data[:i]) for i in range(3)]',
+                       '%def scaled(x):\n'
+                       'y = math.sqrt(x) * factor\n'
+                       '%return y',
+                       'factor = 2\n'
+                       'snapshot = factor\n'
+                       'factor = factor * 50')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        sys.modules.pop('slice_notebook', None)
+
+    def import_slice(self):
+        with mock.patch.dict(iimport.import_opts, {'mode': 'slice'}):
+            return importlib.import_module('slice_notebook')
+
+    def test_only_slice_executed(self):
+        nb = self.import_slice()
+        from slice_notebook import calc_sums
+        assert calc_sums() == 20
+        assert 'log' not in vars(nb) and 'results' not in vars(nb)
+        assert not hasattr(nb, 'missing')
+        assert nb.results == [10, 11, 13]
+        assert nb.log == ['heavy']
+
+    def test_function_globals(self):
+        nb = self.import_slice()
+        # Functions see the final values of module variables
+        assert nb.scaled(4) == 200
+        assert 'snapshot' not in vars(nb)
+        # Executed out of order in a separate namespace
+        assert nb.snapshot == 2
+        assert nb.factor == 100
+
+    def test_import_in_mode(self):
+        nb = iimport.import_in_mode('slice_notebook', 'slice')
+        assert iimport.import_opts['mode'] == 'module'
+        assert nb.calc_sums() == 20
+        assert 'log' not in vars(nb)
+        # The partial module is not returned by other imports
+        assert 'slice_notebook' not in sys.modules
+        full = importlib.import_module('slice_notebook')
+        assert full is not nb and full.log == ['heavy']
+        nb = iimport.import_in_mode('slice_notebook', 'definitions')
+        assert callable(nb.scaled) and 'data' not in vars(nb)
+        assert iimport.import_in_mode('slice_notebook', 'module') is full
+        self.assertRaises(ImportError, iimport.import_in_mode,
+                          'missing_notebook', 'slice')
+
+    def test_slice(self):
+        slicer = self.import_slice().__iimport_slicer__
+        names = [slicer.binds[i] for i in slicer.slice(['calc_sums'])]
+        assert names == [{'data'}, {'data'}, {'calc_sums'}, {'offset'}]
+        names = [slicer.binds[i] for i in slicer.slice(['snapshot'])]
+        assert names == [{'factor'}, {'snapshot'}]
+
+    def test_dynamic_lookups(self):
+        source = ('import os\n'
+                  'x = 1\n'
+                  'def f():\n'
+                  '    return globals()["x"]\n')
+        slicer = iimport.ModuleSlicer(source, '<test>')
+        ns = {'__name__': 'test'}
+        slicer.define(ns, ['f'])
+        assert ns['f']() == 1
+        assert 'os' in ns
+
+
+class TestProcedureScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        write_notebook('graph_notebook.ipynb',
+                       'import threading\n'
+                       'barrier = threading.Barrier(2, timeout=5)\n'
+                       'x = 1',
+                       '%def outer(x):\n'
+                       'n = x * 10\n'
+                       '%def left(n):\n'
+                       'barrier.wait()\n'
+                       'a = [n + i for i in range(2)]\n'
+                       '%return a',
+                       '%def right(x):\n'
+                       'barrier.wait()\n'
+                       'b = x * 2\n'
+                       '%return b\n'
+                       'c = sum(a) + b\n'
+                       '%return c')
+        self.nb = importlib.import_module('graph_notebook')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        sys.modules.pop('graph_notebook', None)
+
+    def test_graph(self):
+        graph = self.nb.__procedures__
+        assert list(graph) == ['left', 'right', 'outer']
+        assert graph['outer'] == {'params': ['x'], 'defaults': {},
+                                  'results': ['c'],
+                                  'calls': ['left', 'right']}
+        assert graph['left']['params'] == ['n']
+
+    def test_plan(self):
+        steps, _ = iimport.ProcedureScheduler(self.nb).plan('outer')
+        assert [step['call'] for step in steps] == [None, 'left', 'right',
+                                                   None]
+        # `n = x * 10` might modify `x`, so `right(x)` waits for it too
+        assert [step['depends'] for step in steps] == [
+            set(), {0}, {0}, {0, 1, 2}]
+
+    def test_independent_calls_run_concurrently(self):
+        # Both inner procedures wait for each other at the barrier
+        scheduler = iimport.ProcedureScheduler(self.nb, workers=2)
+        assert scheduler.run('outer', 2) == 20 + 21 + 4
+        assert scheduler.run('outer', x=1) == 10 + 11 + 2
+
+    def test_not_scheduled(self):
+        scheduler = iimport.ProcedureScheduler(self.nb)
+        assert scheduler.plan('left') is not None
+        assert scheduler.plan('missing') is None
+        self.assertRaises(ValueError, iimport.ProcedureScheduler, self.nb,
+                          backend='bogus')
+
+
+class TestProcedureMap(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        write_notebook('map_notebook.ipynb',
+                       'import numpy as np\n'
+                       'calls = []\n'
+                       'offset = 10',
+                       '%def shift(x, k=1):\n'
+                       'calls.append(x)\n'
+                       'y = x * k + offset\n'
+                       '%return y',
+                       '%def check(x):\n'
+                       'assert x != 2, "x is 2"\n'
+                       '%return x')
+        self.nb = importlib.import_module('map_notebook')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        sys.modules.pop('map_notebook', None)
+
+    def test_param_sets(self):
+        sets = list(iimport.param_sets({'x': [1, 2], 'k': [3]}))
+        assert sets == [({'x': 1, 'k': 3}, (), {'x': 1, 'k': 3}),
+                        ({'x': 2, 'k': 3}, (), {'x': 2, 'k': 3})]
+        sets = list(iimport.param_sets([{'x': 1}, (2, 3), 4]))
+        assert [s[1:] for s in sets] == [((), {'x': 1}), ((2, 3), {}),
+                                         ((4,), {})]
+
+    def test_thread_map(self):
+        results = self.nb.shift.map({'x': [1, 2, 3], 'k': [1, 10]},
+                                    workers=3, backend='thread')
+        assert sorted((p['x'], p['k'], y) for p, y in results) == [
+            (1, 1, 11), (1, 10, 20), (2, 1, 12), (2, 10, 30),
+            (3, 1, 13), (3, 10, 40)]
+        results = self.nb.shift.map(range(5), backend='thread', ordered=True)
+        assert [y for _, y in results] == [10, 11, 12, 13, 14]
+
+    def test_process_map(self):
+        context = multiprocessing.get_context('spawn')
+        results = self.nb.shift.map([(1, 2), (3, 4)], workers=1,
+                                    ordered=True, mp_context=context)
+        assert list(results) == [((1, 2), 12), ((3, 4), 22)]
+        # Calls were made in the worker process
+        assert self.nb.calls == []
+
+    def test_module_not_registered(self):
+        nb = iimport.import_in_mode('map_notebook', 'definitions')
+        # Another module registered by the name is not used
+        other = types.ModuleType('map_notebook')
+        other._source = 'def shift(x, k=1):\n    return -1\n'
+        other.shift = lambda x, k=1: -1
+        sys.modules['map_notebook'] = other
+        for method in multiprocessing.get_all_start_methods():
+            if method == 'forkserver':
+                continue
+            context = multiprocessing.get_context(method)
+            results = nb.shift.map([(1, 2), (3, 4)], workers=1,
+                                   ordered=True, mp_context=context)
+            assert list(results) == [((1, 2), 12), ((3, 4), 22)]
+
+    def test_exceptions(self):
+        results = self.nb.check.map([1, 2, 3], backend='thread', ordered=True)
+        with pytest.raises(AssertionError):
+            list(results)
+        results = self.nb.check.map([1, 2, 3], backend='thread', ordered=True,
+                                    return_exceptions=True)
+        results = list(results)
+        assert isinstance(results[1][1], AssertionError)
+        assert [results[0], results[2]] == [(1, 1), (3, 3)]
+
+    def test_vectorize(self):
+        results = self.nb.shift.map({'x': [1, 2, 3], 'k': [2]},
+                                    backend='thread', vectorize=True)
+        assert [y for _, y in results] == [12, 14, 16]
+        # Vectorized call and the checks of the first and last results
+        assert len(self.nb.calls) == 3
+        del self.nb.calls[:]
+        results = self.nb.check.map([1, 3], backend='thread', ordered=True,
+                                    vectorize=True)
+        assert [y for _, y in results] == [1, 3]
+
+    def test_vectorize_checked(self):
+        def relative(x):
+            return x - np.min(x)
+        # Only the first result is the same as of the usual call
+        results = iimport.map_procedure(relative, [0, 1, 2], backend='thread',
+                                        ordered=True, vectorize=True)
+        assert [y for _, y in results] == [0, 0, 0]
+        # Close values of a different dtype
+        results = iimport.map_procedure(round, [0.4, 1.6], backend='thread',
+                                        ordered=True, vectorize=True)
+        results = [y for _, y in results]
+        assert results == [0, 2]
+        assert all(type(y) is int for y in results)
+
+    def test_not_a_procedure(self):
+        self.assertRaises(ValueError, iimport.map_procedure, len, [1])
+        self.assertRaises(ValueError, self.nb.shift.map, [1], backend='bogus')
+
+
+class TestReloadProcedures(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.cells = ['import sys\nsys._reload_notebook_runs += 1',
+                      '%def scale(x, k=2):\ny = x * k\n%return y',
+                      'def shift(x):\n    return x + 1']
+        write_notebook('reload_notebook.ipynb', *self.cells)
+        sys._reload_notebook_runs = 0
+        self.nb = importlib.import_module('reload_notebook')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+        sys.modules.pop('reload_notebook', None)
+        del sys._reload_notebook_runs
+
+    def test_not_modified(self):
+        assert iimport.reload_procedures(self.nb) is None
+        result = iimport.reload_procedures(self.nb, force=True)
+        assert result == {'changed': [], 'added': [], 'removed': []}
+
+    def test_changed_procedure_rebound(self):
+        scale = self.nb.scale
+        shift = self.nb.shift
+        self.nb.state = 'kept'
+        self.cells[0] += '\n# comment moving the code below'
+        self.cells[1] = '%def scale(x, k=3):\ny = x * k\n%return y'
+        self.cells.append('def new(x):\n    return -x')
+        self.cells.append('%def added(x):\ny = x + 2\n%return y')
+        write_notebook('reload_notebook.ipynb', *self.cells)
+
+        result = iimport.reload_procedures(self.nb, force=True)
+        assert result == {'changed': ['scale'], 'added': ['new', 'added'],
+                          'removed': []}
+        assert sys._reload_notebook_runs == 1
+        assert self.nb.state == 'kept'
+        assert self.nb.scale(1) == 3
+        # References to the old function object call the new code too
+        assert scale(1) == 3 and self.nb.scale is scale
+        assert self.nb.shift is shift
+        assert self.nb.new(1) == -1
+        assert 'k=3' in self.nb._source
+        results = self.nb.added.map([1, 2], backend='thread', ordered=True)
+        assert [y for _, y in results] == [3, 4]
+        assert hasattr(self.nb.scale, 'map')
+
+    def test_broken_procedure_kept(self):
+        self.cells[1] = '%def scale(x, k=undefined):\ny = x * k\n%return y'
+        write_notebook('reload_notebook.ipynb', *self.cells)
+        result = iimport.reload_procedures(self.nb, force=True)
+        assert result['changed'] == []
+        assert self.nb.scale(1) == 2
+
+    def test_notebook_modules(self):
+        assert self.nb in iimport.notebook_modules()
+        assert sample_notebook in iimport.notebook_modules()
+
+
+class TestIncrementalConverter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.nb_path = os.path.join(self.tmpdir, 'converted.ipynb')
+        self.py_path = os.path.join(self.tmpdir, 'converted.py')
+        self.converter = iimport.IncrementalConverter()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_text_as_process_ipynb(self):
+        with open(path_nb, 'r') as f:
+            nb = nbformat.read(f, as_version=4)
+        expected = iimport.NotebookLoader.process_ipynb(nb)
+        assert self.converter.process_ipynb(nb) == expected
+        assert self.converter.process_ipynb(nb) == expected
+        assert self.converter.misses == self.converter.hits
+
+    def test_only_changed_cells_processed(self):
+        cells = ['a = 1', '%def f(x):\ny = x', 'z = y\n%return z', 'b = 2']
+        write_notebook(self.nb_path, *cells)
+        assert self.converter.convert_ipynb(self.nb_path)
+        misses = self.converter.misses
+
+        cells[1] = '%def f(x):\ny = x + 1'
+        write_notebook(self.nb_path, *cells)
+        assert self.converter.convert_ipynb(self.nb_path)
+        # changed cell and the next one (its entry state has changed)
+        assert self.converter.misses - misses == 2
+        with open(self.py_path) as f:
+            assert 'y = x + 1' in f.read()
+
+    def test_inner_procedure_changed(self):
+        cells = ['%{cache}def outer(x):\n%def inner(x):\ny = x * 2',
+                 '%return y', 'z = y + 1\n%return z']
+        write_notebook(self.nb_path, *cells)
+        self.converter.convert_ipynb(self.nb_path)
+        cells[0] = cells[0].replace('x * 2', 'x * 3')
+        write_notebook(self.nb_path, *cells)
+        self.converter.convert_ipynb(self.nb_path)
+        with open(self.py_path) as f:
+            text = f.read()
+        assert text == iimport.NotebookLoader.process_ipynb(
+            iimport.read_ipynb(self.nb_path))
+
+    def test_unchanged_file_not_written(self):
+        write_notebook(self.nb_path, 'a = 1')
+        assert self.converter.convert_ipynb(self.nb_path)
+        mtime = os.stat(self.py_path).st_mtime_ns
+        write_notebook(self.nb_path, 'a = 1', '%- print(a)')
+        assert not self.converter.convert_ipynb(self.nb_path)
+        assert os.stat(self.py_path).st_mtime_ns == mtime
+        assert sorted(os.listdir(self.tmpdir)) == ['converted.ipynb',
+                                                   'converted.py']
+
+
+class TestBackgroundExporter(unittest.TestCase):
+
+    class SlowConverter(object):
+        def __init__(self):
+            self.started = threading.Event()
+            self.release = threading.Event()
+            self.paths = []
+
+        def convert_ipynb(self, path):
+            self.paths.append(path)
+            self.started.set()
+            self.release.wait(5)
+            return True
+
+    def test_saves_coalesce(self):
+        converter = self.SlowConverter()
+        exporter = iimport.BackgroundExporter(workers=1, converter=converter)
+        exporter.submit('a.ipynb')
+        converter.started.wait(5)
+        for _ in range(5):
+            exporter.submit('a.ipynb')
+        exporter.submit('b.ipynb')
+        exporter.submit('b.ipynb')
+        assert exporter.queue_depth == 2
+        converter.release.set()
+        exporter.shutdown()
+        assert sorted(converter.paths) == ['a.ipynb', 'a.ipynb', 'b.ipynb']
+        assert exporter.coalesced == 6
+        assert exporter.queue_depth == 0
+        assert exporter.last_latency is not None
+
+    def test_failed_export_logged(self):
+        converter = mock.Mock()
+        converter.convert_ipynb.side_effect = IOError
+        log = mock.Mock()
+        exporter = iimport.BackgroundExporter(workers=1, converter=converter)
+        exporter.submit('a.ipynb', log=log)
+        exporter.shutdown()
+        assert log.exception.called
+        assert exporter.states == {}
+
+
 class TestCodeTransformChain(unittest.TestCase):
 
     # def setUp(self):
@@ -71,7 +1425,13 @@ class TestCodeTransformChain(unittest.TestCase):
     #     chain = fetch_tag(collect_proc(output_filter()), opts=chain_opts)
 
     def test_chain_works(self):
-        pass
+        chain = fetch_tag(collect_proc(output_filter()), opts={'enabled': 1})
+        lines_out = [chain.send(l) for l in
+                     ['%def add(x, y):', 'z = x + y', '%- print(z)',
+                      '%return z']]
+        assert lines_out[0] is None
+        assert lines_out[1:3] == ['z = x + y', 'print(z)']
+        assert 'def add(x, y):' in lines_out[3]
 
 
 if __name__ == '__main__':
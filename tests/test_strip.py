@@ -0,0 +1,227 @@
+import unittest
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import nbformat
+from nbformat.v4 import new_notebook, new_code_cell, new_markdown_cell, \
+    new_output
+
+from iimport import strip
+
+
+def dirty_notebook():
+    nb = new_notebook()
+    nb.metadata['language_info'] = {'name': 'python', 'version': '3.6.1'}
+    nb.metadata['widgets'] = {'state': {}}
+    nb.cells = [
+        new_markdown_cell('# Title with "quotes" and \\ backslash'),
+        new_code_cell('x = "a\\"b"\nprint(x)', execution_count=3,
+                      metadata={'collapsed': True},
+                      outputs=[new_output('stream', text='a"b\n' * 100),
+                               new_output('display_data',
+                                          data={'image/png': 'QUJD' * 1000})]),
+        new_code_cell('y = [x, {"}": "]"}]', execution_count=4),
+    ]
+    for i, cell in enumerate(nb.cells):
+        cell.id = 'cell%i' % i
+    return nbformat.writes(nb) + '\n'
+
+
+def run_stripper(text, chunk_size=None):
+    stripper = strip.NotebookStripper(io.StringIO(text), io.StringIO())
+    if chunk_size:
+        stripper.chunk_size = chunk_size
+    changed = stripper.strip()
+    return changed, stripper.out.getvalue()
+
+
+def check_stripped(test, text):
+    data = json.loads(text)
+    test.assertNotIn('widgets', data['metadata'])
+    test.assertEqual(data['metadata']['language_info'], {'name': 'python'})
+    markdown, cell1, cell2 = data['cells']
+    test.assertEqual(markdown['metadata'], {})
+    test.assertNotIn('outputs', markdown)
+    for cell in cell1, cell2:
+        test.assertEqual(cell['outputs'], [])
+        test.assertIsNone(cell['execution_count'])
+        test.assertEqual(cell['metadata'], {})
+    test.assertEqual(''.join(cell1['source']), 'x = "a\\"b"\nprint(x)')
+    test.assertEqual(''.join(cell2['source']), 'y = [x, {"}": "]"}]')
+
+
+class TestNotebookStripper(unittest.TestCase):
+
+    def test_strip(self):
+        changed, text = run_stripper(dirty_notebook())
+        self.assertTrue(changed)
+        check_stripped(self, text)
+
+    def test_chunk_boundaries(self):
+        _, expected = run_stripper(dirty_notebook())
+        for chunk_size in (1, 2, 3, 7, 64):
+            changed, text = run_stripper(dirty_notebook(), chunk_size)
+            self.assertTrue(changed)
+            self.assertEqual(text, expected)
+
+    def test_clean_notebook_is_kept(self):
+        _, clean = run_stripper(dirty_notebook())
+        # Line endings and formatting are not touched
+        clean = clean.replace('\n', '\r\n')
+        changed, text = run_stripper(clean)
+        self.assertFalse(changed)
+        self.assertEqual(text, clean)
+
+    def test_check_stops_at_first_change(self):
+        with self.assertRaises(strip.Dirty):
+            strip.NotebookStripper(io.StringIO(dirty_notebook())).strip()
+        _, clean = run_stripper(dirty_notebook())
+        self.assertFalse(strip.NotebookStripper(io.StringIO(clean)).strip())
+
+    def test_malformed(self):
+        for text in ('', '{"cells": [', '{"cells": []} x', '[1, 2'):
+            with self.assertRaises(ValueError):
+                run_stripper(text)
+
+
+class TestStripFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'sub'))
+        os.makedirs(os.path.join(self.root, '.ipynb_checkpoints'))
+        self.dirty = [os.path.join(self.root, 'a.ipynb'),
+                      os.path.join(self.root, 'sub', 'b.ipynb'),
+                      os.path.join(self.root, '.ipynb_checkpoints',
+                                   'a-checkpoint.ipynb')]
+        for path in self.dirty:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(dirty_notebook())
+        self.clean = os.path.join(self.root, 'sub', 'c.ipynb')
+        with open(self.clean, 'w', encoding='utf-8') as f:
+            f.write(run_stripper(dirty_notebook())[1])
+        self.lines = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_strip_files(self):
+        for jobs in (1, 2):
+            statuses, failures = strip.strip_files([self.root], jobs=jobs,
+                                                   report=self.lines.append)
+            self.assertEqual(failures, {})
+            expected = 'stripped' if jobs == 1 else 'clean'
+            self.assertEqual(statuses, {self.dirty[0]: expected,
+                                        self.dirty[1]: expected,
+                                        self.clean: 'clean'})
+        for path in self.dirty[:2]:
+            self.assertTrue(strip.is_clean(path))
+        # Checkpoints are skipped
+        self.assertFalse(strip.is_clean(self.dirty[2]))
+
+    def test_clean_file_is_not_rewritten(self):
+        mtime = os.stat(self.clean).st_mtime_ns - 10**9
+        os.utime(self.clean, ns=(mtime, mtime))
+        self.assertEqual(strip.strip_file(self.clean)[0], 'clean')
+        self.assertEqual(os.stat(self.clean).st_mtime_ns, mtime)
+
+    def test_check(self):
+        statuses, _ = strip.strip_files([self.root], jobs=1, check=True,
+                                        report=self.lines.append)
+        self.assertEqual(statuses[self.dirty[0]], 'dirty')
+        self.assertFalse(strip.is_clean(self.dirty[0]))
+
+    def test_failures(self):
+        bad = os.path.join(self.root, 'bad.ipynb')
+        with open(bad, 'w') as f:
+            f.write('{"cells": [')
+        statuses, failures = strip.strip_files([self.root], jobs=1,
+                                               report=self.lines.append)
+        self.assertEqual(list(failures), [bad])
+        self.assertEqual(statuses[self.dirty[0]], 'stripped')
+
+
+class TestGitFilter(unittest.TestCase):
+
+    @staticmethod
+    def packets(*groups):
+        f = io.BytesIO()
+        for group in groups:
+            if isinstance(group, bytes):
+                for pos in range(0, len(group), 1000):
+                    strip.write_packet(f, group[pos:pos + 1000])
+                strip.write_packet(f)
+            else:
+                strip.write_packet_lines(f, group)
+        f.seek(0)
+        return f
+
+    def test_filter_process(self):
+        content = dirty_notebook().encode('utf-8')
+        stdin = self.packets(
+            ['git-filter-client', 'version=2'],
+            ['capability=clean', 'capability=smudge'],
+            ['command=clean', 'pathname=a.ipynb'], content,
+            ['command=clean', 'pathname=bad.ipynb'], b'{"cells": [',
+            ['command=smudge', 'pathname=a.ipynb'], content)
+        stdout = io.BytesIO()
+        strip.git_filter_process(stdin, stdout)
+
+        stdout.seek(0)
+        self.assertEqual(strip.read_packet_lines(stdout),
+                         ['git-filter-server', 'version=2'])
+        self.assertEqual(strip.read_packet_lines(stdout),
+                         ['capability=clean'])
+        self.assertEqual(strip.read_packet_lines(stdout), ['status=success'])
+        reader = strip.PacketReader(stdout)
+        text = ''.join(iter(reader.read, ''))
+        check_stripped(self, text)
+        self.assertEqual(strip.read_packet_lines(stdout), [])
+        self.assertEqual(strip.read_packet_lines(stdout), ['status=error'])
+        self.assertEqual(strip.read_packet_lines(stdout), ['status=error'])
+        self.assertEqual(stdout.read(), b'')
+
+    def test_legacy_filter_script_copied(self):
+        root = os.path.dirname(os.path.dirname(
+            os.path.abspath(strip.__file__)))
+        bin_dir = tempfile.mkdtemp()
+        try:
+            script = os.path.join(bin_dir, 'ipynb_output_filter.py')
+            shutil.copy(os.path.join(root, 'util', 'ipynb_output_filter.py'),
+                        script)
+            env = dict(os.environ, PYTHONPATH=root)
+            out = subprocess.run([sys.executable, script], cwd=bin_dir,
+                                 env=env, check=True, stdout=subprocess.PIPE,
+                                 input=dirty_notebook().encode('utf-8'))
+            self.assertEqual(out.stdout.decode('utf-8'),
+                             run_stripper(dirty_notebook())[1])
+        finally:
+            shutil.rmtree(bin_dir)
+
+    @unittest.skipIf(shutil.which('git') is None, 'git is not installed')
+    def test_git_add(self):
+        repo = tempfile.mkdtemp()
+        try:
+            git = lambda *args: subprocess.check_output(('git',) + args,
+                                                        cwd=repo)
+            git('init', '-q')
+            strip.install_git_filter(repo)
+            with open(os.path.join(repo, '.gitattributes'), 'w') as f:
+                f.write('*.ipynb filter=iimport-strip\n')
+            with open(os.path.join(repo, 'a.ipynb'), 'w',
+                      encoding='utf-8') as f:
+                f.write(dirty_notebook())
+            git('add', 'a.ipynb')
+            staged = git('show', ':a.ipynb').decode('utf-8')
+            self.assertEqual(staged, run_stripper(dirty_notebook())[1])
+        finally:
+            shutil.rmtree(repo)
+
+
+if __name__ == '__main__':
+    unittest.main()
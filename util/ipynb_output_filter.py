@@ -1,77 +1,47 @@
 #!/usr/bin/env python3
-
+"""
+Strip outputs from the notebook given as argument (or read from stdin)
+and write it to stdout.
+
+Kept for existing git configurations, the work is done by iimport-strip
+(iimport/strip.py), which is loaded by path so that IPython is not imported.
+The script may be copied anywhere (e.g. ~/bin): strip.py of the installed
+iimport package is used, or the one of the repository the script is in.
+"""
+import importlib.util
+import io
+import os
 import sys
 
-try:
-    runarg_idx = sys.argv.index('--rundir')
-    rundir = sys.argv[runarg_idx+1]
-    import os
-    os.chdir(os.path.expanduser(rundir))
-except ValueError:
-    pass
-
-version = None
 
-if sys.version[0] == '2':
-    reload(sys)
-    sys.setdefaultencoding('utf8')
+def find_strip():
+    # Finding the package does not execute its __init__
+    spec = importlib.util.find_spec('iimport')
+    if spec is not None and spec.submodule_search_locations:
+        for location in spec.submodule_search_locations:
+            path = os.path.join(location, 'strip.py')
+            if os.path.isfile(path):
+                return path
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'iimport', 'strip.py')
 
-try:
-    # Jupyter
-    from jupyter_nbformat import reads, write
-except ImportError:
-    try:
-        # New IPython
-        from nbformat import reads, write
-    except ImportError:
-        # Old IPython
-        from IPython.nbformat.current import reads, write
-        version = 'json'
+strip_path = find_strip()
 
-if len(sys.argv) > 1:
-    to_parse = open(sys.argv[1], 'r').read()
-else:
-    to_parse = sys.stdin.read()
+args = sys.argv[1:]
+if '--rundir' in args:
+    idx = args.index('--rundir')
+    os.chdir(os.path.expanduser(args[idx + 1]))
+    del args[idx:idx + 2]
 
-if not version:
-    import json
-    json_in = json.loads(to_parse)
-    version = json_in['nbformat']
+spec = importlib.util.spec_from_file_location('iimport_strip', strip_path)
+strip = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(strip)
 
-json_in = reads(to_parse, version)
-
-if hasattr(json_in, 'worksheets'):
-    # IPython
-    sheets = json_in.worksheets
+if args:
+    f = strip.open_notebook(args[0])
 else:
-    # Jupyter
-    sheets = [json_in]
-
-for sheet in sheets:
-    for cell in sheet.cells:
-        if "outputs" in cell:
-            cell.outputs = []
-        for field in ("prompt_number", "execution_number"):
-            if field in cell:
-                del cell[field]
-        for field in ("execution_count",):
-            if field in cell:
-                cell[field] = None
-
-        if "metadata" in cell:
-            cell.metadata = {}
-            #for field in ("collapsed", "scrolled", "ExecuteTime", "run_control", "deletable", "editable"):
-            #    if field in cell.metadata:
-            #        del cell.metadata[field]
-
-    if hasattr(sheet.metadata, "widgets"):
-        del sheet.metadata["widgets"]
-
-    if hasattr(sheet.metadata, "language_info"):
-        if hasattr(sheet.metadata.language_info, "version"):
-            del sheet.metadata.language_info["version"]
-
-if 'signature' in json_in.metadata:
-    json_in.metadata['signature'] = ""
-
-write(json_in, sys.stdout, version)
+    f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+out = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='')
+with f:
+    strip.NotebookStripper(f, out).strip()
+out.flush()